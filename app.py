@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 import os.path as osp
@@ -19,6 +20,10 @@ import imageio
 
 from models.pipeline import LatentToVideoPipeline
 from utils.common import tensor_to_vae_latent, DDPM_forward
+from utils.condition_cache import ConditionCache, tensor_digest
+from utils.inference_server import MicroBatchServer
+from utils.preview import PreviewCallback, batch_preview_callback, stream_request
+from utils.video_sink import frames_to_uint8
 
 css = """
 .toolbutton {
@@ -32,7 +37,8 @@ css = """
 
 class AnimateController:
     def __init__(self, pretrained_model_path: str, validation_data,
-        output_dir, motion_mask = False, motion_strength = False):
+        output_dir, motion_mask = False, motion_strength = False, max_batch_size = 4, max_wait = 0.1,
+        cache_max_bytes = 1024 ** 3, preview_every = 5):
         # For mixed precision training we cast the text_encoder and vae weights to half-precision
         # as these models are only used for inference, keeping weights in full precision is not required.
         device=torch.device("cuda")
@@ -40,7 +46,16 @@ class AnimateController:
         self.output_dir = output_dir
         self.pipeline = LatentToVideoPipeline.from_pretrained(pretrained_model_path, 
             torch_dtype=torch.float16, variant="fp16").to(device)
-        self.sample_idx = 0
+        self.vae_processor = VaeImageProcessor()
+        # steps between previews of the x0 estimate, 0 for none
+        self.preview_every = preview_every
+        # clicks are served concurrently, next() on a count is atomic
+        self.sample_idx = itertools.count()
+        # the pipeline stays loaded on the worker thread of the server, clicks only preprocess their inputs
+        self.server = MicroBatchServer(self.run_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+        # vae latents of uploaded images (per session) and prompt embeddings, so editing the mask, prompt, seed or
+        # motion strength of an image only pays for denoising. Only the server worker touches it.
+        self.input_cache = ConditionCache(max_entries=256, max_bytes=cache_max_bytes)
 
     def animate(
         self,
@@ -52,22 +67,18 @@ class AnimateController:
         cfg_scale_slider,
         seed_textbox,
         style,
+        request: gr.Request,
         progress=gr.Progress(),
     ):
 
         if seed_textbox != "-1" and seed_textbox != "":
-            torch.manual_seed(int(seed_textbox))
+            seed = int(seed_textbox)
         else:
-            torch.seed()
-        seed = torch.initial_seed()
+            # not torch.seed(), which reseeds the global rng other requests may be drawing from
+            seed = random.randrange(2 ** 63)
 
-        vae = self.pipeline.vae
-        diffusion_scheduler = self.pipeline.scheduler
         validation_data = self.validation_data
-        vae_processor =  VaeImageProcessor()
-
-        device = vae.device
-        dtype = vae.dtype
+        sample_idx = next(self.sample_idx)
 
         pimg = Image.fromarray(init_img["background"]).convert('RGB')
         width, height = pimg.size
@@ -75,46 +86,101 @@ class AnimateController:
         block_size=8
         height = round(height/scale/block_size)*block_size
         width = round(width/scale/block_size)*block_size
-        input_image = vae_processor.preprocess(pimg, height, width)
-        input_image = input_image.unsqueeze(0).to(dtype).to(device)
-        input_image_latents = tensor_to_vae_latent(input_image, vae)
+        input_image = self.vae_processor.preprocess(pimg, height, width)
+        input_image = input_image.unsqueeze(0)
         np_mask = init_img["layers"][0][:,:,3]
         np_mask[np_mask!=0] = 255
         if np_mask.sum() == 0:
             np_mask[:] = 255
         save_sample_path = os.path.join(
-            self.output_dir, f"{self.sample_idx}.mp4")
+            self.output_dir, f"{sample_idx}.mp4")
         out_mask_path = os.path.splitext(save_sample_path)[0] + "_mask.jpg"
         Image.fromarray(np_mask).save(out_mask_path)
- 
-        b, c, _, h, w = input_image_latents.shape
-        initial_latents, timesteps = DDPM_forward(input_image_latents, 
-            sample_step_slider, validation_data.num_frames, diffusion_scheduler) 
-        mask = T.ToTensor()(np_mask).to(dtype).to(device)
-        b, c, f, h, w = initial_latents.shape
-        mask = T.Resize([h, w], antialias=False)(mask)
+
+        vae_scale_factor = self.pipeline.vae_scale_factor
+        mask = T.ToTensor()(np_mask)
+        mask = T.Resize([height // vae_scale_factor, width // vae_scale_factor], antialias=False)(mask)
         mask = rearrange(mask, 'b h w -> b 1 1 h w')
         motion_strength = motion_scale * mask.mean().item()
         print(f"outfile {save_sample_path}, prompt {prompt_textbox}, motion_strength {motion_strength}")
+
+        # clicks with the same key share a pipeline call
+        key = (height, width, int(sample_step_slider), float(cfg_scale_slider))
+        for preview, video_frames in stream_request(self.server, key, {
+            "input_image": input_image,
+            "input_key": (request.session_hash if request else None, "vae_latent", tensor_digest(input_image)),
+            "mask": mask,
+            "prompt": prompt_textbox,
+            "motion_strength": motion_strength,
+            "seed": seed,
+            "num_inference_steps": int(sample_step_slider),
+            "guidance_scale": float(cfg_scale_slider),
+        }):
+            if preview is not None:
+                yield preview, gr.update()
+
+        imageio.mimwrite(save_sample_path, video_frames, fps=8)
+        yield gr.update(), save_sample_path
+
+    def run_batch(self, jobs):
+        """Generates the videos of `jobs`, which share resolution, steps and cfg scale, in one pipeline call."""
+        vae = self.pipeline.vae
+        diffusion_scheduler = self.pipeline.scheduler
+        num_frames = self.validation_data.num_frames
+        _, _, _, height, width = jobs[0]["input_image"].shape
+        num_inference_steps = jobs[0]["num_inference_steps"]
+        guidance_scale = jobs[0]["guidance_scale"]
+
+        device = vae.device
+        dtype = vae.dtype
+
         with torch.no_grad():
-            video_frames, video_latents = self.pipeline(
-                prompt=prompt_textbox,
-                latents=initial_latents,
+            input_images = {job["input_key"]: job["input_image"] for job in jobs}
+
+            def encode_images(keys):
+                input_image = torch.cat([input_images[key] for key in keys]).to(dtype).to(device)
+                return tensor_to_vae_latent(input_image, vae).split(1)
+
+            def encode_prompts(keys):
+                return self.pipeline.encode_prompt([prompt for _, prompt in keys], device, 1, False)[0].split(1)
+
+            input_image_latents = torch.cat(self.input_cache.get_or_compute_many(
+                [job["input_key"] for job in jobs], encode_images))
+            prompt_embeds = torch.cat(self.input_cache.get_or_compute_many(
+                [("prompt", job["prompt"]) for job in jobs], encode_prompts))
+            # the unconditional prompt of the pipeline
+            negative_prompt_embeds = self.input_cache.get_or_compute_many([("prompt", "")], encode_prompts)[0]
+            negative_prompt_embeds = negative_prompt_embeds.expand_as(prompt_embeds)
+            # the noise of every video comes from its own seed, as if it was generated alone. Per job generators
+            # instead of torch.manual_seed, the global rng is shared with the click handler threads
+            generator = [torch.Generator().manual_seed(job["seed"]) for job in jobs]
+            initial_latents = []
+            for g, latent in zip(generator, input_image_latents):
+                initial_latent, timesteps = DDPM_forward(latent[None], num_inference_steps, num_frames,
+                                                         diffusion_scheduler, generator=g)
+                initial_latents.append(initial_latent)
+            mask = torch.cat([job["mask"] for job in jobs]).to(dtype).to(device)
+
+            video_tensor, video_latents = self.pipeline(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                latents=torch.cat(initial_latents),
+                generator=generator,
                 width=width,
                 height=height,
-                num_frames=validation_data.num_frames,
-                num_inference_steps=sample_step_slider,
-                guidance_scale=cfg_scale_slider,
+                num_frames=num_frames,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
                 condition_latent=input_image_latents,
                 mask=mask,
-                motion=[motion_strength],
+                motion=[job["motion_strength"] for job in jobs],
+                output_type="pt",
                 return_dict=False,
                 timesteps=timesteps,
+                callback_on_step_end=batch_preview_callback(jobs, self.preview_every, channel_dim=1),
+                callback_on_step_end_tensor_inputs=PreviewCallback.tensor_inputs,
             )
-
-        imageio.mimwrite(save_sample_path, video_frames, fps=8)
-        self.sample_idx += 1
-        return save_sample_path
+        return [frames_to_uint8(video) for video in video_tensor]
 
 
 def ui(controller):
@@ -163,13 +229,18 @@ def ui(controller):
                         queue=False
                     )
 
-                generate_button = gr.Button(
-                    value="Generate", variant='primary')
+                with gr.Row():
+                    generate_button = gr.Button(
+                        value="Generate", variant='primary')
+                    cancel_button = gr.Button(value="Cancel")
 
-            result_video = gr.Video(
-                label="Generated Animation", interactive=False)
+            with gr.Column():
+                preview_image = gr.Image(
+                    label="Preview", interactive=False)
+                result_video = gr.Video(
+                    label="Generated Animation", interactive=False)
 
-        generate_button.click(
+        generate_event = generate_button.click(
             fn=controller.animate,
             inputs=[
                 init_img,
@@ -181,8 +252,18 @@ def ui(controller):
                 seed_textbox,
                 style_dropdown,
             ],
-            outputs=[result_video]
+            outputs=[preview_image, result_video],
+            # enough clicks in flight to fill the micro-batches of the server
+            concurrency_limit=2 * controller.server.max_batch_size,
         )
+        # stops the denoising of a batch once all of its requests are cancelled
+        cancel_button.click(fn=None, cancels=[generate_event], queue=False)
+
+        with gr.Accordion('Server Status', open=False):
+            status_json = gr.JSON(label="Queue depth, latency (s) and input cache")
+            status_button = gr.Button(value="Refresh")
+            status_button.click(fn=lambda: {**controller.server.metrics(), "input_cache": controller.input_cache.stats()},
+                                outputs=[status_json], queue=False)
 
         def create_example(input_list):
             return gr.Examples(
@@ -218,6 +299,10 @@ if __name__ == "__main__":
     parser.add_argument('--share', action='store_true', default=False)
     parser.add_argument('--local-debug', action='store_true')
     parser.add_argument('--save-path', default='samples')
+    parser.add_argument('--max-batch-size', type=int, default=4, help='requests generated in one pipeline call')
+    parser.add_argument('--max-wait', type=float, default=0.1, help='seconds a request waits for a batch to fill')
+    parser.add_argument('--cache-mb', type=int, default=1024, help='memory cap of the cached input latents')
+    parser.add_argument('--preview-every', type=int, default=5, help='steps between previews, 0 to disable')
 
     args, unknownargs = parser.parse_known_args()
     LOCAL_DEBUG = args.local_debug
@@ -225,7 +310,8 @@ if __name__ == "__main__":
     cli_conf = OmegaConf.from_cli()
     args_dict = OmegaConf.merge(args_dict, cli_conf)
     controller = AnimateController(args_dict.pretrained_model_path, args_dict.validation_data, 
-        args_dict.output_dir, args_dict.motion_mask, args_dict.motion_strength)
+        args_dict.output_dir, args_dict.motion_mask, args_dict.motion_strength, args.max_batch_size, args.max_wait,
+        args.cache_mb * 1024 ** 2, args.preview_every)
     demo = ui(controller)
     demo.queue(max_size=10)
     demo.launch(server_name=args.server_name,
@@ -1,9 +1,11 @@
+import itertools
 import os
 import random
 from argparse import ArgumentParser
 import math
 
 import gradio as gr
+import numpy as np
 import torch
 from diffusers.image_processor import VaeImageProcessor
 from omegaconf import OmegaConf
@@ -15,6 +17,9 @@ from diffusers import StableVideoDiffusionPipeline
 from models.pipeline import TextStableVideoDiffusionPipeline
 from einops import rearrange, repeat
 from utils.common import read_video
+from utils.condition_cache import ConditionCache, tensor_digest
+from utils.inference_server import MicroBatchServer
+from utils.preview import PreviewCallback, batch_preview_callback, stream_request
 
 css = """
 .toolbutton {
@@ -28,7 +33,8 @@ css = """
 
 class AnimateController:
     def __init__(self, pretrained_model_path: str, validation_data,
-        output_dir, motion_mask = False, motion_strength = False):
+        output_dir, motion_mask = False, motion_strength = False, max_batch_size = 4, max_wait = 0.1,
+        cache_max_bytes = 1024 ** 3, preview_every = 5):
         # For mixed precision training we cast the text_encoder and vae weights to half-precision
         # as these models are only used for inference, keeping weights in full precision is not required.
         device=torch.device("cuda")
@@ -36,7 +42,16 @@ class AnimateController:
         self.output_dir = output_dir
         self.pipeline = StableVideoDiffusionPipeline.from_pretrained(pretrained_model_path, torch_dtype=torch.float16, variant="fp16").to(device)
         #self.pipeline = StableVideoDiffusionPipeline.from_pretrained(pretrained_model_path).to(device)
-        self.sample_idx = 0
+        self.vae_processor = VaeImageProcessor()
+        # steps between previews of the x0 estimate, 0 for none
+        self.preview_every = preview_every
+        # clicks are served concurrently, next() on a count is atomic
+        self.sample_idx = itertools.count()
+        # the pipeline stays loaded on the worker thread of the server, clicks only preprocess their inputs
+        self.server = MicroBatchServer(self.run_batch, max_batch_size=max_batch_size, max_wait=max_wait)
+        # vae latents of the uploaded image / video frames and clip embeddings of the first frame, per session, so
+        # editing the mask, seed or settings of an upload only pays for denoising. Only the server worker touches it.
+        self.input_cache = ConditionCache(max_entries=64, max_bytes=cache_max_bytes)
 
     def animate(
         self,
@@ -47,109 +62,153 @@ class AnimateController:
         fps_textbox,
         num_frames_textbox,
         motion_bucket_id_slider,
+        request: gr.Request,
         progress=gr.Progress(),
     ):
 
         if seed_textbox != "-1" and seed_textbox != "":
-            torch.manual_seed(int(seed_textbox))
+            seed = int(seed_textbox)
         else:
-            torch.seed()
-        seed = torch.initial_seed()
+            # not torch.seed(), which reseeds the global rng other requests may be drawing from
+            seed = random.randrange(2 ** 63)
+
+        # per click settings, the shared validation_data is not modified
+        validation_data = self.validation_data
+        num_frames = int(num_frames_textbox)
+        sample_idx = next(self.sample_idx)
+
+        pimg = Image.fromarray(init_img["background"]).convert('RGB')
+        np_mask = init_img["layers"][0][:,:,3]
+        np_mask[np_mask!=0] = 255
+        if np_mask.sum() == 0:
+            np_mask[:] = 255
+        frames = None
+        if input_video is not None:
+            frames = read_video(input_video)
+            frames = [Image.fromarray(f) for f in frames]
+            pimg = frames[0]
+        width, height = pimg.size
+        scale = math.sqrt(width*height / (validation_data.height*validation_data.width))
+        block_size=64
+        height = round(height/scale/block_size)*block_size
+        width = round(width/scale/block_size)*block_size
+        # images of a batch are stacked, so they are brought to the generated size here
+        pimg = pimg.resize((width, height))
+        if frames is not None:
+            input_image = torch.cat([self.vae_processor.preprocess(frame, height, width) for frame in frames])
+        else:
+            input_image = self.vae_processor.preprocess(pimg, height, width)
+        f = len(input_image) if frames is not None else num_frames
+
+        vae_scale_factor = self.pipeline.vae_scale_factor
+        mask = T.ToTensor()(np_mask)
+        mask = T.Resize([height // vae_scale_factor, width // vae_scale_factor], antialias=False)(mask)
+        mask = repeat(mask, 'b h w -> b f 1 h w', f=f).detach().clone()
+        mask[:,0] = 0
+
+        settings = {
+            "width": width,
+            "height": height,
+            "num_frames": num_frames,
+            "num_inference_steps": validation_data.num_inference_steps,
+            "decode_chunk_size": validation_data.get("decode_chunk_size", 7),
+            "fps": int(fps_textbox),
+            "motion_bucket_id": int(motion_bucket_id_slider),
+        }
+        # clicks with the same key share a pipeline call
+        key = (f, *settings.values())
+        session = request.session_hash if request else None
+        if frames is not None:
+            # an upload keeps its temporary path, which is cheaper to key on than the content of every frame
+            stat = os.stat(input_video)
+            input_key = (session, "vae_latent", os.path.abspath(input_video), stat.st_size, stat.st_mtime_ns,
+                         height, width)
+        else:
+            input_key = (session, "vae_latent", tensor_digest(input_image))
+        for preview, video_frames in stream_request(self.server, key, {
+            "image": pimg,
+            "image_key": (session, "image_embeds", tensor_digest(np.asarray(pimg))),
+            "input_image": input_image,
+            "input_key": input_key,
+            "mask": mask,
+            "seed": seed,
+            "settings": settings,
+        }):
+            if preview is not None:
+                yield preview, gr.update()
+
+        save_sample_path = os.path.join(
+            self.output_dir, f"{sample_idx}.mp4")
+        Image.fromarray(np_mask).save(os.path.join(
+            self.output_dir, f"{sample_idx}_label.jpg"))
+        imageio.mimwrite(save_sample_path, video_frames, fps=7)
+        yield gr.update(), save_sample_path
+
+    def run_batch(self, jobs):
+        """Generates the videos of `jobs`, which share their settings and condition length, in one pipeline call."""
+        settings = jobs[0]["settings"]
+        vae = self.pipeline.vae
+        device = vae.device
+        dtype = vae.dtype
+        # cpu generators: both pipelines draw the noise augmentation of the preprocessed image on the cpu
+        generator = [torch.Generator().manual_seed(job["seed"]) for job in jobs]
+        images = [job["image"] for job in jobs]
+        callback = batch_preview_callback(jobs, self.preview_every, channel_dim=2)
 
         with torch.no_grad():
-            vae = self.pipeline.vae
-            validation_data = self.validation_data
-            validation_data.fps = int(fps_textbox)
-            validation_data.num_frames = int(num_frames_textbox)
-            validation_data.motion_bucket_id = int(motion_bucket_id_slider)
-            vae_processor = VaeImageProcessor()
-
-            device = vae.device
-            dtype = vae.dtype
-
-            f = validation_data.num_frames
-            pimg = Image.fromarray(init_img["background"]).convert('RGB')
-            np_mask = init_img["layers"][0][:,:,3]
-            np_mask[np_mask!=0] = 255
-            if np_mask.sum() == 0:
-                np_mask[:] = 255
-            if input_video is not None:
-                frames = read_video(input_video)
-                frames = [Image.fromarray(f) for f in frames]
-                pimg = frames[0]
-                width, height = pimg.size
-                scale = math.sqrt(width*height / (validation_data.height*validation_data.width))
-                block_size=64
-                height = round(height/scale/block_size)*block_size
-                width = round(width/scale/block_size)*block_size
-                f = len(frames)
-                
-                latents = []
-                for frame in frames:
-                    input_image = vae_processor.preprocess(frame, height, width)
-                    input_image = input_image.to(dtype).to(device)
-                    input_image_latent = vae.encode(input_image).latent_dist.mode() * vae.config.scaling_factor
-                    latents.append(input_image_latent.unsqueeze(1))
-                latents = torch.cat(latents, dim=1)
-            else:
-                width, height = pimg.size
-                scale = math.sqrt(width*height / (validation_data.height*validation_data.width))
-                block_size=64
-                height = round(height/scale/block_size)*block_size
-                width = round(width/scale/block_size)*block_size
-                input_image = vae_processor.preprocess(pimg, height, width)
-                input_image = input_image.to(dtype).to(device)
-                input_image_latent = vae.encode(input_image).latent_dist.mode() * vae.config.scaling_factor
-                latents = repeat(input_image_latent, 'b c h w->b f c h w', f=f)
-        
+            motion_mask = self.pipeline.unet.config.in_channels == 9
+            if not motion_mask:
+                # the stock pipeline only exposes the noisy latents to callbacks
+                return self.pipeline(
+                    image=images,
+                    generator=generator,
+                    callback_on_step_end=callback,
+                    **settings,
+                ).frames
+
+            input_images = {job["input_key"]: job["input_image"] for job in jobs}
+            clip_images = {job["image_key"]: job["image"] for job in jobs}
+
+            def encode_latents(keys):
+                inputs = [input_images[key] for key in keys]
+                input_image = torch.cat(inputs).to(dtype).to(device)
+                latents = vae.encode(input_image).latent_dist.mode() * vae.config.scaling_factor
+                return latents.split([len(x) for x in inputs])
+
+            def encode_images(keys):
+                return self.pipeline._encode_image([clip_images[key] for key in keys], device, 1, False).split(1)
+
+            # the inputs missing from the cache are encoded in one call per encoder
+            input_image_latents = self.input_cache.get_or_compute_many(
+                [job["input_key"] for job in jobs], encode_latents)
+            image_embeddings = self.input_cache.get_or_compute_many([job["image_key"] for job in jobs], encode_images)
+            condition_latents = []
+            for job, input_image_latent in zip(jobs, input_image_latents):
+                if len(input_image_latent) == 1:
+                    latents = repeat(input_image_latent, 'b c h w->b f c h w', f=job["mask"].shape[1])
+                else:
+                    latents = input_image_latent.unsqueeze(0)
+                condition_latents.append(latents)
+            latents = torch.cat(condition_latents)
             b, f, c, h, w = latents.shape
 
-            mask = T.ToTensor()(np_mask).to(dtype).to(device)
-            mask = T.Resize([h, w], antialias=False)(mask)
-            mask = repeat(mask, 'b h w -> b f 1 h w', f=f).detach().clone()
-            mask[:,0] = 0
+            mask = torch.cat([job["mask"] for job in jobs]).to(dtype).to(device)
             freeze = repeat(latents[:,0], 'b c h w -> b f c h w', f=f)
             condition_latents = latents * (1-mask) + freeze * mask
             condition_latents = condition_latents/vae.config.scaling_factor
 
-            motion_mask = self.pipeline.unet.config.in_channels == 9
-            decode_chunk_size=validation_data.get("decode_chunk_size", 7)
-            fps=validation_data.get("fps", 7)
-            motion_bucket_id=validation_data.get("motion_bucket_id", 127)
-            if motion_mask:
-                video_frames = TextStableVideoDiffusionPipeline.__call__(
-                    self.pipeline,
-                    image=pimg,
-                    width=width,
-                    height=height,
-                    num_frames=validation_data.num_frames,
-                    num_inference_steps=validation_data.num_inference_steps,
-                    decode_chunk_size=decode_chunk_size,
-                    fps=fps,
-                    motion_bucket_id=motion_bucket_id,
-                    mask=mask,
-                    condition_type="image",
-                    condition_latent=condition_latents
-                ).frames[0]
-            else:
-                video_frames = self.pipeline(
-                    image=pimg,
-                    width=width,
-                    height=height,
-                    num_frames=validation_data.num_frames,
-                    num_inference_steps=validation_data.num_inference_steps,
-                    fps=validation_data.fps,
-                    decode_chunk_size=validation_data.decode_chunk_size,
-                    motion_bucket_id=validation_data.motion_bucket_id,
-                ).frames[0]
-
-        save_sample_path = os.path.join(
-            self.output_dir, f"{self.sample_idx}.mp4")
-        Image.fromarray(np_mask).save(os.path.join(
-            self.output_dir, f"{self.sample_idx}_label.jpg"))
-        imageio.mimwrite(save_sample_path, video_frames, fps=7)
-        self.sample_idx += 1
-        return save_sample_path
+            return TextStableVideoDiffusionPipeline.__call__(
+                self.pipeline,
+                image=images,
+                generator=generator,
+                mask=mask,
+                condition_type="image",
+                condition_latent=condition_latents,
+                image_embeddings=torch.cat(image_embeddings),
+                callback_on_step_end=callback,
+                callback_on_step_end_tensor_inputs=PreviewCallback.tensor_inputs,
+                **settings,
+            ).frames
 
 import cv2
 
@@ -183,12 +242,17 @@ def ui(controller):
         with gr.Row(equal_height=True):
             with gr.Column():
                 init_img = gr.ImageMask(label='Input Image', brush=gr.Brush(default_size=100))
-                generate_button = gr.Button(
-                    value="Generate", variant='primary')
+                with gr.Row():
+                    generate_button = gr.Button(
+                        value="Generate", variant='primary')
+                    cancel_button = gr.Button(value="Cancel")
             input_video = gr.Video(label="Input video", interactive=True)
-            
-            result_video = gr.Video(
-                label="Generated Animation", interactive=False)
+
+            with gr.Column():
+                preview_image = gr.Image(
+                    label="Preview", interactive=False)
+                result_video = gr.Video(
+                    label="Generated Animation", interactive=False)
 
         with gr.Accordion('Advance Options', open=False):
             with gr.Row():
@@ -220,7 +284,7 @@ def ui(controller):
 
 
 
-        generate_button.click(
+        generate_event = generate_button.click(
             fn=controller.animate,
             inputs=[
                 init_img,
@@ -231,8 +295,18 @@ def ui(controller):
                 num_frames_textbox,
                 motion_bucket_id_slider
             ],
-            outputs=[result_video]
+            outputs=[preview_image, result_video],
+            # enough clicks in flight to fill the micro-batches of the server
+            concurrency_limit=2 * controller.server.max_batch_size,
         )
+        # stops the denoising of a batch once all of its requests are cancelled
+        cancel_button.click(fn=None, cancels=[generate_event], queue=False)
+
+        with gr.Accordion('Server Status', open=False):
+            status_json = gr.JSON(label="Queue depth, latency (s) and input cache")
+            status_button = gr.Button(value="Refresh")
+            status_button.click(fn=lambda: {**controller.server.metrics(), "input_cache": controller.input_cache.stats()},
+                                outputs=[status_json], queue=False)
 
     return demo
 
@@ -245,6 +319,10 @@ if __name__ == "__main__":
     parser.add_argument('--share', action='store_true')
     parser.add_argument('--local-debug', action='store_true')
     parser.add_argument('--save-path', default='samples')
+    parser.add_argument('--max-batch-size', type=int, default=4, help='requests generated in one pipeline call')
+    parser.add_argument('--max-wait', type=float, default=0.1, help='seconds a request waits for a batch to fill')
+    parser.add_argument('--cache-mb', type=int, default=1024, help='memory cap of the cached input latents')
+    parser.add_argument('--preview-every', type=int, default=5, help='steps between previews, 0 to disable')
 
     args, unknownargs = parser.parse_known_args()
     LOCAL_DEBUG = args.local_debug
@@ -252,7 +330,8 @@ if __name__ == "__main__":
     cli_conf = OmegaConf.from_cli()
     args_dict = OmegaConf.merge(args_dict, cli_conf)
     controller = AnimateController(args_dict.pretrained_model_path, args_dict.validation_data,
-        args_dict.output_dir, args_dict.motion_mask, args_dict.motion_strength)
+        args_dict.output_dir, args_dict.motion_mask, args_dict.motion_strength, args.max_batch_size, args.max_wait,
+        args.cache_mb * 1024 ** 2, args.preview_every)
     demo = ui(controller)
     demo.queue(max_size=10)
     demo.launch(server_name=args.server_name,
@@ -8,41 +8,84 @@ import ffmpeg
 import subprocess
 import time
 import multiprocessing
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import shutil
 import json
+from tqdm import tqdm
 try:
     from psutil import cpu_count
 except:
     from multiprocessing import cpu_count
 # multiprocessing.freeze_support()
 
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".flv", ".mjpeg", ".m4v", ".ts")
+# scale so that the short side is 512
+SCALE_FILTER = 'scale=\'if(gt(a,1),trunc(oh*a/2)*2,512)\':\'if(gt(a,1),512,trunc(ow*a/2)*2)\''
+
+
+def compress_command(input_video_path, output_video_path, threads=2, frames_dir=None, frame_size=None):
+    command = ['ffmpeg',
+               '-y',  # (optional) overwrite output file if it exists
+               '-threads', str(threads),
+               '-i', input_video_path,
+               ]
+    if frames_dir is None:
+        command += ['-filter:v', SCALE_FILTER,  # scale to 512
+                    '-map', '0:v']
+    else:
+        # the same decode also writes frames at the training resolution, resized to cover it and center cropped
+        width, height = frame_size
+        command += ['-filter_complex',
+                    f'[0:v]split=2[v][f];[v]{SCALE_FILTER}[out];'
+                    f'[f]scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height}[frames]',
+                    '-map', '[out]']
+    command += ['-threads', str(threads),
+                #'-r', '3',  # frames per second
+                '-f', 'mp4', output_video_path]
+    if frames_dir is not None:
+        command += ['-map', '[frames]', '-q:v', '2', os.path.join(frames_dir, '%06d.jpg')]
+    return command
+
+
 def compress(paras):
-    input_video_path, output_video_path = paras
-    try:
-        command = ['ffmpeg',
-                   '-y',  # (optional) overwrite output file if it exists
-                   '-i', input_video_path,
-                   '-filter:v',
-                   'scale=\'if(gt(a,1),trunc(oh*a/2)*2,512)\':\'if(gt(a,1),512,trunc(ow*a/2)*2)\'',  # scale to 256
-                   '-map', '0:v',
-                   #'-r', '3',  # frames per second
-                   output_video_path,
-                   ]
-        ffmpeg = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = ffmpeg.communicate()
-        retcode = ffmpeg.poll()
-        # print something above for debug
-    except Exception as e:
-        raise e
+    """
+    Transcodes one video, the output (and the frame folder) only appear under their final name once ffmpeg succeeded,
+    so an existing output is always complete. Returns the ffmpeg error output, None on success.
+    """
+    input_video_path, output_video_path, threads, frames_dir, frame_size = paras
+    os.makedirs(os.path.dirname(output_video_path), exist_ok=True)
+    tmp_video_path = output_video_path + ".part"
+    tmp_frames_dir = None
+    if frames_dir is not None:
+        tmp_frames_dir = frames_dir + ".part"
+        shutil.rmtree(tmp_frames_dir, ignore_errors=True)
+        os.makedirs(tmp_frames_dir)
+    command = compress_command(input_video_path, tmp_video_path, threads, tmp_frames_dir, frame_size)
+    ffmpeg = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if ffmpeg.returncode != 0 or not os.path.exists(tmp_video_path) or os.path.getsize(tmp_video_path) < 1:
+        if os.path.exists(tmp_video_path):
+            os.remove(tmp_video_path)
+        if tmp_frames_dir is not None:
+            shutil.rmtree(tmp_frames_dir, ignore_errors=True)
+        return ffmpeg.stderr.decode(errors="replace")[-2000:] or f"ffmpeg exited with {ffmpeg.returncode}"
+    if tmp_frames_dir is not None:
+        shutil.rmtree(frames_dir, ignore_errors=True)
+        os.replace(tmp_frames_dir, frames_dir)
+    # the video last, its presence marks the whole job as done
+    os.replace(tmp_video_path, output_video_path)
+    return None
+
 
 def prepare_input_output_pairs(input_root, output_root):
     input_video_path_list = []
     output_video_path_list = []
     for root, dirs, files in os.walk(input_root):
         for file_name in files:
+            if not file_name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
             input_video_path = os.path.join(root, file_name)
-            output_video_path = os.path.join(output_root, file_name)
+            # keep the directory structure, equal file names in different folders must not overwrite each other
+            output_video_path = os.path.join(output_root, os.path.relpath(input_video_path, input_root))
             output_video_path = os.path.splitext(output_video_path)[0] + ".mp4"
             if os.path.exists(output_video_path) and os.path.getsize(output_video_path) > 0:
                 pass
@@ -51,6 +94,51 @@ def prepare_input_output_pairs(input_root, output_root):
                 output_video_path_list.append(output_video_path)
     return input_video_path_list, output_video_path_list
 
+
+def schedule(num_cores, ffmpeg_threads):
+    """ffmpeg processes and threads per process so that together they use `num_cores` without oversubscribing."""
+    ffmpeg_threads = max(1, min(ffmpeg_threads, num_cores))
+    return max(1, num_cores // ffmpeg_threads), ffmpeg_threads
+
+
+def compress_all(input_video_path_list, output_video_path_list, num_workers, ffmpeg_threads, retries=2,
+                 frames_root=None, output_root=None, frame_size=None):
+    """Runs `compress` on a pool of `num_workers` and streams the results, failed videos are retried."""
+    jobs = {}
+    for input_video_path, output_video_path in zip(input_video_path_list, output_video_path_list):
+        frames_dir = None
+        if frames_root is not None:
+            frames_dir = os.path.join(frames_root, os.path.splitext(os.path.relpath(output_video_path, output_root))[0])
+        jobs[output_video_path] = (input_video_path, output_video_path, ffmpeg_threads, frames_dir, frame_size)
+
+    failed = {}
+    attempts = {path: 0 for path in jobs}
+    # every worker only waits on its ffmpeg process, threads are enough
+    with ThreadPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(jobs), desc="Compress") as progress:
+        futures = {executor.submit(compress, paras): path for path, paras in jobs.items()}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = futures.pop(future)
+                attempts[path] += 1
+                try:
+                    error = future.result()
+                except Exception as e:
+                    error = str(e)
+                if error is None:
+                    failed.pop(path, None)
+                    progress.update(1)
+                elif attempts[path] <= retries:
+                    failed[path] = error
+                    futures[executor.submit(compress, jobs[path])] = path
+                else:
+                    failed[path] = error
+                    progress.update(1)
+                    tqdm.write("convert fail: {}\n{}".format(path, error))
+                progress.set_postfix(failed=len(failed))
+    return failed
+
+
 def msvd():
     captions = pickle.load(open('raw-captions.pkl','rb'))
     outdir = "/data/datasets/msvd/videos_mp4"
@@ -105,6 +193,12 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Compress video for speed-up')
     parser.add_argument('--input_root', type=str, help='input root')
     parser.add_argument('--output_root', type=str, help='output root')
+    parser.add_argument('--ffmpeg_threads', type=int, default=2, help='threads of every ffmpeg process')
+    parser.add_argument('--retries', type=int, default=2, help='retries of a failed video')
+    parser.add_argument('--frames_root', type=str, default=None,
+                        help='also extract frames at --frame_width x --frame_height into this folder')
+    parser.add_argument('--frame_width', type=int, default=512)
+    parser.add_argument('--frame_height', type=int, default=512)
     args = parser.parse_args()
 
     input_root = args.input_root
@@ -118,19 +212,13 @@ if __name__ == "__main__":
     input_video_path_list, output_video_path_list = prepare_input_output_pairs(input_root, output_root)
 
     print("Total video need to process: {}".format(len(input_video_path_list)))
-    num_works = cpu_count()
-    print("Begin with {}-core logical processor.".format(num_works))
-
-    pool = Pool(num_works)
-    data_dict_list = pool.map(compress,
-                              [(input_video_path, output_video_path) for
-                               input_video_path, output_video_path in
-                               zip(input_video_path_list, output_video_path_list)])
-    pool.close()
-    pool.join()
-
-    print("Compress finished, wait for checking files...")
-    for input_video_path, output_video_path in zip(input_video_path_list, output_video_path_list):
-        if os.path.exists(input_video_path):
-            if os.path.exists(output_video_path) is False or os.path.getsize(output_video_path) < 1.:
-                print("convert fail: {}".format(output_video_path))
\ No newline at end of file
+    num_works, ffmpeg_threads = schedule(cpu_count(), args.ffmpeg_threads)
+    print("Begin with {} ffmpeg processes x {} threads.".format(num_works, ffmpeg_threads))
+
+    failed = compress_all(input_video_path_list, output_video_path_list, num_works, ffmpeg_threads,
+                          retries=args.retries, frames_root=args.frames_root, output_root=output_root,
+                          frame_size=(args.frame_width, args.frame_height))
+
+    print("Compress finished, {} failed".format(len(failed)))
+    for output_video_path in failed:
+        print("convert fail: {}".format(output_video_path))
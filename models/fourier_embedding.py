@@ -18,19 +18,35 @@ class FourierEmbedder(nn.Module):
         # self.freq_bands = temperature ** (torch.arange(num_freqs) / num_freqs)
         self.fc2 = nn.Linear(output_dim, self.target_w * self.target_h)
 
-        max_freq = 1/10
-        self.freq_bands = 2. ** torch.linspace(0., max_freq, steps=num_freqs)
+        self.max_freq = 1/10
+        # non-persistent so that existing checkpoints still load, moves with the module on `.to(device)`
+        self.register_buffer("freq_bands", self._freq_bands(), persistent=False)
         # torch.Size([2, 4, 64]) torch.Size([2, 48])
 
-    def __call__(self, x, cat_dim=-1):
+    def _freq_bands(self, device=None):
+        return 2. ** torch.linspace(0., self.max_freq, steps=self.num_freqs, device=device)
+
+    def reset_buffers(self):
+        # the frequencies are not in the state dict, recompute them after `to_empty()` of a meta-device module
+        self.freq_bands = self._freq_bands(self.freq_bands.device)
+
+    def encode(self, x, cat_dim=-1):
+        """
+        sin / cos features of `x` flattened per sample, [batch, 2 * num_freqs * x[0].numel()], in the order
+        sin(f0 x), cos(f0 x), sin(f1 x), ... along `cat_dim`.
+        Static camera / tx positions can be encoded once per sequence and passed to `forward` as `features`.
+        """
+        x = x.movedim(cat_dim, -1)
+        x = x.unsqueeze(-2) * self.freq_bands.to(x.dtype)[:, None]  # [..., num_freqs, d]
+        x = torch.stack((torch.sin(x), torch.cos(x)), dim=-2)  # [..., num_freqs, 2, d]
+        x = x.flatten(-3).movedim(-1, cat_dim)
+        return x.reshape(x.size(0), -1)  # [2, 5, 3, 64, 64]
+
+    def forward(self, x=None, cat_dim=-1, features=None):
         "x: arbitrary shape of tensor. dim: cat dim"
-        out = []
-        for freq in self.freq_bands:
-            out.append(torch.sin(freq * x))
-            out.append(torch.cos(freq * x))
-        x = torch.cat(out, cat_dim)
-        x = x.view(x.size(0), -1)  # [2, 5, 3, 64, 64]
-        x = self.fc2(x)
+        if features is None:
+            features = self.encode(x, cat_dim)
+        x = self.fc2(features)
         return x.view(x.size(0), 1, 1, self.target_h, self.target_w)
 
 
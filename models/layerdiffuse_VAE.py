@@ -43,14 +43,14 @@ class LatentTransparencyOffsetEncoder(torch.nn.Module):
 
 
 class ImageResizeEncoder(torch.nn.Module):
-    def __init__(self, input_dim, output_dim, hidden_dim=1024):
+    def __init__(self, input_dim, output_dim, hidden_dim=1024, device=None):
         super(ImageResizeEncoder, self).__init__()
         self.blocks = torch.nn.Sequential(
-            nn.Linear(input_dim, hidden_dim, device='cuda'),
+            nn.Linear(input_dim, hidden_dim, device=device),
             nn.SiLU(),
-            nn.Linear(hidden_dim, hidden_dim, device='cuda'),
+            nn.Linear(hidden_dim, hidden_dim, device=device),
             nn.SiLU(),
-            nn.Linear(hidden_dim, output_dim, device='cuda'),
+            nn.Linear(hidden_dim, output_dim, device=device),
         )
 
     def __call__(self, x):
@@ -58,15 +58,15 @@ class ImageResizeEncoder(torch.nn.Module):
 
 
 class SignalResizeEncoder(torch.nn.Module):
-    def __init__(self, input_dim, output_dim, hidden_dim=1024):
+    def __init__(self, input_dim, output_dim, hidden_dim=1024, device=None):
         super(SignalResizeEncoder, self).__init__()
 
         self.encoder = torch.nn.Sequential(
-            nn.Linear(input_dim, hidden_dim, device='cuda'),
+            nn.Linear(input_dim, hidden_dim, device=device),
             nn.SiLU(),
-            nn.Linear(hidden_dim, hidden_dim, device='cuda'),
+            nn.Linear(hidden_dim, hidden_dim, device=device),
             nn.SiLU(),
-            nn.Linear(hidden_dim, output_dim, device='cuda'),
+            nn.Linear(hidden_dim, output_dim, device=device),
         )
 
     def forward(self, x):
@@ -76,7 +76,8 @@ class SignalResizeEncoder(torch.nn.Module):
 
 
 class LatentSignalEncoder(torch.nn.Module):
-    def __init__(self, input_dim=512, hidden_dims=[1024, 512, 256, 128, 64], output_dim=32, dropout_prob=0.3):
+    def __init__(self, input_dim=512, hidden_dims=[1024, 512, 256, 128, 64], output_dim=32, dropout_prob=0.3,
+                 device=None):
         super(LatentSignalEncoder, self).__init__()
 
         # Create a list of layers
@@ -85,13 +86,13 @@ class LatentSignalEncoder(torch.nn.Module):
 
         # Add hidden layers
         for hidden_dim in hidden_dims:
-            layers.append(nn.Linear(current_dim, hidden_dim, device='cuda'))  # Linear layer
+            layers.append(nn.Linear(current_dim, hidden_dim, device=device))  # Linear layer
             layers.append(nn.SiLU())  # ReLU activation function
             # layers.append(nn.Dropout(p=dropout_prob))  # Dropout layer
             current_dim = hidden_dim
 
         # Add the final output layer
-        layers.append(nn.Linear(current_dim, output_dim, device='cuda'))
+        layers.append(nn.Linear(current_dim, output_dim, device=device))
 
         # Use nn.Sequential to combine the layers into a single module
         self.encoder = nn.Sequential(*layers)
@@ -103,7 +104,8 @@ class LatentSignalEncoder(torch.nn.Module):
 
 
 class LatentSignal2DEncoder(torch.nn.Module):
-    def __init__(self, input_dim=512, hidden_dims=[1024, 512, 256, 128, 64], output_dim=32, dropout_prob=0.3):
+    def __init__(self, input_dim=512, hidden_dims=[1024, 512, 256, 128, 64], output_dim=32, dropout_prob=0.3,
+                 device=None):
         super(LatentSignal2DEncoder, self).__init__()
 
         # Create a list of layers
@@ -112,13 +114,13 @@ class LatentSignal2DEncoder(torch.nn.Module):
 
         # Add hidden layers
         for hidden_dim in hidden_dims:
-            layers.append(nn.Linear(current_dim, hidden_dim, device='cuda'))  # Linear layer
+            layers.append(nn.Linear(current_dim, hidden_dim, device=device))  # Linear layer
             layers.append(nn.SiLU())  # ReLU activation function
             # layers.append(nn.Dropout(p=dropout_prob))  # Dropout layer
             current_dim = hidden_dim
 
         # Add the final output layer
-        layers.append(nn.Linear(current_dim, output_dim, device='cuda'))
+        layers.append(nn.Linear(current_dim, output_dim, device=device))
 
         # Use nn.Sequential to combine the layers into a single module
         self.encoder = nn.Sequential(*layers)
@@ -655,6 +657,101 @@ class FFTConv1DLinearModel2(nn.Module):
         return output
 
 
+class LowRankLinear(nn.Module):
+    """`nn.Linear` factorized through a `rank` wide bottleneck, (in + out) * rank instead of in * out weights."""
+
+    def __init__(self, in_features, out_features, rank=128):
+        super(LowRankLinear, self).__init__()
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features)
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+
+def fft_channels(x):
+    # (..., channels, signal_data) -> (..., 2 * channels, signal_data) real and imaginary parts of the FFT
+    x_fft = torch.fft.fft(x, dim=-1)
+    return torch.cat([x_fft.real, x_fft.imag], dim=-2)
+
+
+class StridedSignalEncoder3(nn.Module):
+    """
+    Compact drop-in for `CompactSignalEncoder3` / `CompactSignalEncoder3_2`, and for `FFTConv1DLinearModel2` with
+    `fft=True`: (batch_size, frames, frame_step, signal_data) -> (batch_size, frames, output_dim, h, w).
+    Strided convolutions and adaptive pooling shrink the signal axis to `pooled_len` before the first Linear and the
+    output projection is low rank, instead of flattening the full length conv output into a dense Linear.
+    """
+
+    def __init__(self, signal_data_dim=512, target_h=1, target_w=1, fps=25, frame_step=2, output_dim=4,
+                 hidden_dim=1024, pooled_len=16, rank=128, fft=False):
+        super(StridedSignalEncoder3, self).__init__()
+        self.fft = fft
+        in_channels = frame_step * 2 if fft else frame_step
+        # 512 -> 128 -> 32 -> pooled_len
+        self.conv1 = nn.Conv1d(in_channels=in_channels, out_channels=64, kernel_size=7, stride=4, padding=3)
+        self.conv2 = nn.Conv1d(in_channels=64, out_channels=128, kernel_size=5, stride=4, padding=2)
+        self.pool = nn.AdaptiveAvgPool1d(pooled_len)
+        self.fc = nn.Linear(128 * pooled_len, hidden_dim)
+        self.fc2 = LowRankLinear(hidden_dim, target_h * target_w * output_dim, rank=rank)
+        self.silu = nn.SiLU()
+
+        self.target_h = target_h
+        self.target_w = target_w
+        self.output_dim = output_dim
+
+    def forward(self, x):
+        batch_size, frames, channels, signal_data = x.shape
+        x = x.reshape(batch_size * frames, channels, signal_data)
+        if self.fft:
+            x = fft_channels(x)
+
+        x = self.silu(self.conv1(x))
+        x = self.silu(self.conv2(x))
+        x = self.pool(x).flatten(1)
+
+        x = self.silu(self.fc(x))
+        x = self.fc2(x)
+
+        return x.view(batch_size, frames, self.output_dim, self.target_h, self.target_w)
+
+
+class CompactFFTConv1DLinearModel(nn.Module):
+    """
+    Compact drop-in for `FFTConv1DLinearModel`:
+    (batch_size, n_input_frames, frame_step, signal_data) -> (batch_size, 1, out_channel, h, w).
+    Every frame's spectrum is reduced to `64 * pooled_len` features with strided convolutions and pooling, so the
+    first Linear grows with `n_input_frames * 64 * pooled_len` instead of `n_input_frames * 64 * signal_data`.
+    """
+
+    def __init__(self, input_size=512, target_h=1, target_w=1, channel=3, frame_step=3, n_input_frames=5, output_dim=4,
+                 out_channel=4, hidden_dim=1024, pooled_len=8, rank=128):
+        super(CompactFFTConv1DLinearModel, self).__init__()
+        self.conv1d = nn.Conv1d(in_channels=frame_step * 2, out_channels=32, kernel_size=7, stride=4, padding=3)
+        self.conv1d2 = nn.Conv1d(in_channels=32, out_channels=64, kernel_size=5, stride=4, padding=2)
+        self.pool = nn.AdaptiveAvgPool1d(pooled_len)
+        self.linear = nn.Linear(n_input_frames * 64 * pooled_len, hidden_dim)
+        self.linear2 = LowRankLinear(hidden_dim, out_channel * target_h * target_w, rank=rank)
+        self.silu = nn.SiLU()
+
+        self.target_h = target_h
+        self.target_w = target_w
+        self.out_channel = out_channel
+
+    def forward(self, x):
+        batch_size, frames, channels, signal_data = x.shape
+        x = fft_channels(x.reshape(batch_size * frames, channels, signal_data))
+
+        x = self.silu(self.conv1d(x))
+        x = self.silu(self.conv1d2(x))
+        x = self.pool(x).view(batch_size, -1)
+
+        x = self.silu(self.linear(x))
+        x = self.silu(self.linear2(x))
+
+        return x.view(batch_size, 1, self.out_channel, self.target_h, self.target_w)
+
+
 class ImageReduction(nn.Module):
     def __init__(self, input_dim=4):
         super(ImageReduction, self).__init__()
@@ -37,6 +37,8 @@ class LatentToVideoPipeline(TextToVideoSDPipeline):
             mask=None,
             timesteps=None,
             motion=None,
+            callback_on_step_end=None,
+            callback_on_step_end_tensor_inputs=["latents"],
     ):
         r"""
         Function invoked when calling the pipeline for generation.
@@ -163,13 +165,16 @@ class LatentToVideoPipeline(TextToVideoSDPipeline):
         uncondition_latent = condition_latent
         condition_latent = torch.cat(
             [uncondition_latent, condition_latent]) if do_classifier_free_guidance else condition_latent
+        if motion is not None:
+            motion = torch.tensor(motion, device=device)
+            if do_classifier_free_guidance and len(motion) > 1:
+                # one strength per video of a batch, repeated for the unconditional half
+                motion = torch.cat([motion] * 2)
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 # expand the latents if we are doing classifier free guidance
                 latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-                if motion is not None:
-                    motion = torch.tensor(motion, device=device)
 
                 noise_pred = self.unet(
                     latent_model_input,
@@ -191,10 +196,22 @@ class LatentToVideoPipeline(TextToVideoSDPipeline):
                 noise_pred = noise_pred.permute(0, 2, 1, 3, 4).reshape(bsz * frames, channel, width, height)
 
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+                step_output = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs)
+                latents = step_output.prev_sample
 
                 # reshape latents back
                 latents = latents[None, :].reshape(bsz, frames, channel, width, height).permute(0, 2, 1, 3, 4)
+                # x0 estimate of the step, for previews
+                denoised = getattr(step_output, "pred_original_sample", None)
+                if denoised is not None:
+                    denoised = denoised.reshape(bsz, frames, channel, width, height).permute(0, 2, 1, 3, 4)
+                if callback_on_step_end is not None:
+                    callback_kwargs = {}
+                    for k in callback_on_step_end_tensor_inputs:
+                        callback_kwargs[k] = locals()[k]
+                    callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
+
+                    latents = callback_outputs.pop("latents", latents)
 
                 # call the callback, if provided
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
@@ -500,6 +517,7 @@ class TextStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
             mask=None,
             condition_type="image",
             condition_latent=None,
+            image_embeddings=None,
     ):
         r"""
         The call function to the pipeline for generation.
@@ -602,7 +620,12 @@ class TextStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
 
         # 3. Encode input image
         if condition_type == "image":
-            image_embeddings = self._encode_image(image, device, num_videos_per_prompt, do_classifier_free_guidance)
+            if image_embeddings is None:
+                image_embeddings = self._encode_image(image, device, num_videos_per_prompt,
+                                                      do_classifier_free_guidance)
+            elif do_classifier_free_guidance:
+                # precomputed `_encode_image` output without guidance, the unconditional embedding is zeros
+                image_embeddings = torch.cat([torch.zeros_like(image_embeddings), image_embeddings])
         elif condition_type == "text":
             if do_classifier_free_guidance:
                 prompt_embeds = torch.cat([negative_prompt_embeds, prompt_embeds])
@@ -710,7 +733,10 @@ class TextStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
                     noise_pred_uncond, noise_pred_cond = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_cond - noise_pred_uncond)
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents).prev_sample
+                step_output = self.scheduler.step(noise_pred, t, latents)
+                latents = step_output.prev_sample
+                # x0 estimate of the step, for previews
+                denoised = step_output.pred_original_sample
                 if callback_on_step_end is not None:
                     callback_kwargs = {}
                     for k in callback_on_step_end_tensor_inputs:
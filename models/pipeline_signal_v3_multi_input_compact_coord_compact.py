@@ -1,4 +1,5 @@
 from typing import Callable, Dict, List, Optional, Union
+import numpy as np
 import torch
 from einops import rearrange, repeat
 import PIL
@@ -13,6 +14,9 @@ from diffusers.utils.torch_utils import randn_tensor
 from diffusers.image_processor import VaeImageProcessor
 
 from models.layerdiffuse_VAE import LatentSignalEncoder
+from models.tiled_vae import tiled_decode_latents
+from utils.video_sink import frames_to_uint8
+from utils.condition_cache import cached_encode
 import torch.nn.functional as F
 from diffusers.models import AutoencoderKLTemporalDecoder
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
@@ -113,14 +117,19 @@ def load_channel(channels, frame_step, frame_range_indices):
     return partial_channels
 
 
-def load_channel2(channels, frame_step, frame_range_indices):
+def load_channel2(channels, frame_step, frame_range_indices, num_rows=75):
     partial_channels = channels[frame_range_indices[0]:frame_range_indices[-1] + frame_step, :]
 
-    partial_channels = F.pad(partial_channels, (0, 0, 0, 75 - partial_channels.size(0)))
+    partial_channels = F.pad(partial_channels, (0, 0, 0, num_rows - partial_channels.size(0)))
 
     return partial_channels
 
 
+def signal_frame_step(fps, native_fps=20):
+    # signal rows per generated frame, the signal is captured at `native_fps`
+    return max(1, round(native_fps / fps))
+
+
 class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
     model_cpu_offload_seq = "image_encoder->unet->vae"
     _callback_tensor_inputs = ["latents"]
@@ -173,6 +182,21 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
 
         return add_time_ids
 
+    def decode_latents(self, latents, num_frames, decode_chunk_size=14, tile_size=None, tile_overlap=8,
+                       max_memory=None):
+        if tile_size is None and max_memory is None:
+            return super().decode_latents(latents, num_frames, decode_chunk_size)
+        return tiled_decode_latents(self.vae, latents, num_frames, decode_chunk_size, tile_size=tile_size,
+                                    tile_overlap=tile_overlap, max_memory=max_memory)
+
+    def iter_decode_latents(self, latents, decode_chunk_size, tile_size=None, tile_overlap=8, max_memory=None):
+        # yields (video index, [channels, frames, height, width]) chunks of at most decode_chunk_size frames
+        for video_index, video_latents in enumerate(latents):
+            for i in range(0, video_latents.shape[0], decode_chunk_size):
+                chunk = video_latents[None, i: i + decode_chunk_size]
+                yield video_index, self.decode_latents(chunk, chunk.shape[1], chunk.shape[1], tile_size=tile_size,
+                                                       tile_overlap=tile_overlap, max_memory=max_memory)[0]
+
     def check_inputs(self, image, height, width):
         if (
                 not isinstance(image, torch.Tensor)
@@ -250,6 +274,9 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
             motion_bucket_id: int = 127,
             noise_aug_strength: int = 0.02,
             decode_chunk_size: Optional[int] = None,
+            decode_tile_size: Optional[int] = None,
+            decode_tile_overlap: int = 8,
+            decode_max_memory: Optional[int] = None,
             num_videos_per_prompt: Optional[int] = 1,
             generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
             latents: Optional[torch.FloatTensor] = None,
@@ -257,9 +284,12 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
             callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
             callback_on_step_end_tensor_inputs: List[str] = ["latents"],
             return_dict: bool = True,
+            frame_sink=None,
+            condition_cache=None,
             n_input_frames=5,
             signal_latent=None,
             signal=None,
+            signal_start=0,
             camera_pose=None,
             tx_pos=None,
             sig1=None,
@@ -300,11 +330,20 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
                 The number of frames to decode at a time. The higher the chunk size, the higher the temporal consistency
                 between frames, but also the higher the memory consumption. By default, the decoder will decode all frames at once
                 for maximal quality. Reduce `decode_chunk_size` to reduce memory usage.
+            decode_tile_size (`int`, *optional*):
+                Tile edge in latent pixels for spatially tiled decoding. Tiles overlap by `decode_tile_overlap` latent
+                pixels and are blended with a linear feather. By default frames are decoded at full resolution.
+            decode_tile_overlap (`int`, *optional*, defaults to 8):
+                The overlap between neighbouring decode tiles in latent pixels.
+            decode_max_memory (`int`, *optional*):
+                Decoder activation budget in bytes. When set, the tile size is halved until a chunk of
+                `decode_chunk_size` frames fits in the budget.
             num_videos_per_prompt (`int`, *optional*, defaults to 1):
-                The number of images to generate per prompt.
+                The number of videos to generate for the same conditioning. The videos are denoised as one batch, the
+                image, signal and pose latents are encoded once and broadcast over the batch.
             generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
                 A [`torch.Generator`](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make
-                generation deterministic.
+                generation deterministic. Pass one generator per video to get one seed per video.
             latents (`torch.FloatTensor`, *optional*):
                 Pre-generated noisy latents sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
@@ -323,6 +362,16 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`~pipelines.stable_diffusion.StableDiffusionPipelineOutput`] instead of a
                 plain tuple.
+            frame_sink (`utils.video_sink.FrameSink`, *optional*):
+                Receives the decoded uint8 frames chunk by chunk instead of materializing the whole video, so host
+                memory stays bounded by `decode_chunk_size`. `frames` is then whatever the sink's `close()` returns.
+                Pass a list with one sink per video when `num_videos_per_prompt > 1`.
+            condition_cache (`utils.condition_cache.ConditionCache`, *optional*):
+                Caches the image reduction, signal and pose latents by encoder name and input content, so repeated
+                generations of the same example (e.g. seed sweeps) skip the conditioning encoders. The content is
+                hashed on the host, so `signal`, `camera_pose` and `tx_pos` have to be passed as cpu tensors.
+            signal_start (`int`, *optional*, defaults to 0):
+                The first generated frame of the signal window, in frames (not signal rows). Used by `generate_long`.
 
         Returns:
             [`~pipelines.stable_diffusion.StableVideoDiffusionPipelineOutput`] or `tuple`:
@@ -394,7 +443,7 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
         if needs_upcasting:
             self.vae.to(dtype=torch.float32)
         # print("image2", image.size())  # image2 torch.Size([5, 3, 64, 64])
-        image_latents = self._encode_vae_image(image, device, num_videos_per_prompt, False)
+        image_latents = self._encode_vae_image(image, device, 1, False)
         image_latents = image_latents.to(dtype)
         image_latents = rearrange(image_latents, '(b f) c h w-> b f c h w', b=batch_size).to(dtype)
         negative_image_latents = torch.zeros_like(image_latents)
@@ -403,11 +452,16 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
 
         image = video[1:n_input_frames]
         image = self.image_processor.preprocess(image, height=height, width=width)
-        # print("image2", image.size())  # image2 torch.Size([5, 3, 64, 64])
-        image_latents = self._encode_vae_image(image, device, num_videos_per_prompt, False)
-        image_latents = image_latents.to(dtype)
-        image_latents = rearrange(image_latents, '(b f) c h w-> b f c h w', b=batch_size).to(dtype)
-        image_latents = image_pool(image_latents)
+
+        def encode_input_frames():
+            # print("image2", image.size())  # image2 torch.Size([5, 3, 64, 64])
+            image_latents = self._encode_vae_image(image, device, 1, False)
+            image_latents = image_latents.to(dtype)
+            image_latents = rearrange(image_latents, '(b f) c h w-> b f c h w', b=batch_size).to(dtype)
+            return image_pool(image_latents)
+
+        # the preprocessed frames are still on the host, where hashing them doesn't copy anything back
+        image_latents = cached_encode(condition_cache, ("img1", dtype), (image,), encode_input_frames)
         images_latent = image_latents.repeat(1, num_frames, 1, 1, 1)
         # mask = repeat(mask, '1 h w -> 2 f 1 h w', f=num_frames)
         # 5. Get Added Time IDs
@@ -448,23 +502,21 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
 
         self._guidance_scale = guidance_scale
         # signal
-        signal_values = signal.float().half()  # [FPS, 512]
+        signal_values = signal.to(device=device, dtype=dtype)  # [FPS, 512]
 
         target_fps = 25
 
         max_frame = signal_values.size(0)
 
-        native_fps = 20
-        sample_fps = fps + 1
-        frame_step = max(1, round(native_fps / sample_fps))
+        frame_step = signal_frame_step(fps + 1)
         frame_range = range(0, max_frame, frame_step)
 
-        start = 0
+        start = signal_start
         frame_range_indices = list(frame_range)[start:start + num_frames]
         # shift  for initial signal,
         # frame_range_indices = [x + 1 for x in frame_range_indices]
         # print(signal_values.unsqueeze(0).size())
-        signal_values = load_channel2(signal_values, frame_step, frame_range_indices)
+        signal_values = load_channel2(signal_values, frame_step, frame_range_indices, num_frames * frame_step)
         signal_values = signal_values.unsqueeze(0)
 
         # bsz = signal_values.size(0)
@@ -474,11 +526,17 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
         signal_values_reshaped = rearrange(signal_values, 'b (f c) h-> b f c h', c=frame_step)  # [B, FPS, 32]
         signal_values_reshaped_input = signal_values_reshaped[:, :n_input_frames]
 
-        signal_embeddings = signal_encoder(signal_values_reshaped_input)
-        # print("signal_encoder", signal_values_reshaped.size())
+        def encode_signal():
+            # print("signal_encoder", signal_values_reshaped.size())
+            return signal_encoder(signal_values_reshaped_input), signal_encoder2(signal_values_reshaped), \
+                   signal_encoder3(signal_values_reshaped_input)
+
+        # keyed by the host signal and the window taken from it
+        signal_embeddings, signal_embeddings2, signal_initial_latent = cached_encode(
+            condition_cache, ("signal", dtype, n_input_frames, num_frames, frame_step, start), (signal,),
+            encode_signal)
 
         signal_embeddings = signal_embeddings.reshape(batch_size, 1, -1)
-        signal_embeddings2 = signal_encoder2(signal_values_reshaped)
 
         # encoder_hidden_states = torch.cat((image_embeddings, signal_embeddings), dim=2)
         encoder_hidden_states = signal_embeddings.to(dtype)
@@ -486,11 +544,12 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
         signal_latent = signal_embeddings2.to(dtype)
 
         # Fourier
-        camera_pose = camera_pose.unsqueeze(0)
-        tx_pos = tx_pos.unsqueeze(0)
+        pose_inputs = (camera_pose, tx_pos)
+        camera_pose = camera_pose.unsqueeze(0).to(device=device, dtype=dtype)
+        tx_pos = tx_pos.unsqueeze(0).to(device=device, dtype=dtype)
 
-        camera_latent = camera_fourier(camera_pose)
-        tx_latent = tx_fourier(tx_pos)
+        camera_latent, tx_latent = cached_encode(condition_cache, ("pose", dtype), pose_inputs,
+                                                 lambda: (camera_fourier(camera_pose), tx_fourier(tx_pos)))
         merged = torch.cat((camera_latent, tx_latent), dim=-1)
         pos_latent = torch.cat((merged, merged), dim=-2)
         pos_latent = pos_latent.repeat(1, num_frames, 1, 1, 1)  # condition_latent torch.Size([1, 50, 20, 8, 8])
@@ -498,7 +557,6 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
         # pos_latent = torch.cat((camera_latent, tx_latent), dim=3)
 
         # here for intiial signal embedding
-        signal_initial_latent = signal_encoder3(signal_values_reshaped_input)
         signal_initial_latent = signal_initial_latent.repeat(1, num_frames, 1, 1,
                                                              1).to(dtype)
         signal_latent = torch.cat([signal_latent] * 2) if do_classifier_free_guidance else signal_latent
@@ -514,7 +572,12 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
         encoder_hidden_states = torch.cat(
             [encoder_hidden_states] * 2) if do_classifier_free_guidance else encoder_hidden_states
 
-        encoder_hidden_states = encoder_hidden_states.repeat_interleave(repeats=num_frames, dim=0)
+        encoder_hidden_states = encoder_hidden_states.repeat_interleave(repeats=num_videos_per_prompt * num_frames,
+                                                                        dim=0)
+
+        # conditioning is shared by all videos of the prompt: [cfg, f, c, h, w] -> [cfg, videos, f, c, h, w] views
+        conditions = [_expand_videos(c, num_videos_per_prompt) for c in [pos_latent, signal_initial_latent, signal_latent, images_latent]]
+        condition_latent = _expand_videos(condition_latent, num_videos_per_prompt)
 
         # 8. Denoising loop
         num_warmup_steps = len(timesteps) - num_inference_steps * self.scheduler.order
@@ -526,7 +589,9 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
                 latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
                 # print(signal_initial_latent.size(), signal_latent.size(), latent_model_input.size(), condition_latent.size())
                 # torch.Size([2, 25, 5, 64, 64]) torch.Size([2, 25, 4, 64, 64]) torch.Size([2, 25, 2, 64, 64]) torch.Size([2, 25, 4, 64, 64])
-                latent_model_input = torch.cat([pos_latent, signal_initial_latent, signal_latent, images_latent, latent_model_input, condition_latent], dim=2).to(dtype)
+                latent_model_input = latent_model_input.unflatten(0, (-1, num_videos_per_prompt))
+                latent_model_input = torch.cat(conditions + [latent_model_input, condition_latent], dim=3)
+                latent_model_input = latent_model_input.flatten(0, 1).to(dtype)
 
                 # predict the noise residual
                 noise_pred = self.unet(
@@ -556,12 +621,26 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
                 if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
                     progress_bar.update()
 
+        # cast back to fp16 if needed
+        if needs_upcasting:
+            self.vae.to(dtype=torch.float16)
+
         if not output_type == "latent":
-            # cast back to fp16 if needed
-            if needs_upcasting:
-                self.vae.to(dtype=torch.float16)
-            frames = self.decode_latents(latents, num_frames, decode_chunk_size)
-            frames = svd_tensor2vid(frames, self.image_processor, output_type=output_type)
+            if frame_sink is not None:
+                frame_sinks = frame_sink if isinstance(frame_sink, (list, tuple)) else [frame_sink] * len(latents)
+                for video_index, chunk in self.iter_decode_latents(latents, decode_chunk_size,
+                                                                   tile_size=decode_tile_size,
+                                                                   tile_overlap=decode_tile_overlap,
+                                                                   max_memory=decode_max_memory):
+                    frame_sinks[video_index].write(frames_to_uint8(chunk))
+                if isinstance(frame_sink, (list, tuple)):
+                    frames = [sink.close() for sink in frame_sink]
+                else:
+                    frames = frame_sink.close()
+            else:
+                frames = self.decode_latents(latents, num_frames, decode_chunk_size, tile_size=decode_tile_size,
+                                             tile_overlap=decode_tile_overlap, max_memory=decode_max_memory)
+                frames = svd_tensor2vid(frames, self.image_processor, output_type=output_type)
         else:
             frames = latents
 
@@ -572,6 +651,106 @@ class MaskStableVideoDiffusionPipeline(StableVideoDiffusionPipeline):
 
         return StableVideoDiffusionPipelineOutput(frames=frames)
 
+    @torch.no_grad()
+    def generate_long(
+            self,
+            video,
+            signal=None,
+            num_frames: Optional[int] = None,
+            window_overlap: Optional[int] = None,
+            n_input_frames=5,
+            fps: int = 7,
+            decode_chunk_size: Optional[int] = None,
+            decode_tile_size: Optional[int] = None,
+            decode_tile_overlap: int = 8,
+            decode_max_memory: Optional[int] = None,
+            frame_sink=None,
+            return_dict: bool = True,
+            **kwargs,
+    ):
+        r"""
+        Generate a video over the whole `signal` with overlapping windows of `num_frames` frames.
+
+        Every window after the first one starts `window_overlap` frames before the end of the previous window and is
+        conditioned, through the `n_input_frames` / `img1` path, on the previous window's frames at that position.
+        The overlapping latents of the two windows are blended linearly before they are decoded. Only the overlap
+        latents are carried from one window to the next and finished frames are decoded chunk by chunk into
+        `frame_sink`, so memory stays constant in the length of the signal.
+
+        Args:
+            video (`List[PIL.Image.Image]`):
+                The conditioning frames of the first window.
+            window_overlap (`int`, *optional*):
+                Number of frames shared by neighbouring windows, at least `n_input_frames`. Defaults to
+                `n_input_frames`.
+            frame_sink (`utils.video_sink.FrameSink`, *optional*):
+                Receives the uint8 frames of the whole video. Without a sink the frames are concatenated in host
+                memory and returned as a `[frames, height, width, channels]` array.
+            kwargs:
+                Passed to `__call__` for every window (`signal_start`, `output_type`, `latents` and
+                `num_videos_per_prompt` are managed here).
+
+        Returns:
+            [`~pipelines.stable_diffusion.StableVideoDiffusionPipelineOutput`] or `tuple`, with `frames` being what
+            `frame_sink.close()` returns or the concatenated uint8 frames.
+        """
+        num_frames = num_frames if num_frames is not None else self.unet.config.num_frames
+        decode_chunk_size = decode_chunk_size if decode_chunk_size is not None else num_frames
+        window_overlap = window_overlap if window_overlap is not None else n_input_frames
+        if not n_input_frames <= window_overlap < num_frames:
+            raise ValueError(f"`window_overlap` has to be in [{n_input_frames}, {num_frames}) but is {window_overlap}.")
+        if kwargs.pop("num_videos_per_prompt", 1) != 1:
+            raise ValueError("`generate_long` generates a single video, call it once per seed.")
+        for key in ["signal_start", "output_type", "latents"]:
+            kwargs.pop(key, None)
+
+        stride = num_frames - window_overlap
+        total_frames = len(range(0, signal.size(0), signal_frame_step(fps)))
+        decode_kwargs = dict(tile_size=decode_tile_size, tile_overlap=decode_tile_overlap,
+                             max_memory=decode_max_memory)
+
+        frames = []
+        write = frame_sink.write if frame_sink is not None else frames.append
+
+        def emit(latents):
+            for _, chunk in self.iter_decode_latents(latents, decode_chunk_size, **decode_kwargs):
+                write(frames_to_uint8(chunk))
+
+        # weight of the new window over the overlap, strictly inside (0, 1) like the decode tile feather
+        blend = torch.linspace(0, 1, window_overlap + 2)[1:-1].view(1, -1, 1, 1, 1)
+        previous = None
+        start = 0
+        while True:
+            latents = self(video, num_frames=num_frames, n_input_frames=n_input_frames, fps=fps, signal=signal,
+                           signal_start=start, decode_chunk_size=decode_chunk_size, output_type="latent",
+                           **kwargs).frames
+            if previous is not None:
+                weight = blend.to(latents.device, latents.dtype)
+                latents[:, :window_overlap] = previous * (1 - weight) + latents[:, :window_overlap] * weight
+            if start + num_frames >= total_frames:
+                emit(latents[:, :total_frames - start])
+                break
+            emit(latents[:, :stride])
+            previous = latents[:, stride:]
+
+            # the next window starts at the overlap and is conditioned on its first frames
+            conditioning = self.decode_latents(previous[:, :n_input_frames], n_input_frames, n_input_frames,
+                                               **decode_kwargs)[0]
+            video = [PIL.Image.fromarray(frame) for frame in frames_to_uint8(conditioning)]
+            start += stride
+
+        self.maybe_free_model_hooks()
+
+        if frame_sink is not None:
+            frames = frame_sink.close()
+        else:
+            frames = np.concatenate(frames)
+
+        if not return_dict:
+            return frames
+
+        return StableVideoDiffusionPipelineOutput(frames=frames)
+
 
 class LatentToVideoPipeline(TextToVideoSDPipeline):
     @torch.no_grad()
@@ -836,6 +1015,11 @@ class LatentToVideoPipeline(TextToVideoSDPipeline):
         return TextToVideoSDPipelineOutput(frames=video)
 
 
+def _expand_videos(x, num_videos_per_prompt):
+    """Broadcasts [b, ...] to [b, num_videos_per_prompt, ...] without copying."""
+    return x.unsqueeze(1).expand(-1, num_videos_per_prompt, *([-1] * (x.ndim - 1)))
+
+
 def _append_dims(x, target_dims):
     """Appends dimensions to the end of a tensor until it has target_dims dimensions."""
     dims_to_append = target_dims - x.ndim
@@ -7,6 +7,23 @@ from diffusers.pipelines.text_to_video_synthesis.pipeline_text_to_video_synth im
 from diffusers.loaders import LoraLoaderMixin, TextualInversionLoaderMixin
 import torchvision.transforms as T
 
+from models.tiled_vae import estimate_decode_memory
+
+
+def estimate_rgba_decode_memory(vae_alpha_decoder, height, width, element_size=4):
+    """
+    Approximate peak activation bytes of decoding one frame of `height` x `width` pixels with the VAE decoder
+    followed by `vae_alpha_decoder` (`UNet384`).
+    """
+    vae_memory = estimate_decode_memory(height * width, 1, element_size)
+    config = vae_alpha_decoder.config
+    # full resolution feature maps of the first block, plus the attention map of the lowest resolution block,
+    # which grows quadratically with the number of pixels
+    tokens = height * width // 4 ** (len(config.block_out_channels) - 1)
+    heads = config.block_out_channels[-1] // config.attention_head_dim
+    alpha_memory = element_size * (height * width * config.block_out_channels[0] * 6 + heads * tokens ** 2)
+    return vae_memory + alpha_memory
+
 
 class ImageToVideoPipeline(TextToVideoSDPipeline):
     def _encode_prompt(
@@ -196,7 +213,13 @@ class MaskedLatentToVideoPipeline(TextToVideoSDPipeline):
         mask=None,
         motion=None,
         image_embeds=None,
+        decode_chunk_size=None,
+        decode_max_memory=None,
     ):
+        """
+        `decode_chunk_size` frames are VAE decoded, alpha decoded and converted to uint8 at a time. When it is not
+        given it is derived from the `decode_max_memory` byte budget, or all frames are decoded at once.
+        """
         # 0. Default height and width to unet
         height = height or self.unet.config.sample_size * self.vae_scale_factor
         width = width or self.unet.config.sample_size * self.vae_scale_factor
@@ -287,22 +310,61 @@ class MaskedLatentToVideoPipeline(TextToVideoSDPipeline):
                         callback(i, t, latents)
 
         # latents = clean_latents
+        b, _, f, latent_h, latent_w = latents.shape
+        assert b == 1
+
+        if decode_chunk_size is None:
+            decode_chunk_size = f
+            if decode_max_memory is not None:
+                frame_memory = estimate_rgba_decode_memory(
+                    vae_alpha_decoder, latent_h * self.vae_scale_factor, latent_w * self.vae_scale_factor,
+                    element_size=torch.finfo(dtype).bits // 8)
+                decode_chunk_size = max(1, decode_max_memory // frame_memory)
+
+        # decode, alpha decode and convert chunk by chunk so that only `decode_chunk_size` frames are on the device
+        video, pngs = [], []
+        for i in range(0, f, decode_chunk_size):
+            video_tensor, chunk_pngs = self.decode_rgba(latents[:, :, i: i + decode_chunk_size], vae_alpha_decoder,
+                                                        dtype)
+            pngs.append(chunk_pngs)
+            if output_type == "pt":
+                video.append(video_tensor)
+            else:
+                video.extend(tensor2vid(video_tensor)) # [f, h, w, c] # video_tensor required -1&1
+            del video_tensor
+        if output_type == "pt":
+            video = torch.cat(video, dim=2)
+        pngs = np.concatenate(pngs)
+        pngs_rgb = pngs[:, :, :, :3]
+        alpha_jpg = pngs[:, :, :, 3]
+
+        # Offload last model to CPU
+        if hasattr(self, "final_offload_hook") and self.final_offload_hook is not None:
+            self.final_offload_hook.offload()
+        # pngs_denoised = pngs_denoised[:, :, :, -1]
+        if not return_dict:
+            return (video, latents, pngs, alpha_jpg, pngs_rgb)
+            # return (video, latents, rgba_video)
+
+        return TextToVideoSDPipelineOutput(frames=video)
+
+    def decode_rgba(self, latents, vae_alpha_decoder, dtype):
+        """
+        :param latents: [1, c, f, h, w] latents.
+        :return: the premultiplied [1, c, f, h, w] float32 video in [-1, 1] and the [f, h, w, 4] uint8 rgba frames.
+        """
         video_tensor = self.decode_latents(latents) # [1, c, f, h, w] float32
-        # b, c, f, h, w = video_tensor.shape
-        # video_tensor = self.decode_latents(latents[:, :4]) # [b, c , f, h, w]
-        # alpha_video_tensor = self.decode_latents(latents[:, 4:]) # [b, c , f, h, w]
         b, c, f, h, w = video_tensor.shape
 
-
         x = video_tensor.permute(0, 2, 1, 3, 4).reshape(b*f, c, h, w).to(dtype)
-        latent = latents.permute(0, 2, 1, 3, 4).reshape(b*f, 4, height, width)
+        latent = latents.permute(0, 2, 1, 3, 4).reshape(b*f, 4, *latents.shape[-2:])
 
         decoded_rgba = vae_alpha_decoder(x, latent)
 
         decoded_rgba = decoded_rgba.reshape(b, f, 4, h, w).permute(0, 2, 1, 3, 4)
 
         alpha = decoded_rgba[:, 3:]
-        fg = decoded_rgba[:, :3] 
+        fg = decoded_rgba[:, :3]
 
         alpha = alpha * 255.0
 
@@ -311,30 +373,11 @@ class MaskedLatentToVideoPipeline(TextToVideoSDPipeline):
 
         fg = (fg+1.0) * 127.5
 
-        
-        pngs = torch.cat((fg, alpha), dim=1)[0].permute(1, 0, 2, 3).permute(0, 2, 3, 1) # [f, h, w, c]
-        pngs = pngs.detach().cpu().float().numpy().clip(0, 255).astype(np.uint8)
-        pngs_rgb = pngs[:, :, :, :3]
-        alpha_jpg = pngs[:, :, :, 3]
-
+        # convert on the device, only uint8 frames are copied to the host
+        pngs = torch.cat((fg, alpha), dim=1)[0].permute(1, 2, 3, 0) # [f, h, w, c]
+        pngs = pngs.float().clamp(0, 255).to(torch.uint8).cpu().numpy()
+        return video_tensor, pngs
 
-        assert b == 1
-
-        if output_type == "pt":
-            video = video_tensor
-        else:
-            video = tensor2vid(video_tensor) # [f, h, w, c] # video_tensor required -1&1
-            # alpha_video = tensor2vid(alpha_video_tensor)
-
-        # Offload last model to CPU
-        if hasattr(self, "final_offload_hook") and self.final_offload_hook is not None:
-            self.final_offload_hook.offload()
-        # pngs_denoised = pngs_denoised[:, :, :, -1]
-        if not return_dict:
-            return (video, latents, pngs, alpha_jpg, pngs_rgb)
-            # return (video, latents, rgba_video)
-
-        return TextToVideoSDPipelineOutput(frames=video)
 
 class ConcatLatentToVideoPipeline(TextToVideoSDPipeline):
     @torch.no_grad()
@@ -0,0 +1,121 @@
+import inspect
+import math
+
+import torch
+
+# Rough peak activation footprint of the SVD temporal decoder, in elements per output pixel per frame.
+# The last up block runs 128 channels at full resolution and keeps a handful of tensors alive at once.
+DECODER_ELEMENTS_PER_PIXEL = 128 * 6
+MIN_TILE_SIZE = 16
+
+
+def _tile_starts(size, tile_size, stride):
+    if size <= tile_size:
+        return [0]
+    starts = list(range(0, size - tile_size, stride))
+    starts.append(size - tile_size)
+    return starts
+
+
+def _ramp(length, overlap, first, last):
+    weight = torch.ones(length)
+    if overlap <= 0:
+        return weight
+    overlap = min(overlap, length)
+    # strictly positive so that every pixel keeps a non-zero total weight
+    ramp = torch.linspace(0, 1, overlap + 2)[1:-1]
+    if not first:
+        weight[:overlap] = torch.minimum(weight[:overlap], ramp)
+    if not last:
+        weight[-overlap:] = torch.minimum(weight[-overlap:], ramp.flip(0))
+    return weight
+
+
+def feather_mask(height, width, overlap, top, bottom, left, right):
+    """
+    Separable linear blending mask for one tile. Edges that touch the image border are not feathered.
+    :param overlap: the feathered width in pixels.
+    :param top, bottom, left, right: whether the tile touches the corresponding image border.
+    """
+    weight_y = _ramp(height, overlap, top, bottom)
+    weight_x = _ramp(width, overlap, left, right)
+    return weight_y[:, None] * weight_x[None, :]
+
+
+def estimate_decode_memory(num_pixels, chunk_size, element_size=4):
+    """Approximate peak decoder activation bytes for `chunk_size` frames of `num_pixels` output pixels."""
+    return int(math.ceil(chunk_size * num_pixels * DECODER_ELEMENTS_PER_PIXEL * element_size))
+
+
+def fit_tile_size(tile_size, chunk_size, max_memory, scale_factor=8, element_size=4):
+    """
+    Largest tile size (in latent pixels, halving from `tile_size`) whose decode fits in `max_memory` bytes.
+    """
+    if max_memory is None:
+        return tile_size
+    while tile_size > MIN_TILE_SIZE:
+        if estimate_decode_memory((tile_size * scale_factor) ** 2, chunk_size, element_size) <= max_memory:
+            break
+        tile_size //= 2
+    return max(tile_size, MIN_TILE_SIZE)
+
+
+@torch.no_grad()
+def tiled_decode_latents(vae, latents, num_frames, decode_chunk_size=14, tile_size=64, tile_overlap=8,
+                         max_memory=None):
+    """
+    Decode SVD latents with spatial tiling on top of the temporal chunking done by `decode_latents`.
+    Neighbouring tiles overlap by `tile_overlap` latent pixels and are blended with a linear feather,
+    so decode memory is bounded by the tile size instead of the output resolution.
+    :param latents: [batch, frames, channels, height, width] latents.
+    :param tile_size: tile edge in latent pixels. Shrunk until the decode fits in `max_memory` bytes if given.
+    :return: [batch, channels, frames, height, width] float32 frames in [-1, 1].
+    """
+    batch_size = latents.shape[0]
+    latents = latents.flatten(0, 1)
+    latents = 1 / vae.config.scaling_factor * latents
+
+    scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+    element_size = torch.finfo(vae.dtype).bits // 8
+    tile_size = fit_tile_size(tile_size or max(latents.shape[-2:]), decode_chunk_size, max_memory,
+                              scale_factor=scale_factor, element_size=element_size)
+    tile_overlap = min(tile_overlap, tile_size // 2)
+    stride = tile_size - tile_overlap
+
+    accepts_num_frames = "num_frames" in set(inspect.signature(vae.forward).parameters.keys())
+
+    _, _, latent_h, latent_w = latents.shape
+    out_h, out_w = latent_h * scale_factor, latent_w * scale_factor
+    ys = _tile_starts(latent_h, tile_size, stride)
+    xs = _tile_starts(latent_w, tile_size, stride)
+
+    frames = []
+    for i in range(0, latents.shape[0], decode_chunk_size):
+        chunk = latents[i: i + decode_chunk_size]
+        decode_kwargs = {}
+        if accepts_num_frames:
+            decode_kwargs["num_frames"] = chunk.shape[0]
+
+        output = None
+        weight = torch.zeros(1, 1, out_h, out_w, device=chunk.device, dtype=torch.float32)
+        for y in ys:
+            for x in xs:
+                tile = chunk[:, :, y: y + tile_size, x: x + tile_size]
+                decoded = vae.decode(tile, **decode_kwargs).sample.float()
+                if output is None:
+                    output = torch.zeros(chunk.shape[0], decoded.shape[1], out_h, out_w,
+                                         device=chunk.device, dtype=torch.float32)
+                th, tw = decoded.shape[-2:]
+                mask = feather_mask(th, tw, tile_overlap * scale_factor,
+                                    top=y == 0, bottom=y + tile_size >= latent_h,
+                                    left=x == 0, right=x + tile_size >= latent_w).to(chunk.device)
+                oy, ox = y * scale_factor, x * scale_factor
+                output[:, :, oy: oy + th, ox: ox + tw] += decoded * mask
+                weight[:, :, oy: oy + th, ox: ox + tw] += mask
+                del decoded
+        frames.append(output / weight)
+    frames = torch.cat(frames, dim=0)
+
+    # [batch*frames, channels, height, width] -> [batch, channels, frames, height, width]
+    frames = frames.reshape(batch_size, num_frames, *frames.shape[1:]).permute(0, 2, 1, 3, 4)
+    return frames
@@ -26,7 +26,7 @@ from PIL import Image
 
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import set_seed
+from accelerate.utils import set_seed, send_to_device
 
 from diffusers.models import AutoencoderKL
 from diffusers import DPMSolverMultistepScheduler, DDPMScheduler
@@ -40,7 +40,10 @@ from diffusers.schedulers.scheduling_ddim import rescale_zero_terminal_snr
 
 from transformers import CLIPTextModel, CLIPTokenizer
 from transformers.models.clip.modeling_clip import CLIPEncoder
-from utils.dataset import get_train_dataset, extend_datasets
+from utils.dataset import get_train_dataset, extend_datasets, bucket_index, normalize_pixel_values, \
+    collate_prompt_keys
+from utils.bucketing import BucketBatchSampler
+from utils.condition_cache import ConditionCache
 from einops import rearrange, repeat
 import imageio
 
@@ -383,6 +386,8 @@ def main(
         rescale_schedule: bool = False,
         offset_noise_strength: float = 0.1,
         extend_dataset: bool = False,
+        bucket_max_batch_size: Optional[int] = None,
+        prompt_cache_size: int = 1024,
         cache_latents: bool = False,
         cached_latent_dir=None,
         save_pretrained_model: bool = True,
@@ -497,20 +502,40 @@ def main(
     else:
         train_dataset = torch.utils.data.ConcatDataset(train_datasets)
 
-        # DataLoaders creation:
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset,
-        batch_size=train_batch_size,
-        shuffle=shuffle
-    )
+    # DataLoaders creation:
+    bucket_batches = train_data.get('use_bucketing', False)
+    if bucket_batches:
+        # batches only hold samples of one resolution bucket, a bucket gets as many samples as fit into the pixels
+        # of a full resolution batch. The sampler shards the batches itself, accelerate expects equal batch sizes.
+        train_sampler = BucketBatchSampler(
+            bucket_index(train_dataset),
+            pixel_budget=train_batch_size * train_data.width * train_data.height,
+            max_batch_size=bucket_max_batch_size,
+            shuffle=shuffle,
+            seed=seed if seed is not None else 0,
+            num_replicas=accelerator.num_processes,
+            rank=accelerator.process_index
+        )
+        train_dataloader = torch.utils.data.DataLoader(train_dataset, batch_sampler=train_sampler,
+                                                       collate_fn=collate_prompt_keys)
+    else:
+        train_dataloader = torch.utils.data.DataLoader(
+            train_dataset,
+            batch_size=train_batch_size,
+            shuffle=shuffle,
+            collate_fn=collate_prompt_keys
+        )
 
     # Prepare everything with our `accelerator`.
-    unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        unet,
-        optimizer,
-        train_dataloader,
-        lr_scheduler,
-    )
+    if bucket_batches:
+        unet, optimizer, lr_scheduler = accelerator.prepare(unet, optimizer, lr_scheduler)
+    else:
+        unet, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
+            unet,
+            optimizer,
+            train_dataloader,
+            lr_scheduler,
+        )
 
     # Use Gradient Checkpointing if enabled.
     unet_and_text_g_c(
@@ -542,8 +567,10 @@ def main(
 
     # Train!
     total_batch_size = train_batch_size * accelerator.num_processes * gradient_accumulation_steps
+    # the bucket sampler already counts the batches of one process
     num_train_epochs = math.ceil(
-        max_train_steps * gradient_accumulation_steps / len(train_dataloader) / accelerator.num_processes)
+        max_train_steps * gradient_accumulation_steps / len(train_dataloader) /
+        (1 if bucket_batches else accelerator.num_processes))
 
     logger.info("***** Running training *****")
     logger.info(f"  Num examples = {len(train_dataset)}")
@@ -565,10 +592,16 @@ def main(
         unet.eval()
         text_encoder.eval()
 
-    uncond_input = tokenizer([""] * train_batch_size, padding="max_length", max_length=tokenizer.model_max_length,
+    uncond_input = tokenizer([""], padding="max_length", max_length=tokenizer.model_max_length,
                              truncation=True, return_tensors="pt").input_ids.to(accelerator.device)
+    # A frozen text encoder maps a prompt to the same embedding on every step, so they are computed once and kept
+    # in an LRU cache. The unconditional input is the empty prompt and ends up in the same cache.
+    text_encoder_frozen = not any(p.requires_grad for p in text_encoder.parameters())
+    prompt_cache = ConditionCache(max_entries=prompt_cache_size) if text_encoder_frozen and prompt_cache_size else None
     for epoch in range(first_epoch, num_train_epochs):
         train_loss = 0.0
+        if bucket_batches:
+            train_sampler.start_epoch(epoch)
 
         for step, batch in enumerate(train_dataloader):
             # Skip steps until we reach the resumed step
@@ -576,11 +609,14 @@ def main(
                 if step % gradient_accumulation_steps == 0:
                     progress_bar.update(1)
                 continue
+            if bucket_batches:
+                batch = send_to_device(batch, accelerator.device)
             with accelerator.accumulate(unet), accelerator.accumulate(text_encoder):
                 with accelerator.autocast():
                     loss, latents = finetune_unet(accelerator, batch, use_offset_noise, cache_latents, vae,
                                                   rescale_schedule, offset_noise_strength, text_encoder,
-                                                  unet, noise_scheduler, uncond_input, motion_mask, motion_strength)
+                                                  unet, noise_scheduler, uncond_input, motion_mask, motion_strength,
+                                                  prompt_cache=prompt_cache)
 
                 device = loss.device
                 # Gather the losses across all processes for logging (if we use distributed training).
@@ -676,14 +712,39 @@ def remove_noise(
     return removed
 
 
+def encode_prompts(text_encoder, token_ids, keys=None, cache=None):
+    """
+    `text_encoder(token_ids)[0]`, looked up per prompt in `cache` under `keys` (frozen text encoders only).
+    The keys identify the token ids without copying them back from the device, see `collate_prompt_keys`.
+    Only the prompts missing from the cache go through the text encoder.
+    """
+    if cache is None or keys is None:
+        return text_encoder(token_ids)[0]
+    embeddings = {}
+    missing = []
+    for i, key in enumerate(keys):
+        if key not in embeddings:
+            embeddings[key] = cache.get(key)
+            if embeddings[key] is None:
+                missing.append(i)
+    if missing:
+        with torch.no_grad():
+            computed = text_encoder(token_ids[missing])[0]
+        for i, embedding in zip(missing, computed):
+            # clone so the entry doesn't keep the whole batch output alive
+            embeddings[keys[i]] = embedding.clone()
+            cache.put(keys[i], embeddings[keys[i]])
+    return torch.stack([embeddings[key] for key in keys])
+
+
 def finetune_unet(accelerator, batch, use_offset_noise,
                   cache_latents, vae, rescale_schedule, offset_noise_strength,
                   text_encoder, unet, noise_scheduler, uncond_input,
-                  motion_mask, motion_strength):
+                  motion_mask, motion_strength, prompt_cache=None):
     vae.eval()
     dtype = vae.dtype
     # Convert videos to latent space
-    pixel_values = batch["pixel_values"].to(dtype)
+    pixel_values = normalize_pixel_values(batch["pixel_values"], dtype, batch.get("pixel_norm", ["simple"])[0])
     bsz = pixel_values.shape[0]
     if not cache_latents:
         latents = tensor_to_vae_latent(pixel_values, vae)
@@ -721,8 +782,9 @@ def finetune_unet(accelerator, batch, use_offset_noise,
 
     # Encode text embeddings
     token_ids = batch['prompt_ids']
-    encoder_hidden_states = text_encoder(token_ids)[0]
-    uncond_hidden_states = text_encoder(uncond_input)[0]
+    prompt_keys = [("prompt_ids", key) for key in batch['prompt_key']] if 'prompt_key' in batch else None
+    encoder_hidden_states = encode_prompts(text_encoder, token_ids, prompt_keys, prompt_cache)
+    uncond_hidden_states = encode_prompts(text_encoder, uncond_input, [("uncond",)], prompt_cache).expand(bsz, -1, -1)
     # Get the target for loss depending on the prediction type
     if noise_scheduler.config.prediction_type == "epsilon":
         target = noise
@@ -803,7 +803,7 @@ def eval(pipeline, vae_processor, validation_data, image, signal, out_file, inde
     dtype = vae.dtype
 
     # prompt = validation_data.prompt
-    signal = torch.load(signal, map_location="cuda:0", weights_only=True)
+    signal = torch.load(signal, map_location="cpu", weights_only=True)
 
     pimg = Image.open(image)
     if pimg.mode == "RGBA":
@@ -910,7 +910,7 @@ def main_eval(
 
     # Move text encoders, and VAE to GPU
     models_to_cast = [unet, vae]
-    cast_to_gpu_and_type(models_to_cast, torch.device("cuda"), weight_dtype)
+    cast_to_gpu_and_type(models_to_cast, torch.device("cuda" if torch.cuda.is_available() else "cpu"), weight_dtype)
     batch_eval(unet, vae, vae_processor, pretrained_model_path, validation_data, "output/demo", True)
 
 
@@ -822,7 +822,7 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, validation_data, out_file, i
         os.makedirs(directory, exist_ok=True)
 
         # prompt = validation_data.prompt
-        signal = torch.load(signal, map_location="cuda:0", weights_only=True).to(dtype).to(device)
+        signal = torch.load(signal, map_location="cpu", weights_only=True).to(dtype).to(device)
 
         pimg = Image.open(image)
         if pimg.mode == "RGBA":
@@ -958,7 +958,7 @@ def main_eval(
 
     # Move text encoders, and VAE to GPU
     models_to_cast = [unet, vae]
-    cast_to_gpu_and_type(models_to_cast, torch.device("cuda"), weight_dtype)
+    cast_to_gpu_and_type(models_to_cast, torch.device("cuda" if torch.cuda.is_available() else "cpu"), weight_dtype)
     batch_eval(unet, vae, vae_processor, pretrained_model_path, sig1, sig2, sig3, validation_data, "output/demo", True)
 
 
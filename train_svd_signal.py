@@ -840,7 +840,7 @@ def eval(pipeline, vae_processor, sig1, sig2, validation_data, out_file, index,
         pimg = Image.open(image)
         if pimg.mode == "RGBA":
             pimg = pimg.convert("RGB")
-        signal = torch.load(signal, map_location="cuda:0", weights_only=True).to(dtype).to(device)
+        signal = torch.load(signal, map_location="cpu", weights_only=True).to(dtype).to(device)
 
         with torch.no_grad():
             if motion_mask:
@@ -898,7 +898,7 @@ def main_eval(
     # Load scheduler, tokenizer and models.
     pipeline, tokenizer, feature_extractor, train_scheduler, vae_processor, text_encoder, vae, unet = load_primary_models(
         pretrained_model_path, eval=True)
-    device = torch.device("cuda")
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     pipeline.to(device)
 
     if eval_file is not None:
@@ -5,6 +5,7 @@ import inspect
 import math
 import os
 import random
+import time
 import gc
 import copy
 import json
@@ -26,7 +27,7 @@ from PIL import Image
 
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import set_seed, ProjectConfiguration
+from accelerate.utils import set_seed, ProjectConfiguration, broadcast_object_list
 
 from diffusers.models import AutoencoderKL
 
@@ -47,10 +48,14 @@ from diffusers.pipelines.stable_video_diffusion.pipeline_stable_video_diffusion
 from models.layerdiffuse_VAE import LatentSignalEncoder, SignalEncoder, SignalEncoder2, ImageReduction, \
     MultiSignalEncoder, TransformNet, SignalTransformer, CompactSignalEncoder2, \
     CompactSignalTransformer2, CompactImageReduction, CompactSignalEncoder3_2, FFTConv1DLinearModel, \
-    FFTConv1DLinearModel2
+    FFTConv1DLinearModel2, StridedSignalEncoder3, CompactFFTConv1DLinearModel
 # from models.pipeline_stable_video_diffusion import StableVideoDiffusionPipeline
 from utils.common import log_scale_tensor
-from utils.dataset import get_train_dataset, extend_datasets, normalize_input
+from utils.dataset import get_train_dataset, normalize_input, normalize_pixel_values, MixtureSampler, \
+    mixture_weights
+from utils.video_sink import BackgroundSink, ImageioSink, TeeSink
+from utils.condition_cache import ConditionCache
+from utils.train_state import ResumableSampler, save_training_state, load_training_state, has_training_state
 from einops import rearrange, repeat
 import imageio
 import wandb
@@ -94,7 +99,8 @@ def create_output_folders(output_dir, config):
     return out_dir
 
 
-def load_primary_models(pretrained_model_path, fps, frame_step, n_input_frames, width, height, eval=False):
+def load_primary_models(pretrained_model_path, fps, frame_step, n_input_frames, width, height, eval=False,
+                        signal_encoder_variant="full"):
     # 25 = 4(latent/noisy) + 1(signal) // + n_input_frames(5) // 1(initial signal)
     # prev in_channels: cond(4) + noise(4) (+ mask(1))
     # ++ init_images(1) + init_signals(1) + signal(1) + pos(1)
@@ -135,7 +141,12 @@ def load_primary_models(pretrained_model_path, fps, frame_step, n_input_frames,
     # encoder_hidden_states for initial signals signal_encoder = CompactSignalTransformer2(input_size=CHIRP_LEN,
     # frame_step=frame_step, n_input_frames=n_input_frames, target_h=16, target_w=64)
 
-    signal_encoder = FFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step, n_input_frames=n_input_frames, target_h=16, target_w=64, out_channel=1)
+    if signal_encoder_variant == "compact":
+        signal_encoder = CompactFFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step,
+                                                     n_input_frames=n_input_frames, target_h=16, target_w=64,
+                                                     out_channel=1)
+    else:
+        signal_encoder = FFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step, n_input_frames=n_input_frames, target_h=16, target_w=64, out_channel=1)
 
     # Just large dim for later interpolation
     input_latents_dim1 = 100
@@ -144,13 +155,22 @@ def load_primary_models(pretrained_model_path, fps, frame_step, n_input_frames,
     # signal_encoder2 = LatentSignalEncoder(output_dim=input_latents_dim1 * input_latents_dim2)
     # latents for whole signals
     # signal_encoder2 = CompactSignalEncoder3_2(signal_data_dim=CHIRP_LEN, fps=fps, frame_step=frame_step, target_h=width // 8, target_w=height // 8)
-    signal_encoder2 = FFTConv1DLinearModel2(signal_data_dim=CHIRP_LEN, fps=fps, frame_step=frame_step,
-                                            target_h=width // 8, target_w=height // 8)
+    if signal_encoder_variant == "compact":
+        signal_encoder2 = StridedSignalEncoder3(signal_data_dim=CHIRP_LEN, fps=fps, frame_step=frame_step,
+                                                target_h=width // 8, target_w=height // 8, fft=True)
+    else:
+        signal_encoder2 = FFTConv1DLinearModel2(signal_data_dim=CHIRP_LEN, fps=fps, frame_step=frame_step,
+                                                target_h=width // 8, target_w=height // 8)
 
     # latents for initial signals
     # signal_encoder3 = CompactSignalTransformer2(input_size=CHIRP_LEN, frame_step=frame_step, n_input_frames=n_input_frames, target_h=width // 8, target_w=height // 8)
 
-    signal_encoder3 = FFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step,
+    if signal_encoder_variant == "compact":
+        signal_encoder3 = CompactFFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step,
+                                                      n_input_frames=n_input_frames, target_h=width // 8,
+                                                      target_w=height // 8)
+    else:
+        signal_encoder3 = FFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step,
                                                n_input_frames=n_input_frames, target_h=width // 8, target_w=height // 8)
 
     # Embed specific AP's location as bounding box
@@ -428,6 +448,10 @@ def save_pipe(
 
     if save_pretrained_model:
         pipeline.save_pretrained(save_path)
+    elif is_checkpoint:
+        # resuming needs the trained weights even when the full pipeline isn't saved
+        unet_out.save_pretrained(os.path.join(save_path, "unet"))
+    if save_pretrained_model or is_checkpoint:
         signal_save_path = save_path + "/signal/"
         os.makedirs(signal_save_path, exist_ok=True)
         torch.save(sig1_out.state_dict(), signal_save_path + 'sig1.pth')
@@ -466,7 +490,7 @@ def prompt_image(image, processor, encoder):
 
 def finetune_unet(accelerator, pipeline, batch, use_offset_noise,
                   rescale_schedule, offset_noise_strength, unet, sig1, sig2, sig3, camera_fourier, tx_fourier, img1,
-                  n_input_frames, motion_mask,
+                  n_input_frames, frame_step, motion_mask,
                   P_mean=0.7, P_std=1.6, human_loss=True):
     pipeline.vae.eval()
     pipeline.image_encoder.eval()
@@ -475,7 +499,9 @@ def finetune_unet(accelerator, pipeline, batch, use_offset_noise,
     dtype = pipeline.vae.dtype
     vae = pipeline.vae
     # Convert videos to latent space
-    pixel_values = batch['pixel_values']
+    # frames may arrive as uint8, they are normalized here on the device instead of in the dataloader workers
+    pixel_values = normalize_pixel_values(batch['pixel_values'].to(device), dtype,
+                                          batch.get('pixel_norm', ['simple'])[0])
     bsz, num_frames = pixel_values.shape[:2]
 
     frames = rearrange(pixel_values, 'b f c h w-> (b f) c h w').to(dtype)
@@ -523,14 +549,16 @@ def finetune_unet(accelerator, pipeline, batch, use_offset_noise,
     input_latents = torch.cat([c_in * noisy_latents, condition_latent / vae.config.scaling_factor], dim=2)
 
     # Signal embedding
-    assert "frame_step" in batch.keys(), batch.keys()
-    frame_step = batch["frame_step"][0].item()
+    # frame_step comes from the config, reading it from the batch would sync with the device every step. The
+    # datasets sample every round(native_fps / fps) frames per video, a video of another native fps fails this
+    # check asynchronously instead of being split wrongly
+    if "frame_step" in batch:
+        torch._assert_async(torch.all(batch["frame_step"] == frame_step))
     # print("frame_step", frame_step)
-    signal_values = torch.real(batch['signal_values']).float().half()  # [B, FPS * frame_step, 512]
+    signal_values = torch.real(batch['signal_values']).to(device, dtype)  # [B, FPS * frame_step, 512]
 
-    if torch.isnan(signal_values).any():
-        print(signal_values)
-        signal_values = torch.nan_to_num(signal_values, nan=0.0)
+    # sanitize on the device instead of branching on isnan().any(), which waits for the GPU
+    signal_values = torch.nan_to_num(signal_values, nan=0.0)
 
     signal_values_reshaped = rearrange(signal_values, 'b (f c) h-> b f c h', c=frame_step)  # [B, FPS, 32]
     signal_values_reshaped_input = signal_values_reshaped[:, :n_input_frames]
@@ -559,9 +587,9 @@ def finetune_unet(accelerator, pipeline, batch, use_offset_noise,
 
 
     # Fourier embedding
-    camera_pose = batch['camera_pose'].float().half()
-    tx_pos = batch['tx_pos'].float().half()
-    human_pos = batch['human_pos'].float().half()
+    camera_pose = batch['camera_pose'].to(device, dtype)
+    tx_pos = batch['tx_pos'].to(device, dtype)
+    human_pos = batch['human_pos'].to(device, dtype)
 
     camera_latent = camera_fourier(camera_pose)
     tx_latent = tx_fourier(tx_pos)
@@ -583,7 +611,6 @@ def finetune_unet(accelerator, pipeline, batch, use_offset_noise,
     # torch.Size([2, 25, 1, 64, 64]) torch.Size([2, 25, 1, 64, 64]) torch.Size([2, 25, 5, 64, 64]) torch.Size([2, 25, 8, 64, 64])
     latent_model_input = torch.cat([pos_latent, signal_initial_latent, signal_latent, images_latent, input_latents], dim=2)
 
-    accelerator.wait_for_everyone()
     # print(input_latents.size(), c_noise.size(), encoder_hidden_states.size(), added_time_ids.size())
     # torch.Size([2, 25, 9, 1, 1]) torch.Size([2]) torch.Size([50, 1, 1024]) torch.Size([2, 3])
     model_pred = unet(latent_model_input, c_noise, encoder_hidden_states=encoder_hidden_states, added_time_ids=added_time_ids).sample
@@ -630,11 +657,14 @@ def main(
         rescale_schedule: bool = False,
         offset_noise_strength: float = 0.1,
         extend_dataset: bool = False,
+        dataset_weights: Optional[list] = None,
         cache_latents: bool = False,
         cached_latent_dir=None,
         save_pretrained_model: bool = True,
         logger_type: str = 'tensorboard',
         motion_mask=False,
+        signal_encoder_variant: str = "full",
+        loss_log_steps: int = 10,
         **kwargs
 ):
     *_, config = inspect.getargvalues(inspect.currentframe())
@@ -660,12 +690,14 @@ def main(
     # Handle the output folder creation
     if accelerator.is_main_process:
         output_dir = create_output_folders(output_dir, config)
+    # every process writes its rng state into the checkpoints of the main process' run folder
+    output_dir = broadcast_object_list([output_dir])[0]
 
     # Load scheduler, tokenizer and models. The text encoder is actually image encoder for SVD
     pipeline, tokenizer, feature_extractor, train_scheduler, vae_processor, text_encoder, vae, unet, sig1, sig2, \
     sig3, camera_fourier, tx_fourier, img1 = load_primary_models(
         pretrained_model_path, train_data.n_sample_frames, train_data.frame_step, train_data.n_input_frames,
-        train_data.width, train_data.height)
+        train_data.width, train_data.height, signal_encoder_variant=signal_encoder_variant)
     # Freeze any necessary models
     freeze_models([vae, unet])
 
@@ -732,10 +764,6 @@ def main(
     except Exception as e:
         print(f"Could not process extra train datasets due to an error : {e}")
 
-    # Extend datasets that are less than the greatest one. This allows for more balanced training.
-    attrs = ['train_data', 'frames', 'image_dir', 'video_files']
-    extend_datasets(train_datasets, attrs, extend=extend_dataset)
-
     # Process one dataset
     if len(train_datasets) == 1:
         train_dataset = train_datasets[0]
@@ -745,10 +773,18 @@ def main(
         train_dataset = torch.utils.data.ConcatDataset(train_datasets)
 
     # DataLoaders creation:
+    # the sampler position is checkpointed, so resuming does not have to replay the dataloader
+    weights = mixture_weights(train_datasets, dataset_weights, extend=extend_dataset)
+    if weights is not None:
+        # balances the datasets by sampling them with `weights` instead of repeating the smaller manifests
+        train_sampler = MixtureSampler(train_dataset, weights=weights, seed=seed if seed is not None else 0)
+    else:
+        train_sampler = ResumableSampler(train_dataset, shuffle=shuffle, seed=seed if seed is not None else 0)
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=train_batch_size,
-        shuffle=shuffle
+        sampler=train_sampler,
+        pin_memory=torch.cuda.is_available()
     )
 
     # Prepare everything with our `accelerator`.
@@ -795,6 +831,22 @@ def main(
     logger.info(f"  Total optimization steps = {max_train_steps}")
     global_step = 0
     first_epoch = 0
+    # samples taken from the sampler by all processes together in one dataloader step
+    samples_per_step = train_batch_size * accelerator.num_processes
+
+    if resume_from_checkpoint:
+        if has_training_state(resume_from_checkpoint):
+            global_step, first_epoch = load_training_state(
+                resume_from_checkpoint, accelerator, optimizer, lr_scheduler, train_sampler)
+        else:
+            # older checkpoints only know the dataloader step, jump the sampler there instead of replaying batches
+            resume_step = resume_step or 0
+            train_sampler.start_epoch(0, resume_step * samples_per_step)
+            global_step = resume_step // gradient_accumulation_steps
+        load_checkpoint_weights(resume_from_checkpoint, accelerator.unwrap_model(unet),
+                                required=has_training_state(resume_from_checkpoint), sig1=sig1, sig2=sig2,
+                                sig3=sig3, camera_fourier=camera_fourier, tx_fourier=tx_fourier, img1=img1)
+        logger.info(f"  Resuming from {resume_from_checkpoint} at step {global_step}, epoch {first_epoch}")
 
     # Only show the progress bar once on each machine.
     progress_bar = tqdm(range(global_step, max_train_steps), disable=not accelerator.is_local_main_process)
@@ -822,16 +874,14 @@ def main(
             save_pretrained_model=save_pretrained_model
         )
     """
+    # losses are accumulated on the device and only gathered / copied to the host every `loss_log_steps` steps
+    train_loss = None
+    log_steps = 0
+    log_start = time.perf_counter()
     for epoch in range(first_epoch, num_train_epochs):
-        train_loss = 0.0
-
-        for step, batch in enumerate(train_dataloader):
-            # Skip steps until we reach the resumed step
-            if resume_from_checkpoint and epoch == first_epoch and step < resume_step:
-                if step % gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
-
+        if epoch != train_sampler.epoch:
+            train_sampler.start_epoch(epoch)
+        for batch in train_dataloader:
             with accelerator.accumulate(unet), accelerator.accumulate(sig1), accelerator.accumulate(
                     sig2), accelerator.accumulate(sig3), accelerator.accumulate(camera_fourier), \
                     accelerator.accumulate(tx_fourier), accelerator.accumulate(img1):
@@ -840,11 +890,10 @@ def main(
                                          rescale_schedule, offset_noise_strength, unet, sig1, sig2, sig3,
                                          camera_fourier,
                                          tx_fourier, img1,
-                                         train_data.n_input_frames, motion_mask)
+                                         train_data.n_input_frames, train_data.frame_step, motion_mask)
                 device = loss.device
-                # Gather the losses across all processes for logging (if we use distributed training).
-                avg_loss = accelerator.gather(loss.repeat(train_batch_size)).mean()
-                train_loss += avg_loss.item() / gradient_accumulation_steps
+                step_loss = loss.detach() / gradient_accumulation_steps
+                train_loss = step_loss if train_loss is None else train_loss + step_loss
 
                 # Backpropagate
                 accelerator.backward(loss)
@@ -855,12 +904,31 @@ def main(
                 lr_scheduler.step()
                 optimizer.zero_grad(set_to_none=True)
 
+            train_sampler.advance(samples_per_step)
+
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
                 progress_bar.update(1)
-                accelerator.log({"train_loss": train_loss}, step=global_step)
                 global_step += 1
-                train_loss = 0.0
+                log_steps += 1
+
+                if global_step % loss_log_steps == 0:
+                    # Gather the losses across all processes for logging (if we use distributed training).
+                    # The window is shorter than loss_log_steps after resuming between two logs
+                    avg_loss = accelerator.gather(train_loss[None]).mean().item() / log_steps
+                    step_time = (time.perf_counter() - log_start) / log_steps
+                    # training_loss is the loss of the last step, like the per-step log it replaces
+                    logs = {"train_loss": avg_loss, "training_loss": loss.detach().item(),
+                            "lr": lr_scheduler.get_last_lr()[0], "step_time": step_time}
+                    accelerator.log(logs, step=global_step)
+                    progress_bar.set_postfix(**logs)
+                    train_loss = None
+                    log_steps = 0
+                    log_start = time.perf_counter()
+
+                if global_step % checkpointing_steps == 0:
+                    save_training_state(os.path.join(output_dir, f"checkpoint-{global_step}"), accelerator,
+                                        optimizer, lr_scheduler, train_sampler, global_step, epoch)
 
                 if global_step % checkpointing_steps == 0 and accelerator.is_main_process:
                     save_pipe(
@@ -890,10 +958,6 @@ def main(
                         eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier, img1, validation_data, out_file, global_step)
                         logger.info(f"Saved a new sample to {out_file}")
 
-            logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
-            accelerator.log({"training_loss": loss.detach().item()}, step=step)
-            progress_bar.set_postfix(**logs)
-
             if global_step >= max_train_steps:
                 break
 
@@ -922,7 +986,28 @@ def main(
     accelerator.end_training()
 
 
-def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier, img1, validation_data, out_file, index, forward_t=25, preview=True):
+def read_prompt_video(path, frame_step=3, num_frames=25):
+    vr = decord.VideoReader(path)
+    frame_range = list(range(0, len(vr), frame_step))
+    frames = vr.get_batch(frame_range[0:num_frames])
+
+    if isinstance(frames, torch.Tensor):
+        frames = frames.cpu().numpy()  # Convert to a NumPy array if it's a tensor
+    return frames
+
+
+def load_signal(path):
+    return torch.real(torch.load(path, map_location="cpu", weights_only=True))
+
+
+def load_cached(condition_cache, path, loader, tag=None):
+    if condition_cache is None:
+        return loader(path)
+    return condition_cache.load(path, loader, tag=tag)
+
+
+def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier, img1, validation_data, out_file, index,
+         forward_t=25, preview=True, condition_cache=None, num_videos_per_prompt=1, generator=None):
     vae = pipeline.vae
     device = vae.device
     dtype = vae.dtype
@@ -956,22 +1041,19 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
         camera_pose = image.replace(".mp4", ".npy")
         tx_loc = image.replace(".mp4", ".txt")
 
-        image_replaced = image.replace("frame", str(index) + "_frame").replace('.mp4', '.gif')
-        target_file = out_file + image_replaced
+        # one output per generated video, numbered from `index`
+        target_files = [out_file + image.replace("frame", str(index + k) + "_frame").replace('.mp4', '.gif')
+                        for k in range(num_videos_per_prompt)]
         # print(out_file)
         # print(image_replaced)
-        directory = os.path.dirname(target_file)
+        directory = os.path.dirname(target_files[0])
         # Create the directory if it doesn't exist
         os.makedirs(directory, exist_ok=True)
 
         # pimg = Image.open(image)
-        vr = decord.VideoReader(image)
-        frame_step = 3
-        frame_range = list(range(0, len(vr), frame_step))
-        frames = vr.get_batch(frame_range[0:validation_data.num_frames])
-
-        if isinstance(frames, torch.Tensor):
-            frames = frames.cpu().numpy()  # Convert to a NumPy array if it's a tensor
+        frames = load_cached(condition_cache, image,
+                             lambda path: read_prompt_video(path, frame_step=3, num_frames=validation_data.num_frames),
+                             tag=("frames", 3, validation_data.num_frames))
 
         # Convert each frame to a PIL.Image
         pil_images = []
@@ -983,8 +1065,9 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
         # video = transform(video)
         # video = normalize_input(video)
 
-        signal = torch.real(torch.load(signal, map_location="cuda:0", weights_only=True)).to(dtype).to(device)
-        initial_signal = torch.real(torch.load(initial_signal, map_location="cuda:0", weights_only=True)).to(dtype).to(device)
+        # conditioning inputs stay on the host, the pipeline hashes them there for the condition cache
+        signal = load_cached(condition_cache, signal, load_signal).to(dtype)
+        initial_signal = load_cached(condition_cache, initial_signal, load_signal).to(dtype)
         initial_channels = initial_signal.unsqueeze(0)  # Now shape is (1, 512)
 
         # result_signal = torch.cat((initial_channels, signal), dim=0)  # Result shape will be (53, 512)
@@ -993,15 +1076,21 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
         # result_signal = result_signal * 1e4
         # result_signal = log_scale_tensor(torch.abs(result_signal))
         # result_signal = result_signal * 1e3
-        if torch.isnan(result_signal).any():
-            print(result_signal)
-            result_signal = torch.nan_to_num(result_signal, nan=0.0)
+        result_signal = torch.nan_to_num(result_signal, nan=0.0)
 
-        camera_data = np.load(camera_pose)
-        tx_data = np.loadtxt(tx_loc)
+        camera_data = load_cached(condition_cache, camera_pose, np.load)
+        tx_data = load_cached(condition_cache, tx_loc, np.loadtxt)
 
-        camera_data = torch.from_numpy(camera_data).to(dtype).to(device)
-        tx_data = torch.from_numpy(tx_data).to(dtype).to(device)
+        camera_data = torch.from_numpy(camera_data).to(dtype)
+        tx_data = torch.from_numpy(tx_data).to(dtype)
+
+        fps = validation_data.get('fps', 8)
+        frame_sink = None
+        if preview:
+            # stream decoded chunks to the gif and mp4 writers instead of materializing the video twice
+            frame_sink = [BackgroundSink(TeeSink(ImageioSink(f, duration=int(1000 / fps), loop=0),
+                                                 ImageioSink(f.replace('.gif', '.mp4'), fps=fps)))
+                          for f in target_files]
 
         with torch.no_grad():
             if motion_mask:
@@ -1009,14 +1098,16 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
                 # initial_latents = torch.randn([1, validation_data.num_frames, 4, h, w], dtype=dtype, device=device)
                 # mask = T.ToTensor()(np_mask).to(dtype).to(device)
                 # mask = T.Resize([h, w], antialias=False)(mask)
-                video_frames = MaskStableVideoDiffusionPipeline.__call__(
-                    pipeline,
+                generate_kwargs = dict(
                     video=pil_images,
                     width=validation_data.width,
                     height=validation_data.height,
                     num_frames=validation_data.num_frames,
                     num_inference_steps=validation_data.num_inference_steps,
                     decode_chunk_size=validation_data.decode_chunk_size,
+                    decode_tile_size=validation_data.get('decode_tile_size', None),
+                    decode_tile_overlap=validation_data.get('decode_tile_overlap', 8),
+                    decode_max_memory=validation_data.get('decode_max_memory', None),
                     fps=validation_data.fps,
                     motion_bucket_id=validation_data.motion_bucket_id,
                     n_input_frames=validation_data.n_input_frames,
@@ -1030,7 +1121,19 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
                     camera_fourier=camera_fourier,
                     tx_fourier=tx_fourier,
                     img1=img1,
-                ).frames[0]
+                    condition_cache=condition_cache,
+                )
+                if validation_data.get('long_generation', False):
+                    # windows of different seeds condition on different frames, so every seed walks the signal alone
+                    generators = generator if isinstance(generator, list) else [generator] * num_videos_per_prompt
+                    sinks = frame_sink if frame_sink is not None else [None] * num_videos_per_prompt
+                    video_frames = [MaskStableVideoDiffusionPipeline.generate_long(
+                        pipeline, window_overlap=validation_data.get('window_overlap', None), generator=g,
+                        frame_sink=s, **generate_kwargs).frames for g, s in zip(generators, sinks)]
+                else:
+                    video_frames = MaskStableVideoDiffusionPipeline.__call__(
+                        pipeline, num_videos_per_prompt=num_videos_per_prompt, generator=generator,
+                        frame_sink=frame_sink, **generate_kwargs).frames
             else:
                 video_frames = pipeline(
                     video=pil_images,
@@ -1041,52 +1144,89 @@ def eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier,
                     fps=validation_data.fps,
                     decode_chunk_size=validation_data.decode_chunk_size,
                     motion_bucket_id=validation_data.motion_bucket_id,
-                ).frames[0]
+                    frame_sink=frame_sink,
+                ).frames
 
-        if preview:
-            fps = validation_data.get('fps', 8)
-            imageio.mimwrite(target_file, video_frames, duration=int(1000 / fps), loop=0)
-            imageio.mimwrite(target_file.replace('.gif', '.mp4'), video_frames, fps=fps)
+        if preview and wandb.run is not None:
             # resized_frames = [np.array(cv2.resize(frame, (125, 125))) for frame in np.array(video_frames)]
             # resized_frames = np.array(resized_frames)
-            wandb.log({image: wandb.Video(target_file.replace('.gif', '.mp4'),
-                                          caption=target_file.replace('.gif', '.mp4'), fps=fps, format="mp4")})
+            for f in target_files:
+                wandb.log({image: wandb.Video(f.replace('.gif', '.mp4'),
+                                              caption=f.replace('.gif', '.mp4'), fps=fps, format="mp4")})
 
     return 0
 
 
+def load_signal_modules(pretrained_model_path, **modules):
+    # counterpart of the signal/*.pth files written by save_pipe
+    signal_path = os.path.join(pretrained_model_path, "signal")
+    for name, module in modules.items():
+        module.load_state_dict(torch.load(os.path.join(signal_path, f"{name}.pth"), map_location="cpu"))
+
+
+def load_checkpoint_weights(checkpoint_dir, unet, required=False, **signal_modules):
+    # weights written by save_pipe(is_checkpoint=True), older checkpoints only have them if save_pretrained_model
+    # was set. `required` for checkpoints with a training state, whose optimizer state belongs to these weights.
+    if required and not (os.path.isdir(os.path.join(checkpoint_dir, "unet"))
+                         and os.path.isdir(os.path.join(checkpoint_dir, "signal"))):
+        raise FileNotFoundError(f"{checkpoint_dir} has a training state but no unet/ and signal/ weights to resume")
+    if os.path.isdir(os.path.join(checkpoint_dir, "unet")):
+        unet.load_state_dict(
+            UNetSpatioTemporalConditionModel.from_pretrained(checkpoint_dir, subfolder="unet").state_dict())
+    if os.path.isdir(os.path.join(checkpoint_dir, "signal")):
+        load_signal_modules(checkpoint_dir, **signal_modules)
+
+
 def main_eval(
         pretrained_model_path: str,
+        train_data: Dict,
         validation_data: Dict,
         seed: Optional[int] = None,
         eval_file=None,
+        signal_encoder_variant: str = "full",
         **kwargs
 ):
     if seed is not None:
         set_seed(seed)
     # Load scheduler, tokenizer and models.
-    pipeline, tokenizer, feature_extractor, train_scheduler, vae_processor, text_encoder, vae, unet = load_primary_models(
-        pretrained_model_path, eval=True)
-    device = torch.device("cuda")
+    pipeline, tokenizer, feature_extractor, train_scheduler, vae_processor, text_encoder, vae, unet, sig1, sig2, \
+    sig3, camera_fourier, tx_fourier, img1 = load_primary_models(
+        pretrained_model_path, train_data.n_sample_frames, train_data.frame_step, train_data.n_input_frames,
+        train_data.width, train_data.height, eval=True,
+        signal_encoder_variant=signal_encoder_variant)
+    load_signal_modules(pretrained_model_path, sig1=sig1, sig2=sig2, sig3=sig3, camera_fourier=camera_fourier,
+                        tx_fourier=tx_fourier, img1=img1)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     pipeline.to(device)
+    cast_to_gpu_and_type([sig1, sig2, sig3, camera_fourier, tx_fourier, img1], device, pipeline.vae.dtype)
 
     if eval_file is not None:
         eval_list = json.load(open(eval_file))
     else:
-        eval_list = [[validation_data.prompt_image, validation_data.prompt]]
+        eval_list = [[image, validation_data.prompt] for image in validation_data.prompt_image]
 
+    # the seeds of an example are denoised in batches of eval_batch_size and share the loaded files and
+    # conditioning latents
+    condition_cache = ConditionCache(max_entries=validation_data.get('condition_cache_size', 64))
     output_dir = "output/svd_signal_v3_compact"
     iters = 5
+    eval_batch_size = validation_data.get('eval_batch_size', iters)
     for example in eval_list:
-        for t in range(iters):
-            name, prompt = example
-            out_file_dir = f"{output_dir}/{name.split('.')[0]}"
-            os.makedirs(out_file_dir, exist_ok=True)
-            out_file = f"{out_file_dir}/{t}.gif"
-            validation_data.prompt_image = name
-            validation_data.prompt = prompt
-            eval(pipeline, vae_processor, validation_data, out_file, t)
-            print("save file", out_file)
+        name, prompt = example
+        out_file_dir = f"{output_dir}/{os.path.splitext(os.path.basename(name))[0]}/"
+        os.makedirs(out_file_dir, exist_ok=True)
+        validation_data.prompt_image = [name]
+        validation_data.prompt = prompt
+        for start in range(0, iters, eval_batch_size):
+            batch_size = min(eval_batch_size, iters - start)
+            generator = None
+            if seed is not None:
+                # cpu generators: the pipeline draws the noise augmentation of the preprocessed image on the cpu
+                generator = [torch.Generator().manual_seed(seed + t) for t in range(start, start + batch_size)]
+            eval(pipeline, vae_processor, sig1, sig2, sig3, camera_fourier, tx_fourier, img1, validation_data,
+                 out_file_dir, start, condition_cache=condition_cache, num_videos_per_prompt=batch_size,
+                 generator=generator)
+        print("save file", out_file_dir)
 
 
 if __name__ == "__main__":
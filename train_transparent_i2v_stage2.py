@@ -513,6 +513,8 @@ def eval(pipeline, vae_processor, vae_alpha_encoder, vae_alpha_decoder, validati
                 return_dict=False,
                 condition_latent=latents[:, :, :1].detach().clone(),
                 mask=mask_1_frame,
+                decode_chunk_size=validation_data.get('decode_chunk_size', None),
+                decode_max_memory=validation_data.get('decode_max_memory', None),
             ) 
             
             
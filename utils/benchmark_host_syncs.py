@@ -0,0 +1,98 @@
+"""
+Step time of the coord training step with the per-step host syncs it used to have (frame_step read with .item(),
+branching on isnan().any(), the loss gathered and copied to the host twice per step) against the sync free step,
+on a stand-in model of the signal encoder and a conv stack in place of the unet.
+On the cpu a sync costs nothing, the difference shows on a gpu, where every sync drains the queued kernels.
+"""
+import argparse
+import time
+
+import torch
+from einops import rearrange
+from torch import nn
+
+from models.layerdiffuse_VAE import StridedSignalEncoder3
+
+CHIRP_LEN = 512
+
+
+class StandIn(nn.Module):
+    def __init__(self, frame_step, size, channels=128, layers=8):
+        super().__init__()
+        self.signal_encoder = StridedSignalEncoder3(signal_data_dim=CHIRP_LEN, frame_step=frame_step,
+                                                    target_h=size, target_w=size)
+        blocks = [nn.Conv2d(8, channels, 3, padding=1)]
+        for _ in range(layers):
+            blocks += [nn.SiLU(), nn.Conv2d(channels, channels, 3, padding=1)]
+        blocks += [nn.SiLU(), nn.Conv2d(channels, 4, 3, padding=1)]
+        self.unet = nn.Sequential(*blocks)
+
+    def forward(self, latents, signal):
+        signal_latent = self.signal_encoder(signal)
+        x = torch.cat([latents, signal_latent], dim=2).flatten(0, 1)
+        return self.unet(x).view_as(latents)
+
+
+def run(model, optimizer, batch, frame_step, iters, host_syncs, loss_log_steps, device):
+    train_loss = None
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for step in range(iters):
+        signal = batch["signal_values"] * 1e3
+        if host_syncs:
+            step_frame_step = batch["frame_step"][0].item()
+            if torch.isnan(signal).any():
+                signal = torch.nan_to_num(signal, nan=0.0)
+        else:
+            step_frame_step = frame_step
+            torch._assert_async(torch.all(batch["frame_step"] == frame_step))
+            signal = torch.nan_to_num(signal, nan=0.0)
+        signal = rearrange(signal, 'b (f c) h-> b f c h', c=step_frame_step)
+        loss = (model(batch["latents"], signal) - batch["latents"]).pow(2).mean()
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        if host_syncs:
+            loss.detach().mean().item()
+            loss.detach().item()
+            loss.detach().item()
+        else:
+            train_loss = loss.detach() if train_loss is None else train_loss + loss.detach()
+            if (step + 1) % loss_log_steps == 0:
+                train_loss.item()
+                train_loss = None
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def main(frame_step=3, num_frames=25, size=32, batch_size=2, iters=20, loss_log_steps=10, device=None):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    model = StandIn(frame_step, size).to(device)
+    optimizer = torch.optim.AdamW(model.parameters())
+    batch = {
+        "signal_values": torch.randn(batch_size, num_frames * frame_step, CHIRP_LEN, device=device),
+        "frame_step": torch.full((batch_size,), frame_step, device=device),
+        "latents": torch.randn(batch_size, num_frames, 4, size, size, device=device),
+    }
+    # warm up both paths
+    for host_syncs in [True, False]:
+        run(model, optimizer, batch, frame_step, 2, host_syncs, loss_log_steps, device)
+    synced = run(model, optimizer, batch, frame_step, iters, True, loss_log_steps, device)
+    sync_free = run(model, optimizer, batch, frame_step, iters, False, loss_log_steps, device)
+    print(f"{num_frames} frames {size}x{size} latents, batch {batch_size} on {device}")
+    print(f"{'host syncs':>12} {synced:8.2f} ms/step")
+    print(f"{'sync free':>12} {sync_free:8.2f} ms/step  x{synced / sync_free:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Step time with and without the per-step host syncs")
+    parser.add_argument("--frame_step", type=int, default=3)
+    parser.add_argument("--num_frames", type=int, default=25)
+    parser.add_argument("--size", type=int, default=32, help="latent size, 64 for 512x512 videos")
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--loss_log_steps", type=int, default=10)
+    parser.add_argument("--device", type=str, default=None)
+    main(**vars(parser.parse_args()))
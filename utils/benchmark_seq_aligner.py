@@ -0,0 +1,108 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from utils.seq_aligner import ScoreParams, get_matrix, get_traceback_matrix, global_align, global_align_batch, \
+    get_mapper, get_refinement_mapper
+
+MAX_LEN = 77
+
+
+def global_align_loop(x, y, score):
+    """The cell by cell implementation `global_align` replaced, the reference for its results."""
+    matrix = get_matrix(len(x), len(y), score.gap)
+    trace_back = get_traceback_matrix(len(x), len(y))
+    for i in range(1, len(x) + 1):
+        for j in range(1, len(y) + 1):
+            left = matrix[i, j - 1] + score.gap
+            up = matrix[i - 1, j] + score.gap
+            diag = matrix[i - 1, j - 1] + score.mis_match_char(x[i - 1], y[j - 1])
+            matrix[i, j] = max(left, up, diag)
+            if matrix[i, j] == left:
+                trace_back[i, j] = 1
+            elif matrix[i, j] == up:
+                trace_back[i, j] = 2
+            else:
+                trace_back[i, j] = 3
+    return matrix, trace_back
+
+
+class WordTokenizer:
+    """Stand-in for the CLIP tokenizer: one id per word between start and end tokens, as `encode` returns them."""
+
+    def __init__(self):
+        self.vocab = {}
+
+    def encode(self, text):
+        return [49406] + [self.vocab.setdefault(word, len(self.vocab)) for word in text.split(" ")] + [49407]
+
+
+def random_prompts(rng, num_prompts, num_words, vocab_size):
+    """Edits of one prompt of `num_words` words: replaced, inserted and deleted words."""
+    words = [f"w{i}" for i in range(vocab_size)]
+    base = list(rng.choice(words, num_words))
+    prompts = [" ".join(base)]
+    for _ in range(num_prompts - 1):
+        prompt = list(base)
+        for _ in range(rng.integers(1, 6)):
+            position = rng.integers(len(prompt))
+            edit = rng.integers(3)
+            if edit == 0:
+                prompt[position] = rng.choice(words)
+            elif edit == 1 and len(prompt) < num_words:
+                prompt.insert(position, rng.choice(words))
+            elif len(prompt) > 1:
+                del prompt[position]
+        prompts.append(" ".join(prompt))
+    return prompts
+
+
+def timed(fn, iters):
+    start = time.perf_counter()
+    for _ in range(iters):
+        result = fn()
+    return result, (time.perf_counter() - start) / iters * 1000
+
+
+def main(num_prompts=8, vocab_size=50, iters=5, seed=0):
+    rng = np.random.default_rng(seed)
+    tokenizer = WordTokenizer()
+    # start and end tokens fill up the 77 token limit
+    prompts = random_prompts(rng, num_prompts, MAX_LEN - 2, vocab_size)
+    sequences = [tokenizer.encode(prompt) for prompt in prompts]
+    score = ScoreParams(0, 1, -1)
+
+    for y in sequences[1:]:
+        expected = global_align_loop(sequences[0], y, score)
+        for result, reference in zip(global_align(sequences[0], y, score), expected):
+            assert np.array_equal(result, reference)
+    _, trace_backs = global_align_batch(sequences[0], sequences[1:], score)
+    for y, trace_back in zip(sequences[1:], trace_backs):
+        assert np.array_equal(trace_back[:, :len(y) + 1], global_align_loop(sequences[0], y, score)[1])
+
+    mappers, alphas = get_refinement_mapper(prompts, tokenizer, MAX_LEN)
+    for prompt, mapper, alpha in zip(prompts[1:], mappers, alphas):
+        expected_mapper, expected_alpha = get_mapper(prompts[0], prompt, tokenizer, MAX_LEN)
+        assert torch.equal(mapper, expected_mapper) and torch.equal(alpha, expected_alpha)
+    print(f"identical alignments and mappers for {num_prompts - 1} edits of a {MAX_LEN} token prompt")
+
+    pairs = [(sequences[0], y) for y in sequences[1:]]
+    _, loop_ms = timed(lambda: [global_align_loop(x, y, score) for x, y in pairs], iters)
+    _, vectorized_ms = timed(lambda: [global_align(x, y, score) for x, y in pairs], iters)
+    _, batch_ms = timed(lambda: global_align_batch(sequences[0], sequences[1:], score), iters)
+    _, mapper_ms = timed(lambda: get_refinement_mapper(prompts, tokenizer, MAX_LEN), iters)
+    print(f"{'loop':>12} {loop_ms:8.2f} ms")
+    print(f"{'vectorized':>12} {vectorized_ms:8.2f} ms  x{loop_ms / vectorized_ms:.1f}")
+    print(f"{'batched':>12} {batch_ms:8.2f} ms  x{loop_ms / batch_ms:.1f}")
+    print(f"get_refinement_mapper {mapper_ms:.2f} ms for {num_prompts} prompts")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="global_align against the per cell loop at the 77 token limit")
+    parser.add_argument("--num_prompts", type=int, default=8)
+    parser.add_argument("--vocab_size", type=int, default=50, help="small vocabularies give many ties")
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    main(**vars(parser.parse_args()))
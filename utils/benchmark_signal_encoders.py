@@ -0,0 +1,132 @@
+import argparse
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+from models.layerdiffuse_VAE import CompactSignalEncoder3, CompactSignalEncoder3_2, FFTConv1DLinearModel, \
+    FFTConv1DLinearModel2, StridedSignalEncoder3, CompactFFTConv1DLinearModel
+
+CHIRP_LEN = 512
+
+
+def encoder_pairs(frame_step, n_input_frames, width, height):
+    """
+    (name, full encoder, compact drop-in, input frames, signal length) as built by the coord training scripts.
+    The signal length is the one the first conv of the full encoder expects: `CompactSignalEncoder3_2` convolves
+    without padding, so its Linear sized for `signal_data_dim` needs 4 more samples. The compact encoders pool the
+    signal axis and take any length, they get the same input as the full one.
+    """
+    h, w = width // 8, height // 8
+    return [
+        ("CompactSignalEncoder3_2",
+         lambda: CompactSignalEncoder3_2(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w),
+         lambda: StridedSignalEncoder3(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w),
+         25, CHIRP_LEN + 4),
+        ("CompactSignalEncoder3",
+         lambda: CompactSignalEncoder3(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w),
+         lambda: StridedSignalEncoder3(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w),
+         25, CHIRP_LEN),
+        ("FFTConv1DLinearModel2",
+         lambda: FFTConv1DLinearModel2(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w),
+         lambda: StridedSignalEncoder3(signal_data_dim=CHIRP_LEN, frame_step=frame_step, target_h=h, target_w=w,
+                                       fft=True),
+         25, CHIRP_LEN),
+        ("FFTConv1DLinearModel",
+         lambda: FFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step, n_input_frames=n_input_frames,
+                                      target_h=h, target_w=w),
+         lambda: CompactFFTConv1DLinearModel(input_size=CHIRP_LEN, frame_step=frame_step,
+                                             n_input_frames=n_input_frames, target_h=h, target_w=w),
+         n_input_frames, CHIRP_LEN),
+    ]
+
+
+def max_rss():
+    # high-water mark of the resident memory of this process, in bytes (ru_maxrss is KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(build, frames, signal_len, frame_step, batch_size, device, iters, optimizer="adamw"):
+    """
+    (params, peak memory, samples/s) of `iters` training steps. The peak is the allocator peak on cuda and the growth
+    of the resident memory of the process on the cpu, so on the cpu run every measurement in a fresh process.
+    `optimizer` "none" only runs forward and backward, for encoders whose AdamW state does not fit.
+    """
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    x = torch.randn(batch_size, frames, frame_step, signal_len, device=device)
+    baseline = max_rss()
+    model = build().to(device)
+    params = sum(p.numel() for p in model.parameters())
+    optim = torch.optim.AdamW(model.parameters()) if optimizer == "adamw" else None
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        model(x).float().mean().backward()
+        if optim is not None:
+            optim.step()
+
+    # warm up, also allocates the gradients and optimizer state
+    step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    peak = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else max_rss() - baseline
+    del model, optim, x
+    return params, peak, batch_size * iters / elapsed
+
+
+def measure_row(index, variant, frame_step, n_input_frames, width, height, batch_size, device, iters, optimizer):
+    name, full, compact, frames, signal_len = encoder_pairs(frame_step, n_input_frames, width, height)[index]
+    build = full if variant == "full" else compact
+    return measure(build, frames, signal_len, frame_step, batch_size, torch.device(device), iters, optimizer)
+
+
+def main(frame_step=3, n_input_frames=10, width=512, height=512, batch_size=2, iters=20, device=None,
+         optimizer="adamw"):
+    device = torch.device(device or ("cuda" if torch.cuda.is_available() else "cpu"))
+    print(f"frame_step={frame_step} n_input_frames={n_input_frames} {width}x{height} batch={batch_size} "
+          f"optimizer={optimizer} on {device}, {torch.get_num_threads()} threads")
+    print("| encoder | variant | params | peak train memory | samples/s |")
+    print("|---|---|---|---|---|")
+    for index, (name, *_) in enumerate(encoder_pairs(frame_step, n_input_frames, width, height)):
+        for variant in ["full", "compact"]:
+            args = (index, variant, frame_step, n_input_frames, width, height, batch_size, str(device), iters,
+                    optimizer)
+            try:
+                if device.type == "cpu":
+                    # the resident memory high-water mark can't be reset, every row gets its own process
+                    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                        params, peak, throughput = executor.submit(measure_row, *args).result()
+                else:
+                    params, peak, throughput = measure_row(*args)
+            except (BrokenProcessPool, torch.cuda.OutOfMemoryError):
+                # a cpu row that runs out of memory is killed with its process
+                print(f"| {name} | {variant} | - | out of memory | - |", flush=True)
+                continue
+            print(f"| {name} | {variant} | {params / 1e6:.1f}M | {peak / 2 ** 20:.0f} MiB | {throughput:.2f} |",
+                  flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the full and compact signal encoders.")
+    parser.add_argument("--frame_step", type=int, default=3)
+    parser.add_argument("--n_input_frames", type=int, default=10)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--optimizer", type=str, default="adamw", choices=["adamw", "none"],
+                        help="none only measures forward and backward")
+    main(**vars(parser.parse_args()))
@@ -1,5 +1,11 @@
+import math
+
+import cv2
+import torch
 from PIL import Image
 
+from .train_state import ResumableSampler
+
 def min_res(size, min_size): return 192 if size < 192 else size
 
 def up_down_bucket(m_size, in_size, direction):
@@ -29,4 +35,81 @@ def sensible_buckets(m_width, m_height, w, h, min_size=192):
         h = closest_bucket(m_height, h, 'down', min_size=min_size)
         return m_width, h
 
-    return m_width, m_height
\ No newline at end of file
+    return m_width, m_height
+
+def bucket_size(m_width, m_height, w, h, multiple=64):
+    """`sensible_buckets` rounded down to a size the VAE / UNet down-sampling can divide."""
+    width, height = sensible_buckets(m_width, m_height, w, h)
+    return max(multiple, width - width % multiple), max(multiple, height - height % multiple)
+
+
+def video_size(path):
+    """(width, height) read from the container header, no frame is decoded."""
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            raise RuntimeError(f"Could not open {path}")
+        return int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        capture.release()
+
+
+def group_buckets(buckets):
+    """Indices of the samples of every (width, height) bucket, `buckets` holds the bucket of every sample."""
+    groups = {}
+    for index, bucket in enumerate(buckets):
+        groups.setdefault(tuple(bucket), []).append(index)
+    return groups
+
+
+def bucket_batch_size(width, height, pixel_budget, max_batch_size=None):
+    """Samples of a `width` x `height` bucket that fit into `pixel_budget` pixels per frame, at least one."""
+    batch_size = max(1, pixel_budget // (width * height))
+    return min(batch_size, max_batch_size) if max_batch_size else batch_size
+
+
+class BucketBatchSampler(ResumableSampler):
+    """
+    Batch sampler that only puts samples of the same resolution bucket into a batch.
+    `buckets` holds the (width, height) bucket of every sample, e.g. from `utils.dataset.bucket_index`, and the batch
+    size of a bucket follows `bucket_batch_size`, so low resolution buckets train with larger batches.
+    Batches are shuffled across buckets per epoch and dealt to the `num_replicas` processes round-robin, every process
+    gets the same number of batches. Batch sizes differ, so the dataloader must not be sharded again by accelerate.
+    `position` counts batches taken by all processes together.
+    """
+
+    def __init__(self, buckets, pixel_budget, max_batch_size=None, shuffle=True, seed=0, drop_last=False,
+                 num_replicas=1, rank=0):
+        super().__init__(buckets, shuffle=shuffle, seed=seed)
+        self.groups = group_buckets(buckets)
+        self.batch_sizes = {bucket: bucket_batch_size(*bucket, pixel_budget, max_batch_size) for bucket in self.groups}
+        self.drop_last = drop_last
+        self.num_replicas = num_replicas
+        self.rank = rank
+        num_batches = sum(len(indices) // self.batch_sizes[bucket] if drop_last
+                          else math.ceil(len(indices) / self.batch_sizes[bucket])
+                          for bucket, indices in self.groups.items())
+        self.num_batches = num_batches - num_batches % num_replicas
+
+    def __len__(self):
+        return self.num_batches // self.num_replicas
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in sorted(self.groups):
+            indices = self.groups[bucket]
+            if self.shuffle:
+                indices = [indices[i] for i in torch.randperm(len(indices), generator=generator).tolist()]
+            batch_size = self.batch_sizes[bucket]
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                if len(batch) == batch_size or not self.drop_last:
+                    batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches[:self.num_batches]
+
+    def __iter__(self):
+        return iter(self.batches()[self.position + self.rank::self.num_replicas])
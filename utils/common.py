@@ -37,12 +37,16 @@ def tensor_to_vae_latent(t, vae):
 
     return latents
 
-def DDPM_forward(x0, step, num_frames, scheduler):
+def DDPM_forward(x0, step, num_frames, scheduler, generator=None):
     device = x0.device
     t = scheduler.timesteps[-1]
     xt = repeat(x0, 'b c 1 h w -> b c f h w', f = num_frames)
 
-    eps = torch.randn_like(xt)
+    if generator is None:
+        eps = torch.randn_like(xt)
+    else:
+        # drawn on the generator's (cpu) device, independent of the global rng
+        eps = torch.randn(xt.shape, generator=generator, dtype=xt.dtype).to(device)
     alpha_vec = torch.prod(scheduler.alphas[t:])
     xt = torch.sqrt(alpha_vec) * xt + torch.sqrt(1-alpha_vec) * eps
     return xt, None
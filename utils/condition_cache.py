@@ -0,0 +1,147 @@
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def tensor_digest(*tensors):
+    """
+    Content hash of host tensors / arrays (shape, dtype and values). Hash the inputs before they are uploaded,
+    hashing a device tensor would copy it back to the host on every call.
+    """
+    digest = hashlib.sha1()
+    for t in tensors:
+        if isinstance(t, torch.Tensor):
+            if t.device.type != "cpu":
+                raise ValueError(f"tensor_digest hashes host data, got a tensor on {t.device}")
+            t = t.detach()
+            digest.update(f"{tuple(t.shape)}{t.dtype}".encode())
+            if t.dtype == torch.bfloat16:
+                t = t.float()
+            t = t.contiguous().numpy()
+        else:
+            t = np.ascontiguousarray(t)
+            digest.update(f"{t.shape}{t.dtype}".encode())
+        digest.update(t.tobytes())
+    return digest.hexdigest()
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 0
+
+
+class ConditionCache:
+    """
+    LRU cache for encoded conditioning tensors (signal latents, pose latents, image reduction latents) and for
+    the raw signal / pose files they are computed from.
+    Keys are built by the caller from an explicit encoder name and a content hash of its host-side input, so repeated
+    generations on the same example only pay for the denoising loop. Encoder weights are assumed frozen while entries are alive,
+    call `clear()` after they change (e.g. between validations during training).
+    """
+
+    def __init__(self, max_entries=64, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def get_or_compute(self, key, compute):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        value = compute()
+        self.put(key, value)
+        return value
+
+    def get_or_compute_many(self, keys, compute):
+        """
+        `get_or_compute` for a batch: the values of all keys that are not cached are computed by one
+        `compute(missing_keys)` call, which returns them in order.
+        """
+        values = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                values[key] = self.entries[key]
+            else:
+                self.misses += 1
+                missing.append(key)
+        if missing:
+            for key, value in zip(missing, compute(missing)):
+                values[key] = value
+                self.put(key, value)
+        return [values[key] for key in keys]
+
+    def put(self, key, value):
+        if key in self.entries:
+            self.size_bytes -= _nbytes(self.entries.pop(key))
+        self.entries[key] = value
+        self.size_bytes += _nbytes(value)
+        self._evict()
+
+    def _evict(self):
+        while len(self.entries) > 1 and (
+                len(self.entries) > self.max_entries
+                or (self.max_bytes is not None and self.size_bytes > self.max_bytes)):
+            _, value = self.entries.popitem(last=False)
+            self.size_bytes -= _nbytes(value)
+
+    def load(self, path, loader, tag=None):
+        # files are keyed by path, size and mtime so an edited file is reloaded,
+        # `tag` separates different loaders / loader arguments for the same file
+        stat = os.stat(path)
+        return self.get_or_compute(("file", os.path.abspath(path), stat.st_size, stat.st_mtime_ns, tag),
+                                   lambda: loader(path))
+
+    def encode(self, name, inputs, compute):
+        """
+        Cache `compute()` under `name`, which identifies the encoder (and its arguments), and the content of the host
+        tensors `inputs`.
+        """
+        if not isinstance(inputs, (tuple, list)):
+            inputs = (inputs,)
+        return self.get_or_compute(("encode", name, tensor_digest(*inputs)), compute)
+
+    def clear(self):
+        self.entries.clear()
+        self.size_bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size_bytes, "hits": self.hits, "misses": self.misses}
+
+
+def cached_encode(cache, name, inputs, compute):
+    """`cache.encode(...)` that falls back to calling `compute()` when no cache is given."""
+    if cache is None:
+        return compute()
+    return cache.encode(name, inputs, compute)
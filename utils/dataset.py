@@ -1,4 +1,5 @@
 import os
+import math
 import decord
 import numpy as np
 import random
@@ -8,16 +9,19 @@ import torchvision.transforms as T
 import torch
 
 from glob import glob
+from functools import lru_cache
 from PIL import Image
 from itertools import islice
 from pathlib import Path
-from .bucketing import sensible_buckets
+from .bucketing import sensible_buckets, bucket_size, video_size, group_buckets
 from .common import get_moved_area_mask, calculate_motion_score
+from .train_state import ResumableSampler
+from .condition_cache import tensor_digest
 import torch.nn.functional as F
 
 decord.bridge.set_bridge('torch')
 
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, ConcatDataset, default_collate
 from einops import rearrange, repeat
 
 
@@ -44,20 +48,60 @@ def normalize_input(
         return rearrange(item / 127.5 - 1.0, 'f h w c -> f c h w')
 
 
+def normalize_pixel_values(
+        pixel_values,
+        dtype=torch.float32,
+        mode="simple",
+        mean=[0.485, 0.456, 0.406],
+        std=[0.229, 0.224, 0.225]
+):
+    """
+    Batched counterpart of `normalize_input` for [..., c, h, w] pixel values, meant to run on the training device.
+    uint8 frames (datasets with `uint8_pixels`) are normalized in `dtype`, float pixel values are already normalized
+    (or are cached latents) and only cast.
+    """
+    if pixel_values.dtype != torch.uint8:
+        return pixel_values.to(dtype)
+    pixel_values = pixel_values.to(dtype)
+    if mode == "simple":
+        # Normalize between -1 & 1
+        return pixel_values / 127.5 - 1.0
+    mean = torch.tensor(mean, device=pixel_values.device, dtype=dtype).view(3, 1, 1)
+    std = torch.tensor(std, device=pixel_values.device, dtype=dtype).view(3, 1, 1)
+    return (pixel_values / 255.0 - mean) / std
+
+
+@lru_cache(maxsize=4096)
+def tokenize_prompt(tokenizer, prompt):
+    # every clip of a video repeats its prompts, so each worker only tokenizes a prompt once
+    return tokenizer(
+        prompt,
+        truncation=True,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        return_tensors="pt",
+    ).input_ids[0]
+
+
 def get_prompt_ids(prompt, tokenizer):
     if tokenizer is None:
         prompt_ids = torch.tensor([0])
     else:
-        prompt_ids = tokenizer(
-            prompt,
-            truncation=True,
-            padding="max_length",
-            max_length=tokenizer.model_max_length,
-            return_tensors="pt",
-        ).input_ids[0]
+        prompt_ids = tokenize_prompt(tokenizer, prompt)
     return prompt_ids
 
 
+def collate_prompt_keys(examples):
+    """
+    `default_collate` that adds a "prompt_key" per example, a digest of its `prompt_ids`, to look up text
+    embeddings by. It is computed here, on the host, because some datasets overwrite `text_prompt` with a label.
+    """
+    batch = default_collate(examples)
+    if "prompt_ids" in batch:
+        batch["prompt_key"] = [tensor_digest(prompt_ids) for prompt_ids in batch["prompt_ids"]]
+    return batch
+
+
 def read_caption_file(caption_file):
     with open(caption_file, 'r', encoding="utf8") as t:
         return t.read()
@@ -125,9 +169,9 @@ def get_frame_signal_batch(signal_path, initial_signal_path, max_frames, sample_
     video = transform(video)
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    channels = torch.load(signal_path, map_location="cuda:0", weights_only=True)
+    channels = torch.load(signal_path, map_location="cpu", weights_only=True)
 
-    initial_channels = torch.load(initial_signal_path, map_location="cuda:0", weights_only=True)
+    initial_channels = torch.load(initial_signal_path, map_location="cpu", weights_only=True)
 
     partial_channels = channels[frame_range_indices, :]
 
@@ -158,7 +202,7 @@ def get_frame_agg_signal_batch(signal_path, initial_signal_path, tx_path, camera
     video = transform(video)
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-    channels = torch.load(signal_path, map_location="cuda:0", weights_only=True)
+    channels = torch.load(signal_path, map_location="cpu", weights_only=True)
     # Read the file and split lines
     with open(signal_path.replace("channels.pt", "human.txt"), 'r') as f:
         lines = f.readlines()
@@ -167,7 +211,7 @@ def get_frame_agg_signal_batch(signal_path, initial_signal_path, tx_path, camera
     coords = [list(map(float, line.strip().split(','))) for line in lines]
 
     # Convert to a PyTorch tensor
-    human_coords = torch.tensor(coords).cuda()
+    human_coords = torch.tensor(coords)
 
     # print("check", frame_step, start, max_frames, frame_range_indices, max_range, frame_range)
 
@@ -176,7 +220,7 @@ def get_frame_agg_signal_batch(signal_path, initial_signal_path, tx_path, camera
 
     camera_pose = np.load(camera_pose_path)
     tx_pos = np.loadtxt(tx_path)
-    initial_channels = torch.load(initial_signal_path, map_location="cuda:0", weights_only=True)
+    initial_channels = torch.load(initial_signal_path, map_location="cpu", weights_only=True)
 
     initial_channels = initial_channels.unsqueeze(0)  # Now shape is (1, 512)
     # channel range: tensor(-0.0050) tensor(0.0049)
@@ -210,6 +254,38 @@ def process_video(vid_path, use_bucketing, w, h, get_frame_buckets, get_frame_ba
     return video, vr
 
 
+def probe_buckets(paths, width, height):
+    """Video sizes read from the container headers and their buckets, every distinct path is probed once."""
+    sizes = {}
+    for path in paths:
+        if path not in sizes:
+            sizes[path] = video_size(path)
+    video_sizes = [sizes[path] for path in paths]
+    return video_sizes, [bucket_size(width, height, w, h) for w, h in video_sizes]
+
+
+def bucket_transform(size, bucket):
+    """Resize a (width, height) video to cover the (width, height) bucket and center crop it, keeping the aspect."""
+    (width, height), (b_width, b_height) = size, bucket
+    scale = max(b_width / width, b_height / height)
+    return T.Compose([
+        T.Resize((math.ceil(height * scale), math.ceil(width * scale)), antialias=True),
+        T.CenterCrop([b_height, b_width])
+    ])
+
+
+def bucket_index(dataset):
+    """(width, height) bucket of every sample of a dataset or ConcatDataset, the input of a BucketBatchSampler."""
+    datasets = dataset.datasets if isinstance(dataset, ConcatDataset) else [dataset]
+    buckets = []
+    for d in datasets:
+        if getattr(d, "use_bucketing", False) and hasattr(d, "bucket_sizes"):
+            buckets += d.bucket_sizes()
+        else:
+            buckets += [(d.width, d.height)] * len(d)
+    return buckets
+
+
 # https://github.com/ExponentialML/Video-BLIP2-Preprocessor
 class VideoBLIPDataset(Dataset):
     def __init__(
@@ -228,6 +304,7 @@ class VideoBLIPDataset(Dataset):
             preprocessed: bool = False,
             use_bucketing: bool = False,
             motion_threshold=50,
+            uint8_pixels: bool = False,
             **kwargs
     ):
         self.vid_types = (".mp4", ".avi", ".mov", ".webm", ".flv", ".mjpeg")
@@ -241,12 +318,17 @@ class VideoBLIPDataset(Dataset):
 
         self.train_data = self.load_from_json(json_path, json_data)
         self.motion_threshold = motion_threshold
+        # emit uint8 frames and let the training step normalize them on the device (`normalize_pixel_values`)
+        self.uint8_pixels = uint8_pixels
         self.width = width
         self.height = height
 
         self.n_sample_frames = n_sample_frames
         self.sample_start_idx = sample_start_idx
         self.fps = fps
+        self.buckets = None
+        self.video_sizes = None
+        self.bucket_groups = None
         self.transform = T.Compose([
             # T.RandomResizedCrop(size=(height, width), scale=(0.8, 1.0), ratio=(width/height, width/height), antialias=False)
             T.Resize(min(height, width), antialias=False),
@@ -300,6 +382,32 @@ class VideoBLIPDataset(Dataset):
 
         return resize
 
+    def video_path(self, index):
+        vid_data = self.train_data[index]
+        if vid_data.get('clip_path') is not None:
+            return vid_data['clip_path']
+        return vid_data[self.vid_data_key]
+
+    def bucket_sizes(self):
+        # probed once, before the dataloader workers are forked by the sampler setup
+        if self.buckets is None:
+            self.video_sizes, self.buckets = probe_buckets(
+                [self.video_path(i) for i in range(len(self))], self.width, self.height)
+            self.bucket_groups = group_buckets(self.buckets)
+        return self.buckets
+
+    def sample_transform(self, index):
+        if not self.use_bucketing:
+            return self.transform
+        self.bucket_sizes()
+        return bucket_transform(self.video_sizes[index], self.buckets[index])
+
+    def bucket_retry_index(self, index):
+        # a replacement sample has to come from the same bucket to fit into the batch
+        if not self.use_bucketing:
+            return random.randint(0, len(self) - 1)
+        return random.choice(self.bucket_groups[self.bucket_sizes()[index]])
+
     def train_data_batch(self, index):
         vid_data = self.train_data[index]
         # Get video prompt
@@ -316,7 +424,7 @@ class VideoBLIPDataset(Dataset):
         vr = decord.VideoReader(clip_path)
 
         video, signal = get_frame_signal_batch(vid_data[self.sig_data_key], vid_data[self.initial_sig_data_key], self.n_sample_frames, self.fps, vr,
-                                               self.transform)
+                                               self.sample_transform(index))
         # video = get_frame_batch(self.n_sample_frames, self.fps, vr, self.transform)
 
         # prompt_ids = np.array(0)
@@ -324,7 +432,8 @@ class VideoBLIPDataset(Dataset):
         prompt_ids = get_prompt_ids(prompt, self.tokenizer)
 
         example = {
-            "pixel_values": normalize_input(video),
+            "pixel_values": video if self.uint8_pixels else normalize_input(video),
+            "pixel_norm": "simple",
             "signal_values": signal,
             "prompt_ids": prompt_ids,
             "text_prompt": prompt,
@@ -354,14 +463,15 @@ class VideoBLIPDataset(Dataset):
         vr = decord.VideoReader(clip_path)
 
         video, signal, frame_step, human_coords = get_frame_agg_signal_batch(vid_data[self.sig_data_key], vid_data[self.initial_sig_data_key], self.n_sample_frames,
-                                                               self.fps, vr, self.transform)
+                                                               self.fps, vr, self.sample_transform(index))
         # video = get_frame_batch(self.n_sample_frames, self.fps, vr, self.transform)
 
         # prompt_ids = np.array(0)
         # prompt = np.array(0)
         prompt_ids = get_prompt_ids(prompt, self.tokenizer)
         example = {
-            "pixel_values": normalize_input(video),
+            "pixel_values": video if self.uint8_pixels else normalize_input(video),
+            "pixel_norm": "simple",
             "signal_values": signal,
             "prompt_ids": prompt_ids,
             "text_prompt": prompt,
@@ -389,7 +499,7 @@ class VideoBLIPDataset(Dataset):
     def __getitem__(self, index):
         example = self.train_data_batch(index)
         if example['motion'] < self.motion_threshold:
-            return self.__getitem__(random.randint(0, len(self) - 1))
+            return self.__getitem__(self.bucket_retry_index(index))
         return example
 
 
@@ -414,6 +524,7 @@ class VideoBLIPDataset_V2(Dataset):
             preprocessed: bool = False,
             use_bucketing: bool = False,
             motion_threshold=50,
+            uint8_pixels: bool = False,
             **kwargs
     ):
         self.vid_types = (".mp4", ".avi", ".mov", ".webm", ".flv", ".mjpeg")
@@ -429,6 +540,8 @@ class VideoBLIPDataset_V2(Dataset):
 
         self.train_data = self.load_from_json(json_path, json_data)
         self.motion_threshold = motion_threshold
+        # emit uint8 frames and let the training step normalize them on the device (`normalize_pixel_values`)
+        self.uint8_pixels = uint8_pixels
         self.width = width
         self.height = height
 
@@ -525,7 +638,8 @@ class VideoBLIPDataset_V2(Dataset):
             prompt = "not"
 
         example = {
-            "pixel_values": normalize_input(video),
+            "pixel_values": video if self.uint8_pixels else normalize_input(video),
+            "pixel_norm": "simple",
             "signal_values": signal,
             "camera_pose": camera_pose,
             "tx_pos": tx_pos,
@@ -884,6 +998,7 @@ class VideoJsonDataset(Dataset):
             fallback_prompt: str = "",
             use_bucketing: bool = False,
             motion_threshold=50,
+            uint8_pixels: bool = False,
             **kwargs
     ):
         self.tokenizer = tokenizer
@@ -899,6 +1014,11 @@ class VideoJsonDataset(Dataset):
         self.n_sample_frames = n_sample_frames
         self.fps = fps
         self.motion_threshold = motion_threshold
+        # emit uint8 frames and let the training step normalize them on the device (`normalize_pixel_values`)
+        self.uint8_pixels = uint8_pixels
+        self.buckets = None
+        self.video_sizes = None
+        self.bucket_groups = None
         self.transform = T.Compose([
             # T.RandomResizedCrop(size=(height, width), scale=(0.8, 1.0), ratio=(width/height, width/height), antialias=False),
             T.Resize(min(height, width), antialias=False),
@@ -912,6 +1032,29 @@ class VideoJsonDataset(Dataset):
 
         return resize
 
+    def video_path(self, index):
+        return os.path.join(self.video_dir, self.video_files[index]['video'])
+
+    def bucket_sizes(self):
+        # probed once, before the dataloader workers are forked by the sampler setup
+        if self.buckets is None:
+            self.video_sizes, self.buckets = probe_buckets(
+                [self.video_path(i) for i in range(len(self))], self.width, self.height)
+            self.bucket_groups = group_buckets(self.buckets)
+        return self.buckets
+
+    def sample_transform(self, index):
+        if not self.use_bucketing:
+            return self.transform
+        self.bucket_sizes()
+        return bucket_transform(self.video_sizes[index], self.buckets[index])
+
+    def bucket_retry_index(self, index):
+        # a replacement sample has to come from the same bucket to fit into the batch
+        if not self.use_bucketing:
+            return random.randint(0, len(self) - 1)
+        return random.choice(self.bucket_groups[self.bucket_sizes()[index]])
+
     @staticmethod
     def __getname__():
         return 'video_json'
@@ -929,14 +1072,15 @@ class VideoJsonDataset(Dataset):
             if self.fallback_prompt == "<no_text>":
                 prompt = ""
             vr = decord.VideoReader(video_path)
-            video = get_frame_batch(self.n_sample_frames, self.fps, vr, self.transform)
+            video = get_frame_batch(self.n_sample_frames, self.fps, vr, self.sample_transform(index))
         except Exception as err:
             print("read video error", err, video_path)
-            return self.__getitem__(index + 1)
+            return self.__getitem__(self.bucket_retry_index(index) if self.use_bucketing else index + 1)
         prompt_ids = get_prompt_ids(prompt, self.tokenizer)
 
         example = {
-            "pixel_values": normalize_input(video),
+            "pixel_values": video if self.uint8_pixels else normalize_input(video),
+            "pixel_norm": "simple",
             "prompt_ids": prompt_ids,
             "text_prompt": prompt,
             'dataset': self.__getname__()
@@ -944,7 +1088,7 @@ class VideoJsonDataset(Dataset):
         example['mask'] = get_moved_area_mask(video.permute([0, 2, 3, 1]).numpy())
         example['motion'] = calculate_motion_score(video.permute([0, 2, 3, 1]).numpy())
         if example['motion'] < self.motion_threshold:
-            return self.__getitem__(random.randint(0, len(self) - 1))
+            return self.__getitem__(self.bucket_retry_index(index))
         return example
 
 
@@ -961,7 +1105,7 @@ class CachedDataset(Dataset):
         return len(self.cached_data_list)
 
     def __getitem__(self, index):
-        cached_latent = torch.load(self.cached_data_list[index], map_location='cuda:0', weights_only=True)
+        cached_latent = torch.load(self.cached_data_list[index], map_location='cpu', weights_only=True)
         return cached_latent
 
 
@@ -1000,3 +1144,67 @@ def extend_datasets(datasets, dataset_items, extend=False):
 
                     print(f"New {item} dataset length: {dataset.__len__()}")
                     extended.append(item)
+
+
+class MixtureSampler(ResumableSampler):
+    """
+    Samples the sources of a ConcatDataset with the given weights, the lazy counterpart of `extend_datasets`.
+    Each draw picks a source by weight and then the next index of that source's own shuffled order, a source is
+    reshuffled once it is exhausted. Nothing is duplicated, so a large-plus-small mix costs one index permutation per
+    source instead of repeated manifests.
+    The stream only depends on (seed, epoch), every process draws the same one. With accelerate the batches are sharded
+    across processes by the prepared dataloader, without it pass `num_replicas` / `rank` to take every
+    `num_replicas`-th index. Resuming at `position` redraws the skipped indices, which costs no data loading.
+    """
+
+    block_size = 4096
+
+    def __init__(self, data_source, weights=None, num_samples=None, seed=0, num_replicas=1, rank=0):
+        super().__init__(data_source, shuffle=True, seed=seed)
+        self.sizes = [len(d) for d in data_source.datasets]
+        self.offsets = [0] + data_source.cumulative_sizes[:-1]
+        if weights is None:
+            weights = [1.0] * len(self.sizes)
+        if len(weights) != len(self.sizes):
+            raise ValueError(f"Got {len(weights)} dataset weights for {len(self.sizes)} datasets")
+        self.weights = torch.tensor([float(w) if size > 0 else 0. for w, size in zip(weights, self.sizes)])
+        if self.weights.sum() <= 0:
+            raise ValueError("All datasets with a positive weight are empty")
+        if num_samples is None:
+            # the epoch length extend_datasets produced: every used source stretched to the biggest one
+            num_samples = max(self.sizes) * int((self.weights > 0).sum())
+        self.num_samples = num_samples - num_samples % num_replicas
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        return self.num_samples // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        orders = [None] * len(self.sizes)
+        cursors = [0] * len(self.sizes)
+        position = self.position
+
+        def draw():
+            drawn = 0
+            while drawn < self.num_samples:
+                sources = torch.multinomial(self.weights, min(self.block_size, self.num_samples - drawn),
+                                            replacement=True, generator=generator)
+                for source in sources.tolist():
+                    if orders[source] is None or cursors[source] == self.sizes[source]:
+                        orders[source] = torch.randperm(self.sizes[source], generator=generator).tolist()
+                        cursors[source] = 0
+                    yield self.offsets[source] + orders[source][cursors[source]]
+                    cursors[source] += 1
+                drawn += len(sources)
+
+        return islice(draw(), position + self.rank, None, self.num_replicas)
+
+
+def mixture_weights(datasets, weights=None, extend=False):
+    """Per-source weights for a MixtureSampler, or None if the datasets should just be concatenated."""
+    if len(datasets) < 2 or (weights is None and not extend):
+        return None
+    return weights if weights is not None else [1.0] * len(datasets)
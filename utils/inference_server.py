@@ -0,0 +1,207 @@
+"""
+Request queue with micro-batching in front of a single warm pipeline, used by the Gradio apps (app.py, app_svd.py),
+which only preprocess the inputs of a click and wait for their result.
+
+python -m utils.inference_server --num_clients 16 exercises the scheduler on CPU with a fake GPU.
+"""
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class QueueFull(RuntimeError):
+    pass
+
+
+class RequestCancelled(RuntimeError):
+    """Raised by `run_batch` when every request of the batch was cancelled by its client."""
+    pass
+
+
+class InferenceRequest:
+    def __init__(self, key, payload):
+        self.key = key
+        self.payload = payload
+        self.future = Future()
+        self.submitted = time.monotonic()
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class MicroBatchServer:
+    """
+    Serves requests of many client threads with one model on a single worker thread.
+    Requests with the same `key` (everything that has to be shared by one pipeline call: resolution, frame count,
+    number of steps, ...) are batched: the worker takes the oldest request, waits until `max_wait` seconds after its
+    submission for more requests of its key and runs at most `max_batch_size` of them as one
+    `run_batch(payloads) -> results` call. Requests of other keys keep their place in the queue.
+    If a batch fails its requests are retried one by one, so one bad input (or an out of memory batch) only fails
+    itself. A batch that raises `RequestCancelled` is not retried.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, max_wait=0.1, max_queue=None, history=1000):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.running = 0
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_errors = 0
+        self.batch_sizes = deque(maxlen=history)
+        self.queue_waits = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, payload):
+        request = InferenceRequest(key, payload)
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("Server is closed")
+            if self.max_queue is not None and len(self.pending) >= self.max_queue:
+                raise QueueFull(f"{len(self.pending)} requests are queued, try again later")
+            self.pending.append(request)
+            self.condition.notify()
+        return request.future
+
+    def __call__(self, key, payload, timeout=None):
+        return self.submit(key, payload).result(timeout)
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            first = self.pending[0]
+            while True:
+                batch = [request for request in self.pending if request.key == first.key][:self.max_batch_size]
+                remaining = first.submitted + self.max_wait - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self.closed:
+                    break
+                self.condition.wait(remaining)
+            for request in batch:
+                self.pending.remove(request)
+            # cancelled requests are dropped here, running ones can't be cancelled any more
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            self.running = len(batch)
+            return batch
+
+    def _execute(self, batch):
+        try:
+            results = self.run_batch([request.payload for request in batch])
+        except RequestCancelled as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        except Exception as e:
+            if len(batch) > 1:
+                for request in batch:
+                    self._execute([request])
+                return
+            self.num_errors += 1
+            batch[0].future.set_exception(e)
+            return
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+            started = time.monotonic()
+            self._execute(batch)
+            finished = time.monotonic()
+            with self.condition:
+                self.running = 0
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.batch_sizes.append(len(batch))
+                self.queue_waits.extend(started - request.submitted for request in batch)
+                self.latencies.extend(finished - request.submitted for request in batch)
+
+    def metrics(self):
+        """Queue depth and batch / latency statistics (seconds) of the last `history` requests."""
+        with self.condition:
+            queue_waits, latencies = list(self.queue_waits), list(self.latencies)
+            return {
+                "queue_depth": len(self.pending),
+                "running": self.running,
+                "requests": self.num_requests,
+                "batches": self.num_batches,
+                "errors": self.num_errors,
+                "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else None,
+                "queue_wait_p50": percentile(queue_waits, 0.5),
+                "queue_wait_p95": percentile(queue_waits, 0.95),
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+            }
+
+    def close(self):
+        """Stops the worker after the queued requests are served."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+class FakeGPU:
+    """
+    CPU stand-in for a pipeline to test the scheduler without a model: a call takes `batch_latency` seconds plus
+    `item_latency` per request, like a GPU that is underutilized at batch size 1, and returns the payloads.
+    """
+
+    def __init__(self, batch_latency=0.5, item_latency=0.1):
+        self.batch_latency = batch_latency
+        self.item_latency = item_latency
+        self.lock = threading.Lock()
+
+    def __call__(self, payloads):
+        # a single device, calls never overlap
+        with self.lock:
+            time.sleep(self.batch_latency + self.item_latency * len(payloads))
+        return payloads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the micro-batching scheduler with a fake GPU")
+    parser.add_argument("--num_clients", type=int, default=16)
+    parser.add_argument("--requests_per_client", type=int, default=4)
+    parser.add_argument("--num_keys", type=int, default=2, help="distinct resolution / steps combinations")
+    parser.add_argument("--max_batch_size", type=int, default=4)
+    parser.add_argument("--max_wait", type=float, default=0.1)
+    parser.add_argument("--batch_latency", type=float, default=0.5)
+    parser.add_argument("--item_latency", type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = MicroBatchServer(FakeGPU(args.batch_latency, args.item_latency), args.max_batch_size, args.max_wait)
+
+    def client(index):
+        for i in range(args.requests_per_client):
+            time.sleep(random.uniform(0, 1))
+            payload = (index, i)
+            assert server(random.randrange(args.num_keys), payload) == payload
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(args.num_clients) as executor:
+        list(executor.map(client, range(args.num_clients)))
+    elapsed = time.monotonic() - started
+    server.close()
+    print(f"{args.num_clients * args.requests_per_client} requests in {elapsed:.1f}s")
+    for name, value in server.metrics().items():
+        print(f"{name}: {value}")
@@ -0,0 +1,248 @@
+"""
+Single pass ingestion of raw captures. Every source video is decoded once by ffmpeg and each frame is fanned out to
+the clip encoder, the scene cut detector, the static clip check and the motion scorer, instead of decoding the video
+again in compress_video.py, scene_detect.py, PreProcessVideos.check_frames_same and the dataset motion filter.
+Writes the clips under `output_root` (mirroring the source folders) and a `video_json` manifest
+([{"video", "caption", ...}]) that VideoJsonDataset can train on directly.
+
+python -m utils.ingest --input_root raw/ --output_root clips/
+"""
+import os
+import json
+import argparse
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+from utils.video_sink import FFmpegSink
+
+try:
+    from psutil import cpu_count
+except:
+    from multiprocessing import cpu_count
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".flv", ".mjpeg", ".m4v", ".ts")
+SOURCE_MANIFEST = "manifest.json"
+
+
+def probe(video_path):
+    capture = cv2.VideoCapture(video_path)
+    try:
+        if not capture.isOpened():
+            raise RuntimeError(f"Could not open {video_path}")
+        return (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                capture.get(cv2.CAP_PROP_FPS) or 30.0)
+    finally:
+        capture.release()
+
+
+def scaled_size(width, height, short_side=512):
+    # the compress_video.py scale: short side to `short_side`, the long side rounded down to an even size
+    if width > height:
+        return int(width * short_side / height) // 2 * 2, short_side
+    return short_side, int(height * short_side / width) // 2 * 2
+
+
+def read_frames(video_path, width, height, threads=2):
+    """Decodes `video_path` once, scaled to `width` x `height`, as [height, width, 3] uint8 rgb frames."""
+    command = ["ffmpeg", "-loglevel", "error", "-threads", str(threads), "-i", video_path,
+               "-vf", f"scale={width}:{height}", "-map", "0:v:0", "-f", "rawvideo", "-pix_fmt", "rgb24", "-"]
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    frame_bytes = width * height * 3
+    try:
+        while True:
+            buffer = process.stdout.read(frame_bytes)
+            if len(buffer) < frame_bytes:
+                break
+            yield np.frombuffer(buffer, np.uint8).reshape(height, width, 3)
+        if process.wait() != 0:
+            error = process.stderr.read().decode(errors="replace")
+            raise RuntimeError(f"ffmpeg failed on {video_path}: {error[-2000:]}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+
+class Clip:
+    """A scene being encoded, with the motion statistics of its frames."""
+
+    def __init__(self, path, fps, start_frame):
+        self.path = path
+        # keeps the extension, ffmpeg picks the container from it
+        self.tmp_path = os.path.splitext(path)[0] + ".part.mp4"
+        self.sink = FFmpegSink(self.tmp_path, fps=fps)
+        self.start_frame = start_frame
+        self.num_frames = 0
+        self.motion = 0.0
+
+    def write(self, frame, score):
+        self.sink.write(frame[None])
+        if self.num_frames > 0:
+            self.motion += score
+        self.num_frames += 1
+
+    def finish(self, keep):
+        self.sink.close()
+        if keep:
+            os.replace(self.tmp_path, self.path)
+        elif os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def motion_score(self):
+        # same scale as utils.common.calculate_motion_score, measured on the detection frames
+        return round(self.motion / max(1, self.num_frames - 1) * 10)
+
+
+def content_score(hsv, last_hsv):
+    """Mean hue / saturation / value distance of two frames, the ContentDetector and motion score metric."""
+    return float(np.abs(hsv.astype(np.int16) - last_hsv).mean())
+
+
+def ingest_video(video_path, output_dir, caption, short_side=512, detect_width=256, threshold=27.0,
+                 min_seconds=2.0, max_seconds=60.0, min_scene_frames=15, threads=2):
+    """
+    Splits `video_path` into scene clips in `output_dir` in one decode and returns their manifest entries.
+    A cut is placed where the content score of consecutive frames exceeds `threshold` (and the scene has at least
+    `min_scene_frames`), scenes are also cut at `max_seconds`. Clips shorter than `min_seconds` and static clips,
+    whose frames never change at detection resolution, are dropped.
+    """
+    width, height, fps = probe(video_path)
+    width, height = scaled_size(width, height, short_side)
+    detect_size = (detect_width, max(1, round(height * detect_width / width)))
+    max_frames = int(max_seconds * fps)
+    os.makedirs(output_dir, exist_ok=True)
+
+    entries = []
+    clip = None
+    last_hsv = None
+
+    def finish(clip):
+        keep = clip.num_frames >= min_seconds * fps and clip.motion > 0
+        clip.finish(keep)
+        if keep:
+            entries.append({
+                "video": clip.path,
+                "caption": caption,
+                "source": video_path,
+                "start_frame": clip.start_frame,
+                "num_frames": clip.num_frames,
+                "fps": fps,
+                "motion": clip.motion_score(),
+            })
+
+    frames = read_frames(video_path, width, height, threads)
+    try:
+        for index, frame in enumerate(frames):
+            hsv = cv2.cvtColor(cv2.resize(frame, detect_size, interpolation=cv2.INTER_AREA), cv2.COLOR_RGB2HSV)
+            score = 0.0 if last_hsv is None else content_score(hsv, last_hsv)
+            last_hsv = hsv
+
+            if clip is not None and ((score >= threshold and clip.num_frames >= min_scene_frames)
+                                     or clip.num_frames >= max_frames):
+                done, clip = clip, None
+                finish(done)
+            if clip is None:
+                clip = Clip(os.path.join(output_dir, f"clip_{index:07d}.mp4"), fps, index)
+                score = 0.0
+            clip.write(frame, score)
+
+        if clip is not None:
+            done, clip = clip, None
+            finish(done)
+    except BaseException:
+        # stop the encoder of the open clip and drop its .part.mp4, the decoder is stopped by closing `frames`
+        if clip is not None:
+            clip.finish(False)
+        raise
+    finally:
+        frames.close()
+    return entries
+
+
+def read_caption(video_path, fallback_prompt):
+    caption_path = os.path.splitext(video_path)[0] + ".txt"
+    if os.path.exists(caption_path):
+        with open(caption_path, "r") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        if lines:
+            return lines[0]
+    return fallback_prompt
+
+
+def ingest_source(video_path, output_dir, fallback_prompt, **kwargs):
+    entries = ingest_video(video_path, output_dir, read_caption(video_path, fallback_prompt), **kwargs)
+    # the per source manifest is written last and marks the source as done for a resumed run
+    tmp_path = os.path.join(output_dir, SOURCE_MANIFEST + ".part")
+    with open(tmp_path, "w") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, os.path.join(output_dir, SOURCE_MANIFEST))
+    return entries
+
+
+def ingest(input_root, output_root, manifest_path=None, fallback_prompt="", ffmpeg_threads=2, num_workers=None,
+           **kwargs):
+    sources = []
+    for root, dirs, files in os.walk(input_root):
+        for file_name in sorted(files):
+            if file_name.lower().endswith(VIDEO_EXTENSIONS):
+                video_path = os.path.join(root, file_name)
+                output_dir = os.path.join(output_root, os.path.splitext(os.path.relpath(video_path, input_root))[0])
+                sources.append((video_path, output_dir))
+
+    # ffmpeg decode threads x workers sized to the machine, the python side of a worker uses about one more core
+    num_workers = num_workers or max(1, cpu_count() // (ffmpeg_threads + 1))
+    manifest = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor, tqdm(total=len(sources), desc="Ingest") as progress:
+        futures = {}
+        for video_path, output_dir in sources:
+            done_path = os.path.join(output_dir, SOURCE_MANIFEST)
+            if os.path.exists(done_path):
+                with open(done_path) as f:
+                    manifest += json.load(f)
+                progress.update(1)
+                continue
+            futures[executor.submit(ingest_source, video_path, output_dir, fallback_prompt, threads=ffmpeg_threads,
+                                    **kwargs)] = video_path
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                video_path = futures.pop(future)
+                try:
+                    manifest += future.result()
+                except Exception as e:
+                    tqdm.write(f"ingest fail: {video_path}\n{e}")
+                progress.update(1)
+
+    # paths relative to the output root, which is the `video_dir` of the video_json dataset
+    for entry in manifest:
+        entry["video"] = os.path.relpath(entry["video"], output_root)
+    manifest_path = manifest_path or os.path.join(output_root, "train.json")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    print(f"{len(manifest)} clips from {len(sources)} videos, manifest saved to {manifest_path}")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Transcode, scene split, filter and index videos in one decode")
+    parser.add_argument("--input_root", type=str, required=True)
+    parser.add_argument("--output_root", type=str, required=True)
+    parser.add_argument("--manifest_path", type=str, default=None, help="defaults to <output_root>/train.json")
+    parser.add_argument("--fallback_prompt", type=str, default="", help="caption of videos without a .txt file")
+    parser.add_argument("--short_side", type=int, default=512)
+    parser.add_argument("--detect_width", type=int, default=256)
+    parser.add_argument("--threshold", type=float, default=27.0)
+    parser.add_argument("--min_seconds", type=float, default=2.0)
+    parser.add_argument("--max_seconds", type=float, default=60.0)
+    parser.add_argument("--ffmpeg_threads", type=int, default=2)
+    parser.add_argument("--num_workers", type=int, default=None)
+    args = parser.parse_args()
+
+    assert args.input_root != args.output_root
+    ingest(**vars(args))
@@ -16,7 +16,8 @@ Apache License 2.0: https://github.com/advimman/lama/blob/main/LICENSE
 """
 
 import os
-import sys
+import argparse
+from functools import lru_cache
 from urllib.request import urlretrieve
 
 import torch
@@ -27,11 +28,12 @@ from torch.nn import functional as F
 from torchvision.transforms.functional import to_tensor
 from tqdm import tqdm
 
-from train import export_to_video
+from utils.video_sink import BackgroundSink, FFmpegSink
 
 
 LAMA_URL = "https://huggingface.co/akhaliq/lama/resolve/main/best.ckpt"
 LAMA_PATH = "models/lama.ckpt"
+MASK_PATH = "./utils/mask.png"
 
 
 def download_progress(t):
@@ -71,23 +73,24 @@ class FourierUnit(nn.Module):
         batch = x.shape[0]
 
         # (batch, c, h, w/2+1, 2)
+        # the ffts run in float32, half precision ffts only support power of two sizes
         fft_dim = (-2, -1)
-        ffted = torch.fft.rfftn(x, dim=fft_dim, norm="ortho")
+        ffted = torch.fft.rfftn(x.float(), dim=fft_dim, norm="ortho")
         ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
         ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()  # (batch, c, 2, h, w/2+1)
-        ffted = ffted.view((batch, -1) + ffted.size()[3:])
+        ffted = ffted.view((batch, -1) + ffted.size()[3:]).to(x.dtype)
 
         ffted = self.conv_layer(ffted)  # (batch, c*2, h, w/2+1)
         ffted = self.relu(self.bn(ffted))
 
         # (batch,c, t, h, w/2+1, 2)
         ffted = ffted.view((batch, -1, 2) + ffted.size()[2:]).permute(0, 1, 3, 4, 2).contiguous()
-        ffted = torch.complex(ffted[..., 0], ffted[..., 1])
+        ffted = torch.complex(ffted[..., 0].float(), ffted[..., 1].float())
 
         ifft_shape_slice = x.shape[-2:]
         output = torch.fft.irfftn(ffted, s=ifft_shape_slice, dim=fft_dim, norm="ortho")
 
-        return output
+        return output.to(x.dtype)
 
 
 class SpectralTransform(nn.Module):
@@ -309,42 +312,262 @@ class LargeMaskInpainting(nn.Module):
         return inpainted
 
 
-@torch.inference_mode()
-def inpaint_watermark(imgs):
-    if not os.path.exists(LAMA_PATH):
-        download(LAMA_URL, LAMA_PATH)
+def estimate_inpaint_memory(height, width, element_size=4):
+    """
+    Approximate peak activation bytes of inpainting one frame of `height` x `width` pixels: the full resolution
+    feature maps of the first and last layers dominate, the downsampled resnet blocks are a fraction of them.
+    """
+    return element_size * height * width * 64 * 6
 
-    mask = to_tensor(Image.open("./utils/mask.png").convert("L")).unsqueeze(0).to(imgs.device)
-    if mask.shape[-1] != imgs.shape[-1]:
-        mask = F.interpolate(mask, size=(imgs.shape[2], imgs.shape[3]), mode="nearest")
-    mask = mask.expand(imgs.shape[0], 1, mask.shape[2], mask.shape[3])
 
-    model = LargeMaskInpainting().to(imgs.device)
-    state_dict = torch.load(LAMA_PATH, map_location=imgs.device)["state_dict"]
+def load_lama(device="cpu", dtype=torch.float32, checkpoint_path=LAMA_PATH):
+    if not os.path.exists(checkpoint_path):
+        os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+        download(LAMA_URL, checkpoint_path)
+    state_dict = torch.load(checkpoint_path, map_location="cpu")["state_dict"]
     g_dict = {k.replace("generator.", ""): v for k, v in state_dict.items() if k.startswith("generator")}
+    model = LargeMaskInpainting()
     model.load_state_dict(g_dict)
-
-    inpainted = model.forward(imgs, mask)
-
-    return inpainted
-
-
-if __name__ == "__main__":
+    return model.eval().requires_grad_(False).to(device, dtype)
+
+
+def mask_window(mask, padding=64, multiple=8):
+    """
+    (top, bottom, left, right) of a window around the nonzero pixels of the [1, 1, h, w] `mask`, grown by `padding`
+    pixels of context on every side and to a multiple of `multiple` (the model downsamples 3 times), shifted to stay
+    inside the frame. None if the mask is empty.
+    """
+    ys, xs = torch.nonzero(mask[0, 0] > 0, as_tuple=True)
+    if len(ys) == 0:
+        return None
+
+    def span(low, high, size):
+        low, high = max(0, low - padding), min(size, high + padding)
+        length = min(size, -(-(high - low) // multiple) * multiple)
+        low = max(0, min(low, size - length))
+        return low, low + length
+
+    top, bottom = span(ys.min().item(), ys.max().item() + 1, mask.shape[-2])
+    left, right = span(xs.min().item(), xs.max().item() + 1, mask.shape[-1])
+    return top, bottom, left, right
+
+
+class WatermarkInpainter:
+    """
+    Removes the watermark of `mask_path` from videos. The model is loaded once and the mask is resized once per
+    frame size, so one inpainter can clean a whole dataset.
+    Frames are inpainted `chunk_size` at a time, when it is not given it is derived from the `max_memory` byte
+    budget, otherwise all frames of a call are one batch.
+    With `roi` only a window of `roi_padding` pixels around the bounding box of the mask goes through the model and
+    is pasted back, so the cost scales with the watermark instead of the frame. Pixels outside the mask are kept
+    as they are either way; inside the mask the result differs slightly from a full frame pass, as the fourier
+    convolutions only see the context of the window.
+    """
+
+    def __init__(self, device=None, dtype=torch.float32, mask_path=MASK_PATH, checkpoint_path=LAMA_PATH,
+                 chunk_size=None, max_memory=None, roi=False, roi_padding=64):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.model = load_lama(self.device, dtype, checkpoint_path)
+        self.mask_image = to_tensor(Image.open(mask_path).convert("L")).unsqueeze(0)
+        self.chunk_size = chunk_size
+        self.max_memory = max_memory
+        self.roi = roi
+        self.roi_padding = roi_padding
+        self.masks = {}
+
+    def mask(self, height, width, roi_padding=False):
+        """
+        The mask resized to the frame and the window of the frame that is inpainted, or None for no window.
+        `roi_padding` overrides the window of the inpainter, None for the full frame.
+        """
+        if roi_padding is False:
+            roi_padding = self.roi_padding if self.roi else None
+        if (height, width, roi_padding) not in self.masks:
+            mask = self.mask_image.to(self.device, self.dtype)
+            if mask.shape[-2:] != (height, width):
+                mask = F.interpolate(mask, size=(height, width), mode="nearest")
+            window = mask_window(mask, roi_padding) if roi_padding is not None else (0, height, 0, width)
+            if window is not None:
+                top, bottom, left, right = window
+                mask = mask[:, :, top:bottom, left:right]
+            self.masks[(height, width, roi_padding)] = mask, window
+        return self.masks[(height, width, roi_padding)]
+
+    def frames_per_chunk(self, num_frames, height, width, chunk_size=None, roi_padding=False):
+        chunk_size = chunk_size if chunk_size is not None else self.chunk_size
+        if chunk_size is not None:
+            return chunk_size
+        if self.max_memory is not None:
+            mask, window = self.mask(height, width, roi_padding)
+            frame_memory = estimate_inpaint_memory(*mask.shape[-2:], torch.finfo(self.dtype).bits // 8)
+            return max(1, self.max_memory // frame_memory)
+        return max(1, num_frames)
+
+    @torch.inference_mode()
+    def inpaint(self, imgs, chunk_size=None, roi_padding=False):
+        """
+        :param imgs: [f, c, h, w] frames in [0, 1], inpainted in chunks and returned on their own device.
+        :param chunk_size: frames per batch of this call instead of the inpainter's `chunk_size` / `max_memory`.
+        :param roi_padding: window of this call instead of the inpainter's `roi` / `roi_padding`, None for the full
+            frame.
+        """
+        f, _, h, w = imgs.shape
+        mask, window = self.mask(h, w, roi_padding)
+        if window is None:
+            return imgs
+        top, bottom, left, right = window
+        full_frame = window == (0, h, 0, w)
+        chunk_size = self.frames_per_chunk(f, h, w, chunk_size, roi_padding)
+        inpainted = []
+        for i in range(0, f, chunk_size):
+            chunk = imgs[i: i + chunk_size, :, top:bottom, left:right].to(self.device, self.dtype)
+            pred = self.model(chunk, mask.expand(len(chunk), -1, -1, -1)).to(imgs.device, imgs.dtype)
+            if not full_frame:
+                frames = imgs[i: i + chunk_size].clone()
+                frames[:, :, top:bottom, left:right] = pred
+                pred = frames
+            inpainted.append(pred)
+        return torch.cat(inpainted)
+
+    @torch.inference_mode()
+    def roi_error(self, imgs, paddings):
+        """
+        {padding: (max, mean)} absolute difference inside the mask between the `roi` result at every padding of
+        `paddings` and the full frame result for the [f, c, h, w] frames in [0, 1] `imgs`.
+        """
+        f, _, h, w = imgs.shape
+        full = self.inpaint(imgs, roi_padding=None)
+        inside = self.mask(h, w, roi_padding=None)[0].to(imgs.device).expand_as(full) > 0
+        errors = {}
+        for padding in paddings:
+            difference = (self.inpaint(imgs, roi_padding=padding) - full).abs()[inside].float()
+            errors[padding] = (difference.max().item(), difference.mean().item()) if difference.numel() else (0.0, 0.0)
+        return errors
+
+    def calibrate_roi_padding(self, imgs, paddings=(16, 32, 64, 128, 256), tolerance=2 / 255):
+        """
+        The smallest padding of `paddings` whose `roi_error` stays within `tolerance` everywhere inside the mask,
+        None (the full frame) if none does, and the errors of all paddings.
+        """
+        errors = self.roi_error(imgs, paddings)
+        chosen = next((padding for padding in sorted(errors) if errors[padding][0] <= tolerance), None)
+        return chosen, errors
+
+    @torch.inference_mode()
+    def inpaint_frames(self, frames):
+        """
+        :param frames: iterable of [f, h, w, c] uint8 frame chunks (torch or numpy).
+        :return: generator of the inpainted [f, h, w, c] uint8 numpy chunks, converted on the device.
+        """
+        for frames_chunk in frames:
+            frames_chunk = torch.as_tensor(frames_chunk).to(self.device, non_blocking=True)
+            imgs = rearrange(frames_chunk, "f h w c -> f c h w").to(self.dtype).div(255)
+            inpainted = self.inpaint(imgs)
+            yield rearrange(inpainted, "f c h w -> f h w c").float().clamp(0, 1).mul(255).round().byte().cpu().numpy()
+
+    def inpaint_video(self, video_path, out_path, crf=18):
+        """Streams `video_path` through the model: decoded, inpainted and encoded one chunk at a time."""
+        import decord
+
+        vr = decord.VideoReader(video_path)
+        height, width = vr[0].shape[:2]
+        chunk_size = self.frames_per_chunk(len(vr), height, width)
+
+        def read_chunks():
+            for i in range(0, len(vr), chunk_size):
+                yield vr.get_batch(list(range(i, min(i + chunk_size, len(vr))))).asnumpy()
+
+        # encoding of a chunk overlaps with decoding and inpainting of the next one. Written next to `out_path` and
+        # renamed when complete, an interrupted batch run never leaves a truncated video behind
+        tmp_path = os.path.splitext(out_path)[0] + ".part.mp4"
+        sink = BackgroundSink(FFmpegSink(tmp_path, fps=vr.get_avg_fps(), crf=crf))
+        try:
+            for frames in self.inpaint_frames(read_chunks()):
+                sink.write(frames)
+        finally:
+            sink.close()
+        os.replace(tmp_path, out_path)
+        return out_path
+
+
+@lru_cache(maxsize=None)
+def get_inpainter(device, dtype=torch.float32, roi=False):
+    return WatermarkInpainter(device, dtype, roi=roi)
+
+
+def inpaint_watermark(imgs, chunk_size=None, roi=False):
+    """:param imgs: [f, c, h, w] frames in [0, 1] with the watermark of `MASK_PATH`."""
+    # the inpainter is shared by all callers, the chunk size is only an argument of this call
+    return get_inpainter(imgs.device, roi=roi).inpaint(imgs, chunk_size)
+
+
+def list_videos(path):
+    if os.path.isfile(path):
+        return [path]
+    return sorted(os.path.join(root, file_name) for root, _, files in os.walk(path)
+                  for file_name in files
+                  if file_name.endswith(".mp4") and not file_name.endswith((" inpainted.mp4", ".part.mp4")))
+
+
+def read_frames(video_path, num_frames):
+    """The first `num_frames` frames of `video_path` as [f, c, h, w] floats in [0, 1]."""
     import decord
 
-    decord.bridge.set_bridge("torch")
-
-    if len(sys.argv) < 2:
-        print("Usage: python -m utils.lama <path/to/video>")
-        sys.exit(1)
-
-    video_path = sys.argv[1]
-    out_path = video_path.replace(".mp4", " inpainted.mp4")
-
     vr = decord.VideoReader(video_path)
-    fps = vr.get_avg_fps()
-    video = rearrange(vr[:], "f h w c -> f c h w").div(255)
+    frames = torch.as_tensor(vr.get_batch(list(range(min(num_frames, len(vr))))).asnumpy())
+    return rearrange(frames, "f h w c -> f c h w").float().div(255)
 
-    inpainted = inpaint_watermark(video)
-    inpainted = rearrange(inpainted, "f c h w -> f h w c").clamp(0, 1).mul(255).byte().cpu().numpy()
-    export_to_video(inpainted, out_path, fps)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Remove the watermark of utils/mask.png from videos")
+    parser.add_argument("path", type=str, help="a video or a folder of videos")
+    parser.add_argument("--output_dir", type=str, default=None,
+                        help="defaults to writing '<name> inpainted.mp4' next to every video")
+    parser.add_argument("--device", type=str, default=None, help="defaults to cuda if available")
+    parser.add_argument("--half", action="store_true", help="run the model in float16")
+    parser.add_argument("--chunk_size", type=int, default=None, help="frames inpainted per batch")
+    parser.add_argument("--max_memory", type=float, default=4.0, help="GiB budget of a batch without --chunk_size")
+    parser.add_argument("--roi", action="store_true", help="only inpaint a window around the watermark")
+    parser.add_argument("--roi_padding", type=int, default=None,
+                        help="pixels of context around the watermark, by default the smallest padding whose result "
+                             "inside the mask is within --roi_tolerance of a full frame pass on the first video")
+    parser.add_argument("--roi_tolerance", type=float, default=2.0,
+                        help="largest difference to a full frame pass inside the mask, in 8 bit levels")
+    parser.add_argument("--check_roi", action="store_true",
+                        help="only report the difference of --roi to a full frame pass inside the mask per padding")
+    parser.add_argument("--check_frames", type=int, default=8, help="frames of the first video the roi is checked on")
+    args = parser.parse_args()
+
+    inpainter = WatermarkInpainter(args.device, torch.float16 if args.half else torch.float32,
+                                   chunk_size=args.chunk_size, max_memory=int(args.max_memory * 1024 ** 3),
+                                   roi=args.roi, roi_padding=args.roi_padding)
+    videos = list_videos(args.path)
+    if videos and (args.check_roi or (args.roi and args.roi_padding is None)):
+        paddings = sorted({16, 32, 64, 128, 256} | ({args.roi_padding} if args.roi_padding is not None else set()))
+        padding, errors = inpainter.calibrate_roi_padding(read_frames(videos[0], args.check_frames), paddings,
+                                                          args.roi_tolerance / 255)
+        for p, (max_error, mean_error) in errors.items():
+            print(f"roi_padding {p:4d}: max {max_error * 255:.2f} mean {mean_error * 255:.3f} 8 bit levels "
+                  f"inside the mask")
+        if args.check_roi:
+            raise SystemExit
+        print(f"roi_padding {padding}" if padding is not None else "no padding is within the tolerance, "
+              "inpainting full frames")
+        inpainter.roi = padding is not None
+        inpainter.roi_padding = padding
+    for video_path in tqdm(videos):
+        if args.output_dir is None:
+            out_path = video_path.replace(".mp4", " inpainted.mp4")
+        else:
+            out_path = os.path.join(args.output_dir, os.path.relpath(video_path, args.path)
+                                    if os.path.isdir(args.path) else os.path.basename(video_path))
+            os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        if os.path.exists(out_path):
+            continue
+        try:
+            inpainter.inpaint_video(video_path, out_path)
+        except Exception as e:
+            tqdm.write(f"inpaint fail: {video_path}\n{e}")
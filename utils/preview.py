@@ -0,0 +1,94 @@
+"""
+Cheap previews of a generation in progress, for the Gradio apps: the x0 estimate of the scheduler is projected from
+the 4 latent channels to rgb with a fixed linear map instead of a VAE decode, every few denoising steps.
+"""
+import queue
+import threading
+
+import numpy as np
+import torch
+
+from utils.inference_server import RequestCancelled
+
+# approximate rgb of the 4 (scaled) latent channels of the SD VAE, which SVD encodes its frames with as well
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.2616, -0.7177],
+]
+
+
+def latents_to_rgb(latents, channel_dim=1):
+    """
+    :param latents: scaled latents with 4 channels at `channel_dim`, [b, c, f, h, w] (channel_dim 1) or
+        [b, f, c, h, w] (channel_dim 2).
+    :return: [b, f, h, w, 3] uint8 numpy frames at latent resolution.
+    """
+    latents = latents.movedim(channel_dim, -1).float()
+    rgb = latents @ torch.tensor(LATENT_RGB_FACTORS, device=latents.device)
+    return ((rgb + 1) / 2).clamp(0, 1).mul(255).round().to(torch.uint8).cpu().numpy()
+
+
+def preview_grid(frames, max_frames=8):
+    """Up to `max_frames` evenly spaced frames of [f, h, w, 3] side by side."""
+    index = np.linspace(0, len(frames) - 1, min(max_frames, len(frames))).round().astype(int)
+    return np.concatenate(list(frames[index]), axis=1)
+
+
+class PreviewCallback:
+    """
+    `callback_on_step_end` of the video pipelines that hands `on_preview(step, frames)` a [b, f, h, w, 3] preview
+    every `every` steps (0 disables them) and aborts the generation with `RequestCancelled` once `should_stop()`.
+    The preview uses the `denoised` x0 estimate when the pipeline exposes it, the current latents otherwise.
+    """
+
+    tensor_inputs = ["latents", "denoised"]
+
+    def __init__(self, every, on_preview, should_stop=None, channel_dim=1):
+        self.every = every
+        self.on_preview = on_preview
+        self.should_stop = should_stop
+        self.channel_dim = channel_dim
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        if self.should_stop is not None and self.should_stop():
+            raise RequestCancelled("Generation cancelled")
+        if self.every and (step + 1) % self.every == 0:
+            latents = callback_kwargs.get("denoised")
+            if latents is None:
+                latents = callback_kwargs["latents"]
+            self.on_preview(step, latents_to_rgb(latents, self.channel_dim))
+        return {}
+
+
+def batch_preview_callback(jobs, every, channel_dim=1):
+    """
+    PreviewCallback for a micro-batch of app requests: the preview of every request is put on its "previews" queue
+    and the batch stops once all its requests set their "cancel" event.
+    """
+    def on_preview(step, frames):
+        for job, job_frames in zip(jobs, frames):
+            job["previews"].put((step, preview_grid(job_frames)))
+
+    return PreviewCallback(every, on_preview, lambda: all(job["cancel"].is_set() for job in jobs), channel_dim)
+
+
+def stream_request(server, key, payload, poll=0.1):
+    """
+    Submits `payload` to the `MicroBatchServer` with a "previews" queue and a "cancel" event, yields
+    (preview, None) for every preview and finally (None, result). Closing the generator early, e.g. when the
+    Gradio event is cancelled, cancels the request.
+    """
+    payload = {**payload, "previews": queue.Queue(), "cancel": threading.Event()}
+    future = server.submit(key, payload)
+    try:
+        while not future.done():
+            try:
+                yield payload["previews"].get(timeout=poll)[1], None
+            except queue.Empty:
+                pass
+        yield None, future.result()
+    finally:
+        future.cancel()
+        payload["cancel"].set()
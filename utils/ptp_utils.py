@@ -14,6 +14,7 @@
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 from PIL import Image, ImageDraw, ImageFont
 import cv2
@@ -193,7 +194,11 @@ class AttentionControl(abc.ABC):
         #self.reset()
         if self.cur_att_layer >= self.num_uncond_att_layers:
             h = attn.shape[0]   
-            attn[h // 2:] = self.forward(attn[h // 2:], is_cross, place_in_unet) 
+            cond_attn = attn[h // 2:]
+            edited = self.forward(cond_attn, is_cross, place_in_unet)
+            # stores return the maps unchanged, copying them onto themselves would only cost a kernel
+            if edited is not cond_attn:
+                attn[h // 2:] = edited
         self.cur_att_layer += 1
         if self.cur_att_layer == self.num_att_layers + self.num_uncond_att_layers:
             self.cur_att_layer = 0
@@ -212,41 +217,68 @@ class AttentionControl(abc.ABC):
 
 
 class AttentionStore(AttentionControl):
+    """
+    Average attention maps over the denoising steps, for maps with at most `max_size` query tokens.
+    Every layer adds its maps in place to one float32 running sum per (place in unet, cross / self, resolution),
+    allocated on the device of the maps the first time the resolution shows up, so memory doesn't grow with the
+    number of layers or steps and there are no python lists of small tensors.
+    With `batch_size` (prompts, times frames for video unets) the maps are averaged over heads before they are
+    added, `[batch_size * heads, q, k] -> [batch_size, q, k]`. With `downsample` the query axis of the maps, seen as
+    a `aspect_ratio` (width / height) grid, is average pooled by that factor.
+    """
 
     @staticmethod
     def get_empty_store():
-        return {"down_cross": [], "mid_cross": [], "up_cross": [],
-                "down_self": [],  "mid_self": [],  "up_self": []}
+        return {"down_cross": {}, "mid_cross": {}, "up_cross": {},
+                "down_self": {},  "mid_self": {},  "up_self": {}}
+
+    def query_grid(self, num_queries):
+        height = max(1, round((num_queries / self.aspect_ratio) ** 0.5))
+        return height, num_queries // height
+
+    def reduce(self, attn):
+        if self.batch_size is not None:
+            attn = attn.reshape(self.batch_size, -1, *attn.shape[1:]).mean(1)
+        if self.downsample > 1:
+            height, width = self.query_grid(attn.shape[1])
+            attn = attn.transpose(1, 2).reshape(-1, attn.shape[2], height, width)
+            attn = F.avg_pool2d(attn, self.downsample, ceil_mode=True)
+            attn = attn.flatten(2).transpose(1, 2)
+        return attn
 
     def forward(self, attn, is_cross: bool, place_in_unet: str):
         key = f"{place_in_unet}_{'cross' if is_cross else 'self'}"
-        if attn.shape[1] <= 32 ** 2:  # avoid memory overhead
-            self.step_store[key].append(attn)
+        if attn.shape[1] <= self.max_size:  # avoid memory overhead
+            resolution = attn.shape[1]
+            with torch.no_grad():
+                attn_sum = self.reduce(attn)
+            store = self.attention_store[key]
+            if resolution not in store:
+                store[resolution] = torch.zeros(attn_sum.shape, dtype=torch.float32, device=attn_sum.device)
+                self.layer_counts[(key, resolution)] = 0
+            store[resolution].add_(attn_sum)
+            self.layer_counts[(key, resolution)] += 1
         return attn
 
-    def between_steps(self):
-        if len(self.attention_store) == 0:
-            self.attention_store = self.step_store
-        else:
-            for key in self.attention_store:
-                for i in range(len(self.attention_store[key])):
-                    self.attention_store[key][i] += self.step_store[key][i]
-        self.step_store = self.get_empty_store()
-
     def get_average_attention(self):
-        average_attention = {key: [item / self.cur_step for item in self.attention_store[key]] for key in self.attention_store}
-        return average_attention
-
+        """For every key the maps of each resolution, averaged over its layers and the steps so far."""
+        return {key: [attn_sum / self.layer_counts[(key, resolution)]
+                      for resolution, attn_sum in self.attention_store[key].items()]
+                for key in self.attention_store}
 
     def reset(self):
         super(AttentionStore, self).reset()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.attention_store = self.get_empty_store()
+        self.layer_counts = {}
 
-    def __init__(self):
+    def __init__(self, max_size=32 ** 2, batch_size=None, downsample=1, aspect_ratio=1.0):
         super(AttentionStore, self).__init__()
-        self.step_store = self.get_empty_store()
-        self.attention_store = {}
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.downsample = downsample
+        self.aspect_ratio = aspect_ratio
+        self.attention_store = self.get_empty_store()
+        self.layer_counts = {}
         
 
 def load_512(image_path, left=0, right=0, top=0, bottom=0):
@@ -6,19 +6,63 @@ conda activate XPretrain
 import os
 import argparse
 import logging
-from scenedetect import detect, AdaptiveDetector, split_video_ffmpeg, ContentDetector
-from concurrent.futures import ProcessPoolExecutor, as_completed
-import fcntl
-
-
-# file to record processed videos
-logfile_path = "./log/tmp_processed_videos_adaptive.txt"
-
-def process_video(video_path):
+import sqlite3
+import time
+from scenedetect import open_video, SceneManager, AdaptiveDetector, split_video_ffmpeg, ContentDetector
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+
+# index of processed videos, lets an interrupted run resume
+index_path = "./log/processed_videos_adaptive.sqlite"
+# append-only list written by earlier versions, imported into the index once
+legacy_logfile_path = "./log/tmp_processed_videos_adaptive.txt"
+
+
+class ProcessedIndex:
+    """
+    Status of every video of a run, kept in sqlite so a resumed run looks videos up instead of loading a text log.
+    Only the main process writes to it, the workers just return their results.
+    """
+
+    def __init__(self, path, legacy_logfile=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS videos "
+                        "(name TEXT PRIMARY KEY, status TEXT, num_scenes INTEGER, error TEXT, updated REAL)")
+        if legacy_logfile is not None and os.path.exists(legacy_logfile):
+            with open(legacy_logfile, 'r') as logfile:
+                names = [(name, time.time()) for name in logfile.read().splitlines() if name]
+            self.db.executemany("INSERT OR IGNORE INTO videos (name, status, updated) VALUES (?, 'done', ?)", names)
+        self.db.commit()
+
+    def done(self):
+        return {name for name, in self.db.execute("SELECT name FROM videos WHERE status = 'done'")}
+
+    def record(self, name, status, num_scenes=None, error=None):
+        self.db.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)",
+                        (name, status, num_scenes, error, time.time()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def detect_scenes(video_path, downscale_width=256, frame_skip=0):
+    video = open_video(video_path)
+    scene_manager = SceneManager()
+    # detect on frames downscaled to about `downscale_width`, the cuts don't need full resolution
+    scene_manager.auto_downscale = False
+    scene_manager.downscale = max(1, video.frame_size[0] // downscale_width)
+    scene_manager.add_detector(AdaptiveDetector(adaptive_threshold=0.1))  # 1.0
+    # scene_manager.add_detector(ContentDetector())
+    scene_manager.detect_scenes(video, frame_skip=frame_skip)
+    return scene_manager.get_scene_list()
+
+
+def process_video(video_path, downscale_width=256, frame_skip=0):
     # start/end times of all scenes found in the video
     print("detect scene", video_path)
-    scene_list = detect(video_path, AdaptiveDetector(adaptive_threshold=0.1)) # 1.0
-    # scene_list = detect(video_path, ContentDetector())
+    scene_list = detect_scenes(video_path, downscale_width, frame_skip)
     # filter clips <= 3.0s
     scene_list = list(filter(lambda scene : 60.0 >=(scene[1].get_seconds()-scene[0].get_seconds()) >= 2.0, scene_list))
     num_scene = len(scene_list)
@@ -28,15 +72,9 @@ def process_video(video_path):
 
     # save clips into current dir
     split_video_ffmpeg(video_path, scene_list, show_progress=True)
+    return num_scene
 
 
-
-def process_and_log(video_path):
-    process_video(video_path)
-    with open(logfile_path, 'a') as logfile:
-        logfile.write(os.path.basename(video_path) + '\n')
-        logfile.flush()
-
 def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
@@ -45,71 +83,80 @@ def setup_logging():
     )
 
 
-def fun(folder_path, vid_format='mp4'):
-    logging.info(f'supported video format: {vid_format}')
+def list_videos(folder_path, vid_formats):
+    # a single scan of the folder for all formats
+    suffixes = tuple(f'.{vid_format}' for vid_format in vid_formats)
+    with os.scandir(folder_path) as entries:
+        return sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith(suffixes))
 
-    file_list = os.listdir(folder_path)
-    file_list = list(filter(lambda fn: fn.endswith(f'.{vid_format}'), file_list))
-    
-    logging.info(f'total videos: {len(file_list)}')
-    logging.info('output videos will be saved into current dir.')
-
-    # 读取已处理过的文件列表
-    processed_files = set()
-    if os.path.exists(logfile_path):
-        with open(logfile_path, 'r') as logfile:
-            processed_files = set(logfile.read().splitlines())
 
-    # processed_files = ()
-    # lock = threading.Lock()
+def fun(folder_path, vid_formats=('mp4', 'mkv', 'avi'), max_workers=8, max_in_flight=None, downscale_width=256,
+        frame_skip=0):
+    logging.info(f'supported video format: {vid_formats}')
 
+    file_list = list_videos(folder_path, vid_formats)
 
-    with ProcessPoolExecutor(max_workers=8) as executor:
-        futures = []
+    logging.info(f'total videos: {len(file_list)}')
+    logging.info('output videos will be saved into current dir.')
 
-        for i, file_name in enumerate(file_list):
-            if(i % 100 == 0):
-                logging.info(f'done processing {i} videos')
-            if(file_name in processed_files):
-                logging.info(f'{file_name} processed before, ignored...')
-                continue
-            if file_name.endswith(f".{vid_format}"):
+    # 读取已处理过的文件列表
+    index = ProcessedIndex(index_path, legacy_logfile=legacy_logfile_path)
+    processed_files = index.done()
+    pending = [file_name for file_name in file_list if file_name not in processed_files]
+    logging.info(f'{len(file_list) - len(pending)} videos processed before, ignored')
+
+    # keep every worker busy but bound the queued work, a new video is submitted as soon as any one finishes
+    max_in_flight = max_in_flight or 2 * max_workers
+    num_done = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        pending = iter(pending)
+        while True:
+            for file_name in pending:
                 video_path = os.path.join(folder_path, file_name)
                 logging.info(f'processing video {file_name}')
-                # 提交视频处理任务给线程池，并将Future对象存储到列表中
-                future = executor.submit(process_and_log, video_path)
-                futures.append(future)
-
-                # 避免短时间提交过多任务导致内存不足
-                if len(futures) >= 24:
-                    # 等待最早完成的任务完成
-                    for completed_future in as_completed(futures):
-                        completed_future.result()
-                    # 清空已完成的任务列表
-                    futures.clear()
-
-        # 等待剩余的任务完成
-        for completed_future in as_completed(futures):
-            completed_future.result()
+                in_flight[executor.submit(process_video, video_path, downscale_width, frame_skip)] = file_name
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                file_name = in_flight.pop(future)
+                try:
+                    index.record(file_name, 'done', num_scenes=future.result())
+                except Exception as e:
+                    logging.error(f'failed to process {file_name}: {e}')
+                    index.record(file_name, 'failed', error=str(e))
+                num_done += 1
+                if num_done % 100 == 0:
+                    logging.info(f'done processing {num_done} videos')
+    index.close()
+
 
 def main():
     setup_logging()
-    
+
     parser = argparse.ArgumentParser(description='Process a folder path.')
 
     parser.add_argument('folder_path', type=str, help='Path to the folder to be processed', default='/data_menghao/XPretrain/hdvila_100m/default_content_detector_clips_the_magic_key_from_bbdown')
+    parser.add_argument('--max_workers', type=int, default=8)
+    parser.add_argument('--max_in_flight', type=int, default=None,
+                        help='videos submitted but not finished, defaults to twice the workers')
+    parser.add_argument('--downscale_width', type=int, default=256, help='approximate frame width for detection')
+    parser.add_argument('--frame_skip', type=int, default=0, help='frames skipped between detected frames')
 
     args = parser.parse_args()
 
     if not os.path.isdir(args.folder_path):
         logging.info(f"Error: The folder {args.folder_path} does not exist.")
         return
-    
-    
-    fun(folder_path=args.folder_path, vid_format='mp4')
-    fun(folder_path=args.folder_path, vid_format='mkv')
-    fun(folder_path=args.folder_path, vid_format='avi')
-    
+
+
+    fun(folder_path=args.folder_path, vid_formats=('mp4', 'mkv', 'avi'), max_workers=args.max_workers,
+        max_in_flight=args.max_in_flight, downscale_width=args.downscale_width, frame_skip=args.frame_skip)
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
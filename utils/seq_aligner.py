@@ -58,24 +58,40 @@ def get_traceback_matrix(size_x, size_y):
     return matrix
 
 
-def global_align(x, y, score):
-    matrix = get_matrix(len(x), len(y), score.gap)
-    trace_back = get_traceback_matrix(len(x), len(y))
-    for i in range(1, len(x) + 1):
-        for j in range(1, len(y) + 1):
-            left = matrix[i, j - 1] + score.gap
-            up = matrix[i - 1, j] + score.gap
-            diag = matrix[i - 1, j - 1] + score.mis_match_char(x[i - 1], y[j - 1])
-            matrix[i, j] = max(left, up, diag)
-            if matrix[i, j] == left:
-                trace_back[i, j] = 1
-            elif matrix[i, j] == up:
-                trace_back[i, j] = 2
-            else:
-                trace_back[i, j] = 3
+def global_align_batch(x, ys, score):
+    """
+    Needleman-Wunsch alignment of `x` with every sequence of `ys` at once, row by row over `x` with numpy.
+    Within a row the left moves are a running maximum: with a linear gap cost
+    matrix[i, j] = max over k <= j of (row[k] + (j - k) * gap), where row holds the best of up / diag moves.
+    Shorter sequences of `ys` are padded on the right, which doesn't affect the cells of their own length.
+    :return: [len(ys), len(x) + 1, max len + 1] score and traceback matrices, ties prefer left, up, diag.
+    """
+    size_x, size_y = len(x), max((len(y) for y in ys), default=0)
+    x = np.asarray(x, dtype=np.int64)
+    y = np.full((len(ys), size_y), -1, dtype=np.int64)
+    for b, y_b in enumerate(ys):
+        y[b, :len(y_b)] = y_b
+    match = np.where(x[None, :, None] == y[:, None, :], score.match, score.mismatch)
+
+    matrix = np.repeat(get_matrix(size_x, size_y, score.gap)[None], len(ys), axis=0)
+    trace_back = np.repeat(get_traceback_matrix(size_x, size_y)[None], len(ys), axis=0)
+    offsets = np.arange(size_y + 1) * score.gap
+    for i in range(1, size_x + 1):
+        up = matrix[:, i - 1, 1:] + score.gap
+        diag = matrix[:, i - 1, :-1] + match[:, i - 1]
+        row = np.concatenate([matrix[:, i, :1], np.maximum(up, diag)], axis=1)
+        matrix[:, i] = np.maximum.accumulate(row - offsets, axis=1) + offsets
+        left = matrix[:, i, :-1] + score.gap
+        current = matrix[:, i, 1:]
+        trace_back[:, i, 1:] = np.where(current == left, 1, np.where(current == up, 2, 3))
     return matrix, trace_back
 
 
+def global_align(x, y, score):
+    matrix, trace_back = global_align_batch(x, [y], score)
+    return matrix[0], trace_back[0]
+
+
 def get_aligned_sequences(x, y, trace_back):
     x_seq = []
     y_seq = []
@@ -104,11 +120,7 @@ def get_aligned_sequences(x, y, trace_back):
     return x_seq, y_seq, torch.tensor(mapper_y_to_x, dtype=torch.int64)
 
 
-def get_mapper(x: str, y: str, tokenizer, max_len=77):
-    x_seq = tokenizer.encode(x)
-    y_seq = tokenizer.encode(y)
-    score = ScoreParams(0, 1, -1)
-    matrix, trace_back = global_align(x_seq, y_seq, score)
+def alignment_mapper(x_seq, y_seq, trace_back, max_len=77):
     mapper_base = get_aligned_sequences(x_seq, y_seq, trace_back)[-1]
     alphas = torch.ones(max_len)
     alphas[: mapper_base.shape[0]] = mapper_base[:, 1].ne(-1).float()
@@ -118,11 +130,23 @@ def get_mapper(x: str, y: str, tokenizer, max_len=77):
     return mapper, alphas
 
 
+def get_mapper(x: str, y: str, tokenizer, max_len=77):
+    x_seq = tokenizer.encode(x)
+    y_seq = tokenizer.encode(y)
+    score = ScoreParams(0, 1, -1)
+    matrix, trace_back = global_align(x_seq, y_seq, score)
+    return alignment_mapper(x_seq, y_seq, trace_back, max_len)
+
+
 def get_refinement_mapper(prompts, tokenizer, max_len=77):
-    x_seq = prompts[0]
+    """Mappers of prompts[1:] to prompts[0], all aligned to the tokens of prompts[0] in one batch."""
+    x_seq = tokenizer.encode(prompts[0])
+    y_seqs = [tokenizer.encode(prompt) for prompt in prompts[1:]]
+    score = ScoreParams(0, 1, -1)
+    _, trace_backs = global_align_batch(x_seq, y_seqs, score)
     mappers, alphas = [], []
-    for i in range(1, len(prompts)):
-        mapper, alpha = get_mapper(x_seq, prompts[i], tokenizer, max_len)
+    for y_seq, trace_back in zip(y_seqs, trace_backs):
+        mapper, alpha = alignment_mapper(x_seq, y_seq, trace_back[:, :len(y_seq) + 1], max_len)
         mappers.append(mapper)
         alphas.append(alpha)
     return torch.stack(mappers), torch.stack(alphas)
@@ -0,0 +1,118 @@
+import os
+import random
+
+import numpy as np
+import torch
+from accelerate.logging import get_logger
+from torch.utils.data import Sampler
+
+logger = get_logger(__name__, log_level="INFO")
+
+TRAINING_STATE_DIR = "training_state"
+
+
+class ResumableSampler(Sampler):
+    """
+    Shuffling sampler whose position in the epoch can be checkpointed.
+    The permutation only depends on (seed, epoch), so a resumed run rebuilds it and starts at the saved position
+    instead of loading and throwing away every batch that was already trained on.
+    `position` counts the samples of the epoch consumed by all processes together. accelerate shards the batches of
+    this sampler across processes round-robin, so restarting the epoch at `position` puts every rank at its own next
+    batch. There is deliberately no `set_epoch`, the dataloader wrappers of accelerate would reset the epoch to their
+    own iteration counter, which restarts at 0 after a resume.
+    """
+
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def permutation(self):
+        if not self.shuffle:
+            return list(range(len(self.data_source)))
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return torch.randperm(len(self.data_source), generator=generator).tolist()
+
+    def __iter__(self):
+        # materialized when the dataloader iterator is created, later `advance` calls only affect the next pass
+        return iter(self.permutation()[self.position:])
+
+    def start_epoch(self, epoch, position=0):
+        self.epoch = epoch
+        self.position = position
+
+    def advance(self, num_samples):
+        self.position += num_samples
+
+    def state_dict(self):
+        return {"epoch": self.epoch, "position": self.position, "seed": self.seed, "shuffle": self.shuffle,
+                "num_samples": len(self)}
+
+    def load_state_dict(self, state):
+        if state["num_samples"] != len(self):
+            raise ValueError(f"Sampler state was saved for {state['num_samples']} samples per epoch, "
+                             f"this sampler draws {len(self)}")
+        self.seed = state["seed"]
+        self.shuffle = state["shuffle"]
+        self.start_epoch(state["epoch"], state["position"])
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def save_training_state(checkpoint_dir, accelerator, optimizer, lr_scheduler, sampler, global_step, epoch):
+    """
+    Everything besides the weights that is needed to continue a run from `checkpoint_dir`: optimizer, lr scheduler
+    and sampler state (written once by the main process) and the RNG state of every process.
+    Must be called on all processes.
+    """
+    state_dir = os.path.join(checkpoint_dir, TRAINING_STATE_DIR)
+    os.makedirs(state_dir, exist_ok=True)
+    if accelerator.is_main_process:
+        torch.save({
+            "global_step": global_step,
+            "epoch": epoch,
+            "num_processes": accelerator.num_processes,
+            "sampler": sampler.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "lr_scheduler": lr_scheduler.state_dict(),
+        }, os.path.join(state_dir, "state.pt"))
+    torch.save(rng_state(), os.path.join(state_dir, f"rng_{accelerator.process_index}.pt"))
+
+
+def has_training_state(checkpoint_dir):
+    return os.path.isfile(os.path.join(checkpoint_dir, TRAINING_STATE_DIR, "state.pt"))
+
+
+def load_training_state(checkpoint_dir, accelerator, optimizer, lr_scheduler, sampler):
+    """Counterpart of `save_training_state`, returns (global_step, epoch)."""
+    state_dir = os.path.join(checkpoint_dir, TRAINING_STATE_DIR)
+    state = torch.load(os.path.join(state_dir, "state.pt"), map_location="cpu", weights_only=False)
+    if state["num_processes"] != accelerator.num_processes:
+        # the sampler position is global, only the per-process rng streams can't be matched up
+        logger.warning(f"Checkpoint was written by {state['num_processes']} processes, resuming with "
+                       f"{accelerator.num_processes}, the random state is not restored")
+    else:
+        set_rng_state(torch.load(os.path.join(state_dir, f"rng_{accelerator.process_index}.pt"), weights_only=False))
+    sampler.load_state_dict(state["sampler"])
+    optimizer.load_state_dict(state["optimizer"])
+    lr_scheduler.load_state_dict(state["lr_scheduler"])
+    return state["global_step"], state["epoch"]
@@ -0,0 +1,154 @@
+import queue
+import subprocess
+import threading
+
+import imageio
+import numpy as np
+import torch
+
+
+def frames_to_uint8(frames):
+    """
+    [channels, frames, height, width] decoder output in [-1, 1] -> [frames, height, width, channels] uint8 numpy.
+    """
+    frames = (frames / 2 + 0.5).clamp(0, 1).mul(255).round().to(torch.uint8)
+    return frames.permute(1, 2, 3, 0).cpu().numpy()
+
+
+class FrameSink:
+    """Receives decoded uint8 frames of shape [frames, height, width, channels] chunk by chunk."""
+
+    def write(self, frames):
+        raise NotImplementedError
+
+    def close(self):
+        return None
+
+
+class CallbackSink(FrameSink):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, frames):
+        self.callback(frames)
+
+
+class ImageioSink(FrameSink):
+    """Appends frames to an imageio writer, e.g. a gif (`duration`, `loop`) or an mp4 (`fps`)."""
+
+    def __init__(self, path, **writer_kwargs):
+        self.path = path
+        self.writer = imageio.get_writer(path, **writer_kwargs)
+
+    def write(self, frames):
+        for frame in frames:
+            self.writer.append_data(frame)
+
+    def close(self):
+        self.writer.close()
+        return self.path
+
+
+class FFmpegSink(FrameSink):
+    """Pipes raw rgb24 frames into an ffmpeg encoder process. The process is started on the first chunk."""
+
+    def __init__(self, path, fps=8, codec="libx264", crf=18, pix_fmt="yuv420p", ffmpeg="ffmpeg"):
+        self.path = path
+        self.fps = fps
+        self.codec = codec
+        self.crf = crf
+        self.pix_fmt = pix_fmt
+        self.ffmpeg = ffmpeg
+        self.process = None
+
+    def _open(self, height, width):
+        command = [
+            self.ffmpeg, "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(self.fps), "-i", "-",
+            "-c:v", self.codec, "-crf", str(self.crf), "-pix_fmt", self.pix_fmt, self.path,
+        ]
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frames):
+        if self.process is None:
+            self._open(frames.shape[1], frames.shape[2])
+        self.process.stdin.write(np.ascontiguousarray(frames).tobytes())
+
+    def close(self):
+        if self.process is None:
+            return None
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to encode {self.path}")
+        return self.path
+
+
+class MemmapSink(FrameSink):
+    """Writes frames into a `.npy` memmap of `num_frames` frames, allocated on the first chunk."""
+
+    def __init__(self, path, num_frames):
+        self.path = path
+        self.num_frames = num_frames
+        self.array = None
+        self.index = 0
+
+    def write(self, frames):
+        if self.array is None:
+            self.array = np.lib.format.open_memmap(self.path, mode="w+", dtype=np.uint8,
+                                                   shape=(self.num_frames, *frames.shape[1:]))
+        self.array[self.index: self.index + len(frames)] = frames
+        self.index += len(frames)
+
+    def close(self):
+        if self.array is not None:
+            self.array.flush()
+        return self.array
+
+
+class TeeSink(FrameSink):
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def write(self, frames):
+        for sink in self.sinks:
+            sink.write(frames)
+
+    def close(self):
+        return [sink.close() for sink in self.sinks]
+
+
+class BackgroundSink(FrameSink):
+    """
+    Runs another sink on a worker thread so that encoding overlaps with decoding of the next chunk.
+    At most `max_pending` chunks are buffered, which keeps host memory bounded by the decode chunk size.
+    """
+
+    def __init__(self, sink, max_pending=2):
+        self.sink = sink
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frames = self.queue.get()
+            if frames is None:
+                break
+            if self.error is None:
+                try:
+                    self.sink.write(frames)
+                except Exception as e:
+                    self.error = e
+
+    def write(self, frames):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frames)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.sink.close()